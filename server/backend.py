@@ -3,12 +3,15 @@
 import json
 import logging
 import requests
+import socket
+import time
 import traceback
+import uuid
 
-from . import session, user_monitor, twist_forward, agentclient
+from . import session, user_monitor, twist_forward, agentclient, inventory, vmwaiter, rdpgateway, telemetry, qos
 
 from oslo_config import cfg
-from twisted.internet import threads, reactor
+from twisted.internet import defer, threads, reactor, task
 
 
 log = logging.getLogger(__name__)
@@ -19,6 +22,16 @@ opt_server_group = cfg.OptGroup(name='server',
 server_opts = [
     cfg.StrOpt('local_ip', default='192.168.1.41',
                help=('Local IP')),
+    cfg.IntOpt('gateway_port', default=0,
+               help=('Serve all RDP connections on this port, routed by '
+                     'RDP routing token; 0 opens one port per connection')),
+    cfg.IntOpt('bulk_concurrency', default=10,
+               help=('Max concurrent power actions of a bulk request')),
+    cfg.IntOpt('bulk_timeout', default=180,
+               help=('Seconds to wait for each VM of a bulk request')),
+    cfg.FloatOpt('notify_window', default=0.1,
+                 help=('Seconds to collect user status changes into one '
+                       'WebSocket message, 0 sends each change at once')),
 ]
 
 CONF = cfg.CONF
@@ -28,48 +41,164 @@ CONF.register_opts(server_opts, opt_server_group)
 cfg.CONF(default_config_files=['/etc/foldex/foldex.conf'])
 
 _monitor = None
+_wsf = None
 _proxy = twist_forward.ForwardInst()
+_gateway = None
+_gateway_port = None
 
 _local_ip = CONF.server.local_ip
 
 _connections = {}
 
+_waiter = vmwaiter.StatusWaiter(inventory.poll_status)
+
+_hypervisor_refresher = task.LoopingCall(
+    lambda: threads.deferToThread(session.refresh_hypervisors).addErrback(_refresh_err_handler))
+_inventory_refresher = task.LoopingCall(
+    lambda: threads.deferToThread(inventory.refresh).addErrback(_refresh_err_handler))
+
+def init_gateway(fd=None):
+    """启用单端口 RDP 网关，fd 为从旧进程接管的监听 socket。"""
+    global _gateway, _gateway_port
+    if _gateway is not None or (fd is None and not CONF.server.gateway_port):
+        return
+    _gateway = rdpgateway.GatewayFactory()
+    _gateway.limiter = _proxy.limiter
+    if fd is None:
+        _gateway_port = reactor.listenTCP(CONF.server.gateway_port, _gateway, interface=_local_ip)
+    else:
+        _gateway_port = reactor.adoptStreamPort(fd, socket.AF_INET, _gateway)
+    log.info('RDP gateway listening on {}'.format(_gateway_port.getHost()))
+
 def init_ws(wsf):
-    global _monitor
-    _monitor = user_monitor.UserMonitor(wsf, timeout=30, interval=5)
+    global _monitor, _wsf
+    _wsf = wsf
+    _monitor = user_monitor.UserMonitor(wsf, timeout=30, interval=5,
+                                        notify_window=CONF.server.notify_window)
+    wsf.state = _monitor.snapshot
+    wsf.item_topics = user_monitor.topics_of
+
+def _log_stage(result, username, stage, start):
+    log.debug('Login of {}: {} took {:.3f}s'.format(username, stage, time.time() - start))
+    return result
+
+def _login_stage(username, stage, fn, *args):
+    """在线程中执行登录的一个步骤并记录耗时。"""
+    d = threads.deferToThread(fn, *args)
+    d.addBoth(_log_stage, username, stage, time.time())
+    return d
+
+def _first_error(failure):
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+def _login_err(failure, username):
+    failure.trap(session.AuthenticationFailure)
+    log.error(failure.value)
+    return failure
 
 def login(username, password):
+    """用户登录，返回 Deferred，结果为VM信息和 token。
+
+    用户认证和VM列表刷新在线程中并行执行，不阻塞 reactor。
+    """
     log.info('User {} logging in'.format(username))
-    try:
-        user = session.Session(username, password)
-        admin = session.AdminSession(username)
-        vms = admin.get_vms()
-        info = {
-            'vms': vms,
-            'token': user.token
-        }
-        return info
-    except session.AuthenticationFailure as e:
-        log.error(e)
-        raise
+    start = time.time()
+    auth = _login_stage(username, 'authenticate', session.Session, username, password)
+    fresh = _login_stage(username, 'inventory', inventory.ensure_fresh)
+    d = defer.gatherResults([auth, fresh], consumeErrors=True)
+    d.addErrback(_first_error)
+
+    def collect(results):
+        user = results[0]
+        d = _login_stage(username, 'vms', inventory.get_vms, user.project_id)
+        d.addCallback(lambda vms: {'vms': vms, 'token': user.token})
+        return d
+
+    d.addCallback(collect)
+    d.addErrback(_login_err, username)
+    d.addBoth(_log_stage, username, 'login', start)
+    return d
+
+def all_vms():
+    """列出所有项目的VM，供管理界面使用。"""
+    return inventory.all_vms()
+
+def _vm_ready(user, vm_id):
+    """在线程中查询已启动VM的连接信息和浮动ip。"""
+    ip = inventory.get_vm_ip(vm_id)
+    if ip is None: # 没有浮动ip或VM不存在时无法转发
+        raise session.VMError('VM {} has no floating ip'.format(vm_id))
+    return user.ready_info(vm_id), ip
+
+def _wait_powered_on(started, user, vm_id):
+    if not started:
+        return None
+    d = _waiter.wait(vm_id, 'ACTIVE', user.status_wait_timeout)
+    d.addCallback(lambda _: log.info('VM {} powered on'.format(vm_id)))
+    return d
+
+def prepare_vm(user, vm_id):
+    """启动VM，等待期间不占用线程。
+
+    返回 Deferred，结果为 (msg, ip)。
+    """
+    d = threads.deferToThread(user.power_on, vm_id)
+    d.addCallback(_wait_powered_on, user, vm_id)
+    d.addCallback(lambda _: threads.deferToThread(_vm_ready, user, vm_id))
+    return d
+
+def _request_connect_vm_err(failure, request):
+    failure.trap(session.VMError)
+    log.error('VM failed to start: {}'.format(failure.getErrorMessage()))
+    request.setResponseCode(500)
+    request.write(json.dumps({'err': failure.getErrorMessage()}))
+    request.finish()
 
-def _request_connect_cb(msg, user, vm_id, request):
+def _request_connect_cb(result, user, vm_id, request):
+    msg, ip = result
     res = msg['res']
-    vm_info = user.get_vms()[vm_id]
-    ip = vm_info['floating_ips'][0]
     log.debug('vm ip: {}'.format(ip))
+    res[vm_id]['policy'] = 1 # 默认启用驱动器重定向
+    shaper = qos.shaper(user.username, res[vm_id]['policy'])
 
-    localport = _proxy.addProxy(ip, 3389)
+    try:
+        if _gateway is not None:
+            token = _gateway.add_route(ip, 3389, user.username, vm_id, shaper)
+            localport = CONF.server.gateway_port
+            res[vm_id]['rdp_token'] = token # 客户端填写到 loadbalanceinfo
+            _connections[vm_id] = token
+            ready = defer.succeed(localport)
+        else:
+            localport = _proxy.addProxy(ip, 3389, _local_ip, user.username, vm_id, shaper)
+            _connections[vm_id] = localport
+            ready = _proxy.whenReady(localport) # 转发进程开始监听后再回复客户端
+    except IOError as e:
+        log.error('Cannot find free port: {}'.format(e))
+        request.setResponseCode(503)
+        request.write(json.dumps({'err': str(e)}))
+        request.finish()
+        return
+
+    ready.addCallback(_request_connect_reply, msg, vm_id, request)
+    ready.addErrback(_request_connect_forward_err, vm_id, request)
+
+def _request_connect_forward_err(failure, vm_id, request):
+    failure.trap(IOError)
+    log.error('Cannot start forwarding: {}'.format(failure.getErrorMessage()))
+    _proxy.deleteProxy(_connections.pop(vm_id))
+    request.setResponseCode(503)
+    request.write(json.dumps({'err': failure.getErrorMessage()}))
+    request.finish()
 
+def _request_connect_reply(localport, msg, vm_id, request):
+    res = msg['res']
     res[vm_id]['rdp_ip'] = _local_ip
     res[vm_id]['rdp_port'] = localport
-    res[vm_id]['policy'] = 1 # 默认启用驱动器重定向
     log.debug('local ip: {}, local port: {}'.format(_local_ip, localport))
-    _connections[vm_id] = localport
 
     # TODO contact client agent
     client_ip = request.getClientIP()
-    vm_info = user.get_vms()[vm_id]
     ac = agentclient.AgentClient(client_ip)
 
     enable = True
@@ -93,8 +222,9 @@ def request_connect(token, vm_id, request):
     try:
         user = session.Session.get(token)
         log.info('User {} attempt to connect to VM {}'.format(user.username, vm_id))
-        d = threads.deferToThread(user.start_vm, vm_id)
-        d.addCallback(_request_connect_cb, user, vm_id, request)
+        d = prepare_vm(user, vm_id)
+        d.addCallbacks(_request_connect_cb, _request_connect_vm_err,
+                       callbackArgs=(user, vm_id, request), errbackArgs=(request,))
         d.addErrback(_err_handler)
     except session.InvalidTokenError as e:
         log.error(e)
@@ -105,12 +235,94 @@ def request_connect(token, vm_id, request):
     except IOError as e:
         log.error('Cannot find free port: {}'.format(e))
 
+# 批量操作: (发送请求的方法名, 目标状态)
+_bulk_actions = {
+    'start': ('power_on', 'ACTIVE'),
+    'stop': ('power_off', 'SHUTOFF'),
+}
+
+def _bulk_notify(result, job, op):
+    msg = {'action': 'bulk', 'job': job, 'op': op}
+    msg.update(result)
+    topics = ['vm:{}'.format(result['vm'])]
+    info = inventory.lookup_vm(result['vm'])
+    if info is not None:
+        topics.append('project:{}'.format(info[u'project_id']))
+    _wsf.publish(msg, topics=topics)
+    return result
+
+def _bulk_one(actor, op, vm_id, job, sem):
+    method, status = _bulk_actions[op]
+    d = sem.run(threads.deferToThread, getattr(actor, method), vm_id)
+
+    def wait(sent):
+        if not sent: # VM已处于目标状态或无法执行该操作
+            return 'skipped'
+        d = _waiter.wait(vm_id, status, CONF.server.bulk_timeout)
+        d.addCallback(lambda _: 'done')
+        return d
+
+    d.addCallback(wait)
+    d.addCallbacks(lambda r: {'vm': vm_id, 'result': r, 'status': status},
+                   lambda f: {'vm': vm_id, 'result': 'failed', 'err': f.getErrorMessage()})
+    d.addCallback(_bulk_notify, job, op)
+    return d
+
+def _bulk_done(results, job, op):
+    summary = {}
+    for ok, result in results:
+        summary[result['result']] = summary.get(result['result'], 0) + 1
+    log.info('Bulk {} job {} finished: {}'.format(op, job, summary))
+    _wsf.publish({'action': 'bulk_done', 'job': job, 'op': op, 'summary': summary})
+
+def bulk_power(token, op, vm_ids=None, project=None):
+    """批量开关机。
+
+    指定 vm_ids 时以用户身份操作；指定 project 时操作项目中的全部VM，
+    需要是该项目的用户或管理员。
+    发送请求的并发数有上限，各VM的结果通过 WebSocket 推送。
+    参数不正确时抛出 ValueError。
+    """
+    if (vm_ids is None) == (project is None):
+        raise ValueError('Exactly one of vm_ids and project is required')
+    if vm_ids is not None and (not isinstance(vm_ids, list) or
+                               not all(isinstance(v, basestring) for v in vm_ids)):
+        raise ValueError('vm_ids must be a list of VM ids')
+    user = session.Session.get(token)
+    if project is not None:
+        if project != user.project_id and user.username != CONF.os.admin_user:
+            raise session.PermissionDenied(user.username, project)
+        vm_ids = inventory.lookup_project_vms(project)
+        actor = None
+    else:
+        actor = user
+    job = uuid.uuid4().hex
+    log.info('User {} bulk {} job {}: {} VMs'.format(user.username, op, job, len(vm_ids)))
+
+    def run(actor):
+        sem = defer.DeferredSemaphore(CONF.server.bulk_concurrency)
+        ds = [_bulk_one(actor, op, vm_id, job, sem) for vm_id in vm_ids]
+        return defer.DeferredList(ds).addCallback(_bulk_done, job, op)
+
+    if actor is None: # 操作整个项目时使用管理员会话
+        d = threads.deferToThread(session.admin_session, CONF.os.admin_project)
+    else:
+        d = defer.succeed(actor)
+    d.addCallback(run)
+    d.addErrback(_err_handler)
+    return {'job': job, 'vms': vm_ids}
+
 def disconnect_user(user, vm_id):
     # 如果是前端请求断开连接，次函数会执行两次，
     # 一次是响应前端请求，一次是断开之后响应客户端请求
     log.debug('disconnecting vm: {}'.format(vm_id))
-    localport = _connections[vm_id]
-    _proxy.deleteProxy(localport)
+    conn = _connections.pop(vm_id, None)
+    if conn is None: # 已断开或代理因空闲被关闭
+        pass
+    elif _gateway is not None:
+        _gateway.remove_route(conn)
+    else:
+        _proxy.deleteProxy(conn)
     _monitor.update_connection(user, vm=None)
     _monitor.notify(user)
     return {'status': 'OK'}
@@ -123,6 +335,84 @@ def disconnect(token, vm_id):
         log.error(e)
         raise
 
+def _refresh_err_handler(failure):
+    log.error('Background refresh failed: {}'.format(failure.getErrorMessage()))
+
+
+def start_cache_refresh():
+    _hypervisor_refresher.start(CONF.os.hypervisor_refresh_interval)
+    _inventory_refresher.start(CONF.inventory.refresh_interval)
+
+
+def _forward_reaped(reaped):
+    """代理端口或网关路由因空闲被关闭。"""
+    for vm_id, conn in _connections.items():
+        if conn == reaped:
+            del _connections[vm_id]
+
+
+def forwarding_state():
+    """转发相关的状态，用于交给新进程。"""
+    return {
+        'forward': _proxy,
+        'gateway': _gateway,
+        'gateway_port': _gateway_port,
+        'connections': _connections
+    }
+
+
+def restore_connections(connections):
+    _connections.update(connections)
+
+
+def session_state():
+    """登录会话、用户在线状态和 WebSocket 序号，用于交给新进程。"""
+    return {
+        'sessions': session.Session.tokens().export(),
+        'monitor': _monitor.export(),
+        'websocket': _wsf.export()
+    }
+
+
+def _resume_session(state):
+    try:
+        session.Session.resume(state)
+    except session.AuthenticationFailure as e: # token 已过期或被撤销
+        log.info('Session not resumed: {}'.format(e))
+    except Exception as e:
+        log.warning('Session of user {} not resumed: {}'.format(state['username'], e))
+
+
+def restore_session_state(state):
+    """恢复旧进程的状态，返回所有会话恢复完成后触发的 Deferred。"""
+    _monitor.restore(state['monitor'])
+    _wsf.restore(state['websocket'])
+    ds = [threads.deferToThread(_resume_session, item) for item in state['sessions']]
+    d = defer.DeferredList(ds, consumeErrors=True)
+    d.addCallback(lambda _: log.info('Resumed {} sessions'.format(len(session.Session.tokens()))))
+    return d
+
+
+def start_forwarding():
+    _proxy.onReap = _forward_reaped
+    _proxy.start()
+    if _gateway is not None:
+        _gateway.onReap = _forward_reaped
+        _gateway.start(CONF.server.proxy_idle_timeout)
+
+
+def stop_forwarding():
+    _proxy.stop()
+    if _gateway is not None:
+        _gateway.stop()
+
+
+def stop_cache_refresh():
+    for refresher in (_hypervisor_refresher, _inventory_refresher):
+        if refresher.running:
+            refresher.stop()
+
+
 def start_heartbeat_monitor():
     _monitor.start()
 
@@ -153,3 +443,27 @@ def init_user(token, from_ip):
 def user_status():
     status = [{'user': t[0], 'vm': t[1], 'ip_addr': t[2]} for t in _monitor.status()]
     return status
+
+
+def stats():
+    """各缓存和连接的统计信息，供管理界面使用。"""
+    return {
+        'inventory': inventory.stats(),
+        'tokens': session.Session.tokens().stats(),
+        'singleflight': session.flights.stats(),
+        'ports': _proxy.stats(),
+        'gateway': _gateway.stats() if _gateway is not None else None,
+        'qos': qos.stats(),
+        'notifications': _monitor.batcher.stats() if _monitor is not None else None,
+        'websocket': _wsf.stats() if _wsf is not None else None
+    }
+
+
+def ws_clients():
+    """WebSocket 客户端的发送缓冲和丢弃的消息数。"""
+    return _wsf.queues() if _wsf is not None else []
+
+
+def traffic():
+    """按用户和VM汇总的转发流量、背压和连接时间。"""
+    return telemetry.registry.report()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import json
+import logging
+import logging.config
+import os
+import select
+
+from . import logconf, port_forward
+
+
+log = logging.getLogger(__name__)
+
+
+class Control(object):
+    """从 stdin 读取主进程的命令，回复写到 stdout，每行一个 JSON 对象。
+
+    命令: {"op": "add", "port": p, "host": h, "dest": ip, "dport": 3389}
+          {"op": "delete", "port": p}
+          {"op": "stats"}
+          {"op": "limit", "ports": [p, ...]}
+
+    stats 回复各端口的连接数和最后一个连接关闭的时间（有连接时为 null），
+    以及上次回复以来拒绝的连接数：
+          {"op": "stats", "ports": {p: [连接数, 空闲开始时间]}, "refused": n}
+    limit 给出超过连接数限制的端口，这些端口上的新连接直接关闭。
+    """
+
+    def __init__(self, loop, fd_in=0, fd_out=1):
+        self.loop = loop
+        self.fd = fd_in
+        self.fd_out = fd_out
+        self.buf = ''
+        self.listeners = {}
+        self.refusing = set() # 超过连接数限制的端口
+
+    def on_event(self, events):
+        data = os.read(self.fd, 65536)
+        if not data: # 主进程已退出或要求退出
+            self.loop.thread_stop = True
+            return
+        self.buf += data
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            try:
+                self.handle(json.loads(line))
+            except Exception as e:
+                log.error('Bad command {}: {}'.format(line, e))
+
+    def reply(self, msg):
+        os.write(self.fd_out, json.dumps(msg) + '\n')
+
+    def handle(self, cmd):
+        if cmd['op'] == 'stats':
+            self.reply(self.stats())
+            return
+        if cmd['op'] == 'limit':
+            self.refusing = set(cmd['ports'])
+            for port, listener in self.listeners.items():
+                listener.refusing = port in self.refusing
+            return
+        port = cmd['port']
+        if cmd['op'] == 'add':
+            try:
+                listener = port_forward.Listener(self.loop, cmd['host'], port,
+                                                 cmd['dest'], cmd['dport'], reuse_port=True)
+            except EnvironmentError as e:
+                self.reply({'op': 'error', 'port': port, 'err': str(e)})
+                return
+            listener.refusing = port in self.refusing
+            listener.start()
+            self.listeners[port] = listener
+            self.reply({'op': 'added', 'port': port})
+        elif cmd['op'] == 'delete':
+            listener = self.listeners.pop(port, None)
+            if listener is not None:
+                listener.close()
+            self.reply({'op': 'deleted', 'port': port})
+
+    def stats(self):
+        refused = 0
+        for listener in self.listeners.values():
+            refused += listener.refused
+            listener.refused = 0
+        ports = dict((port, [listener.connections(), listener.idle_since])
+                     for port, listener in self.listeners.items())
+        return {'op': 'stats', 'ports': ports, 'refused': refused}
+
+    def close(self):
+        self.loop.unregister(self)
+        for listener in self.listeners.values():
+            listener.close()
+
+
+def main():
+    conf = copy.deepcopy(logconf.conf_dict)
+    conf['handlers']['console']['stream'] = 'ext://sys.stderr' # stdout 用于回复主进程
+    logging.config.dictConfig(conf)
+
+    loop = port_forward.EventLoop()
+    loop.register(Control(loop), select.EPOLLIN)
+    log.debug('Forwarding worker {} started'.format(os.getpid()))
+    loop.run()
+
+
+if __name__ == '__main__':
+    main()
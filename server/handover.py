@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import socket
+import struct
+import time
+
+from . import backend, qos
+
+from collections import deque
+from oslo_config import cfg
+from twisted.internet import defer, protocol, reactor, task
+from twisted.internet.error import ConnectError
+from twisted.internet.interfaces import IFileDescriptorReceiver
+from zope.interface import implementer
+
+
+log = logging.getLogger(__name__)
+
+opt_server_group = cfg.OptGroup(name='server',
+                            title='Foldex Server IP Port')
+
+handover_opts = [
+    cfg.StrOpt('handover_socket', default='',
+               help=('UNIX socket used to hand listening sockets and live '
+                     'RDP connections over to a newly started process, '
+                     'empty to disable hot restart')),
+    cfg.IntOpt('handover_drain_timeout', default=5,
+               help=('Seconds to wait for buffered data to be written '
+                     'before handing connections over')),
+]
+
+CONF = cfg.CONF
+CONF.register_group(opt_server_group)
+CONF.register_opts(handover_opts, opt_server_group)
+
+# 交接消息，每行一个 JSON 对象，fds 为随消息发送的文件描述符个数：
+#   {"type": "http", "fds": 1}
+#   {"type": "gateway", "fds": 1, "routes": [[token, host, port, user, vm_id, shaper], ...]}
+#   {"type": "proxy", "fds": 1, "dest": ip, "dport": 3389, "user": u, "vm_id": id, "shaper": [u, policy]}
+#   {"type": "conn", "fds": 2, "port": p} 或 {"type": "conn", "fds": 2, "token": t}
+#   {"type": "connections", "fds": 0, "map": {vm_id: port 或 token}}
+#   {"type": "state", "fds": 0, "sessions": [...], "monitor": [...], "websocket": {...}}
+#   {"type": "end", "fds": 0}
+# 新进程接管后回复 {"type": "done"}。旧进程不能交接时只发送
+#   {"type": "refused", "fds": 0, "reason": "..."}
+
+
+class HandoverError(Exception):
+    pass
+
+
+class HandoverRefused(HandoverError):
+    """旧进程拒绝交接，新进程不能启动。"""
+
+
+# Python 2 的 socket 模块没有 SO_PEERCRED，取 Linux 的值
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+def peer_uid(transport):
+    """UNIX socket 对端进程的 uid。"""
+    creds = transport.getHandle().getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+def _private_dir(path):
+    """socket 所在目录不存在时创建为只有本用户可访问，已存在时检查权限。"""
+    dirname = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname, 0o700)
+    st = os.stat(dirname)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise HandoverError('{} must be owned by uid {} and not accessible to others'.format(
+            dirname, os.getuid()))
+
+
+class _Pair(object):
+    """一条已连接的转发连接：客户端一侧和VM一侧。"""
+
+    def __init__(self, server):
+        self.server = server
+        self.client = server.peer
+
+    def freeze(self):
+        if self.server.splice is not None:
+            self.server.splice.freeze()
+        else:
+            self.server.producer.freeze()
+            self.client.producer.freeze()
+
+    def thaw(self):
+        if self.server.splice is not None:
+            self.server.splice.thaw()
+        else:
+            self.server.producer.thaw()
+            self.client.producer.thaw()
+
+    def alive(self):
+        return self.server.transport.connected and self.client.transport.connected
+
+    def drained(self):
+        if not self.alive():
+            return True
+        if self.server.splice is not None:
+            return self.server.splice.drained()
+        # 发送缓冲非空的 transport 注册为 writer，写完后移除
+        writers = reactor.getWriters()
+        return self.server.transport not in writers and self.client.transport not in writers
+
+    def fds(self):
+        return [self.server.transport.fileno(), self.client.transport.fileno()]
+
+    def detach(self):
+        if self.server.splice is not None:
+            self.server.splice.detach()
+        for transport in (self.server.transport, self.client.transport):
+            reactor.removeReader(transport)
+            reactor.removeWriter(transport)
+
+
+def _connected(server):
+    """已连接到VM并开始转发。"""
+    return server.splice is not None or \
+        (server.peer is not None and server.peer.producer is not None)
+
+
+def _shaper_key(shaper):
+    return list(shaper.key) if shaper is not None else None
+
+
+def _shaper(key):
+    return qos.shaper(*key) if key is not None else None
+
+
+class Sender(protocol.Protocol):
+    """旧进程一侧：停止接受新连接，等待缓冲数据写出，然后发送 socket 和状态。
+
+    新进程确认后从 reactor 移除交出的 socket 并退出，不关闭连接；
+    新进程中途断开则恢复服务。
+    """
+
+    def connectionMade(self):
+        self.buf = ''
+        self.done = False
+        self.refused = False
+        # 只交给同一用户的进程，其它用户拿到 socket 和 token 即可冒充任意会话
+        uid = peer_uid(self.transport)
+        if uid != os.getuid():
+            log.warning('Refusing handover to uid {}'.format(uid))
+            self.refuse()
+            return
+        if self.factory.active is not None:
+            log.warning('Refusing handover, another one is in progress')
+            self.refuse()
+            return
+        state = backend.forwarding_state()
+        if state['forward'].pool is not None:
+            # 转发进程中的连接无法交给新进程，旧进程退出会断开它们
+            reason = 'Connections in forwarding workers cannot be handed over'
+            log.error('Refusing handover: {}'.format(reason))
+            self.transport.write(json.dumps({'type': 'refused', 'fds': 0, 'reason': reason}) + '\n')
+            self.refuse()
+            return
+        self.factory.active = self
+        log.info('New process connected, handing over')
+        self.ports = []
+        self.pairs = []
+        self.messages = []
+        self.collect(self.factory.http_port, state, backend.session_state())
+        for port in self.ports:
+            port.stopReading()
+        for pair in self.pairs:
+            pair.freeze()
+        self.drain = task.LoopingCall(self.checkDrained)
+        self.deadline = time.time() + CONF.server.handover_drain_timeout
+        self.drain.start(0.05)
+
+    def collect(self, http_port, state, sessions):
+        forward, gateway = state['forward'], state['gateway']
+        self.ports.append(http_port)
+        self.messages.append(({'type': 'http'}, [http_port.fileno()]))
+
+        if gateway is not None:
+            port = state['gateway_port']
+            routes = [[token, host, dport] + list(gateway.owners.get(token, (None, None))) +
+                      [_shaper_key(gateway.shapers.get(token))]
+                      for token, (host, dport) in gateway.routes.items()]
+            self.ports.append(port)
+            self.messages.append(({'type': 'gateway', 'routes': routes}, [port.fileno()]))
+
+        for localport, proxy in forward.forwardlist.items():
+            factory = proxy.new_proxy
+            self.ports.append(proxy.listening)
+            self.messages.append(({'type': 'proxy', 'dest': factory.host, 'dport': factory.port,
+                                   'user': factory.user, 'vm_id': factory.vm_id,
+                                   'shaper': _shaper_key(factory.shaper)},
+                                  [proxy.listening.fileno()]))
+            for server in factory.proxy:
+                if _connected(server):
+                    self.pairs.append(_Pair(server))
+                    self.messages.append(({'type': 'conn', 'port': localport}, None))
+
+        if gateway is not None:
+            for token, servers in gateway.proxy.items():
+                for server in servers:
+                    if _connected(server):
+                        self.pairs.append(_Pair(server))
+                        self.messages.append(({'type': 'conn', 'token': token}, None))
+
+        self.messages.append(({'type': 'connections', 'map': state['connections']}, []))
+        # 登录会话和用户状态也交给新进程，客户端不需要重新登录
+        sessions['type'] = 'state'
+        self.messages.append((sessions, []))
+
+    def checkDrained(self):
+        if not all(pair.drained() for pair in self.pairs):
+            if time.time() < self.deadline:
+                return
+            log.warning('Handing over connections with unsent data')
+        self.drain.stop()
+        self.send()
+
+    def send(self):
+        pairs = iter(self.pairs)
+        for msg, fds in self.messages:
+            if fds is None:
+                pair = next(pairs)
+                if not pair.alive(): # 等待期间已断开
+                    continue
+                fds = pair.fds()
+            for fd in fds:
+                self.transport.sendFileDescriptor(fd)
+            msg['fds'] = len(fds)
+            self.transport.write(json.dumps(msg) + '\n')
+        self.transport.write(json.dumps({'type': 'end', 'fds': 0}) + '\n')
+        log.info('Sent {} ports and {} connections'.format(len(self.ports), len(self.pairs)))
+
+    def refuse(self):
+        self.refused = True
+        self.transport.loseConnection()
+
+    def dataReceived(self, data):
+        if self.refused:
+            return
+        self.buf += data
+        if '\n' in self.buf and json.loads(self.buf.split('\n', 1)[0])['type'] == 'done':
+            self.done = True
+            self.factory.finish(self.ports, self.pairs)
+
+    def connectionLost(self, reason):
+        if self.refused or self.done:
+            return
+        self.factory.active = None
+        log.error('Handover aborted: {}'.format(reason.getErrorMessage()))
+        if self.drain.running:
+            self.drain.stop()
+        for port in self.ports:
+            port.startReading()
+        for pair in self.pairs:
+            pair.thaw()
+
+
+class SenderFactory(protocol.Factory):
+
+    protocol = Sender
+
+    def __init__(self, http_port):
+        self.http_port = http_port
+        self.active = None # 正在进行的交接，同时只允许一个
+        self.exit = reactor.stop
+
+    def finish(self, ports, pairs):
+        """新进程已接管：移除交出的 socket 后退出，连接由新进程继续服务。"""
+        for port in ports:
+            port.stopReading()
+        for pair in pairs:
+            pair.detach()
+        state = backend.forwarding_state()
+        state['forward'].forwardlist.clear()
+        if state['gateway'] is not None:
+            state['gateway'].proxy.clear()
+            state['gateway'].routes.clear()
+        state['connections'].clear()
+        log.info('Handover complete, exiting')
+        self.exit()
+
+
+@implementer(IFileDescriptorReceiver)
+class Receiver(protocol.Protocol):
+    """新进程一侧：接收旧进程的 socket 和状态。"""
+
+    def __init__(self):
+        self.buf = ''
+        self.fds = deque()
+        self.items = []
+        self.received = defer.Deferred()
+
+    def fileDescriptorReceived(self, fd):
+        self.fds.append(fd)
+
+    def dataReceived(self, data):
+        self.buf += data
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            msg = json.loads(line)
+            if msg['type'] == 'refused':
+                self.received.errback(HandoverRefused(msg['reason']))
+                return
+            if msg['type'] == 'end':
+                self.received.callback(self.items)
+                return
+            self.items.append((msg, [self.fds.popleft() for _ in range(msg['fds'])]))
+
+    def finish(self):
+        self.transport.write(json.dumps({'type': 'done'}) + '\n')
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        if not self.received.called:
+            for _, fds in self.items:
+                for fd in fds:
+                    os.close(fd)
+            self.received.errback(HandoverError('Previous process went away: {}'.format(
+                reason.getErrorMessage())))
+
+
+def takeover(path):
+    """连接旧进程，返回的 Deferred 结果为 (receiver, items)，没有旧进程时为 None。"""
+    if not path or not os.path.exists(path):
+        return defer.succeed(None)
+    d = protocol.ClientCreator(reactor, Receiver).connectUNIX(path)
+
+    def connected(receiver):
+        uid = peer_uid(receiver.transport)
+        if uid != os.getuid():
+            receiver.received.addErrback(lambda _: None)
+            receiver.transport.loseConnection()
+            raise HandoverError('{} is served by uid {}'.format(path, uid))
+        log.info('Taking over from the running process')
+        receiver.received.addCallback(lambda items: (receiver, items))
+        return receiver.received
+
+    def failed(failure):
+        if failure.check(HandoverRefused):
+            return failure
+        failure.trap(ConnectError, HandoverError)
+        log.warning('Nothing taken over: {}'.format(failure.getErrorMessage()))
+        return None
+
+    d.addCallback(connected)
+    d.addErrback(failed)
+    return d
+
+
+class _Prebuilt(protocol.Factory):
+    """adoptStreamConnection 用，返回已创建好的协议实例。"""
+
+    def __init__(self, proto):
+        self.proto = proto
+
+    def buildProtocol(self, addr):
+        return self.proto
+
+
+def _adopt_pair(server, fds):
+    reactor.adoptStreamConnection(fds[0], socket.AF_INET, _Prebuilt(server))
+    if server.stats is None: # 超过连接数限制，已关闭
+        return
+    client = server.clientProtocolFactory.protocol()
+    client.setPeer(server)
+    reactor.adoptStreamConnection(fds[1], socket.AF_INET, _Prebuilt(client))
+
+
+def adopt(items, site):
+    """接管收到的 socket，返回 HTTP 监听端口。
+
+    会话在线程中恢复，恢复完成之前 HTTP 端口不接受连接，
+    新连接留在 backlog 中，不会因为 token 还未恢复而被拒绝。
+    """
+    http_port = None
+    resumed = None
+    proxies = {}
+    conns = 0
+    for msg, fds in items:
+        kind = msg['type']
+        if kind == 'http':
+            http_port = reactor.adoptStreamPort(fds[0], socket.AF_INET, site)
+        elif kind == 'gateway':
+            backend.init_gateway(fds[0])
+            gateway = backend.forwarding_state()['gateway']
+            for token, host, dport, user, vm_id, key in msg['routes']:
+                gateway.add_route(host, dport, user, vm_id, _shaper(key), token)
+        elif kind == 'proxy':
+            forward = backend.forwarding_state()['forward']
+            port = forward.adoptProxy(fds[0], msg['dest'], msg['dport'], msg['user'],
+                                      msg['vm_id'], _shaper(msg['shaper']))
+            proxies[port] = forward.forwardlist[port].new_proxy
+        elif kind == 'conn':
+            if 'token' in msg:
+                server = backend.forwarding_state()['gateway'].buildProtocol(None)
+                server.resumed = msg['token']
+            else:
+                server = proxies[msg['port']].buildProtocol(None)
+                server.resumed = True
+            _adopt_pair(server, fds)
+            conns += 1
+        elif kind == 'connections':
+            backend.restore_connections(msg['map'])
+        elif kind == 'state':
+            resumed = backend.restore_session_state(msg)
+        for fd in fds: # adopt 时已复制
+            os.close(fd)
+    log.info('Took over {} proxies and {} connections'.format(len(proxies), conns))
+    if resumed is not None and http_port is not None:
+        http_port.stopReading()
+        resumed.addBoth(lambda _: http_port.startReading())
+    return http_port
+
+
+def serve(path, http_port):
+    """等待新进程连接，交出 socket 和状态。
+
+    socket 只有本用户可以连接，所在目录也不能被其它用户访问。
+    """
+    _private_dir(path)
+    if os.path.exists(path):
+        os.unlink(path)
+    return reactor.listenUNIX(path, SenderFactory(http_port), mode=0o600)
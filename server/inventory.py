@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import logging
+import threading
+import time
+
+from . import session
+
+from collections import defaultdict
+from oslo_config import cfg
+
+
+log = logging.getLogger(__name__)
+
+opt_inventory_group = cfg.OptGroup(name='inventory',
+                            title='VM inventory cache options')
+inventory_opts = [
+    cfg.IntOpt('refresh_interval', default=10,
+               help=('Incremental refresh interval in seconds')),
+    cfg.IntOpt('max_staleness', default=30,
+               help=('Refresh before serving data older than this many seconds')),
+    cfg.IntOpt('full_sync_interval', default=3600,
+               help=('Interval in seconds between full resynchronizations')),
+]
+
+CONF = cfg.CONF
+CONF.register_group(opt_inventory_group)
+CONF.register_opts(inventory_opts, opt_inventory_group)
+
+
+def first_ip(info):
+    """VM信息中的第一个浮动ip，没有时返回 None。"""
+    if info is None or len(info[u'floating_ips']) == 0:
+        return None
+    return info[u'floating_ips'][0]
+
+
+class VMDirectory(object):
+    """全部项目的VM信息缓存。
+
+    首次全量同步，之后用 changes-since 查询只应用有变化的VM。
+    查询时如果数据过旧则先同步刷新。
+    """
+
+    # changes-since 时间提前量，容忍与 Nova 的时钟偏差，重复应用的变化无副作用
+    clock_skew = 5
+    # 查询未命中触发刷新的最小间隔
+    miss_refresh_interval = 2
+
+    def __init__(self, max_staleness, full_sync_interval):
+        self.max_staleness = max_staleness
+        self.full_sync_interval = full_sync_interval
+        self.vms = {}
+        self.projects = defaultdict(set)
+        self.synced = 0
+        self.full_synced = 0
+        self.since = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.full_syncs = 0
+        self.deltas = 0
+
+    def _admin(self):
+        return session.admin_session(CONF.os.admin_project)
+
+    def _marker(self, start):
+        ts = datetime.datetime.utcfromtimestamp(start - self.clock_skew)
+        return ts.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _put(self, vm_id, info):
+        old = self.vms.get(vm_id)
+        if old is not None and old[u'project_id'] != info[u'project_id']:
+            self.projects[old[u'project_id']].discard(vm_id)
+        self.vms[vm_id] = info
+        self.projects[info[u'project_id']].add(vm_id)
+
+    def _remove(self, vm_id):
+        old = self.vms.pop(vm_id, None)
+        if old is not None:
+            self.projects[old[u'project_id']].discard(vm_id)
+
+    def full_sync(self):
+        start = time.time()
+        vms = {}
+        for vm in self._admin().list_servers(all_projects=True):
+            vms[vm.id] = session.vm_info(vm, with_host=True)
+        with self.lock:
+            self.vms = {}
+            self.projects = defaultdict(set)
+            for vm_id in vms:
+                self._put(vm_id, vms[vm_id])
+            self.since = self._marker(start)
+            self.synced = self.full_synced = start
+            self.full_syncs += 1
+        log.debug('VM directory synced: {} VMs'.format(len(vms)))
+
+    def refresh(self, max_age=None):
+        """增量刷新，必要时全量同步。
+
+        max_age: 等待其他线程刷新完成后，数据不超过此时间则不再刷新
+        """
+        with self.refresh_lock:
+            start = time.time()
+            if max_age is not None and start - self.synced <= max_age:
+                return
+            if self.since is None or start - self.full_synced > self.full_sync_interval:
+                self.full_sync()
+                return
+            changed = []
+            for vm in self._admin().list_servers(all_projects=True, changes_since=self.since):
+                if vm.status in ('DELETED', 'SOFT_DELETED'):
+                    changed.append((vm.id, None))
+                else:
+                    changed.append((vm.id, session.vm_info(vm, with_host=True)))
+            with self.lock:
+                for vm_id, info in changed:
+                    if info is None:
+                        self._remove(vm_id)
+                    else:
+                        self._put(vm_id, info)
+                self.since = self._marker(start)
+                self.synced = start
+                self.deltas += len(changed)
+            if changed:
+                log.debug('VM directory applied {} changes'.format(len(changed)))
+
+    def ensure_fresh(self, found=True):
+        age = time.time() - self.synced
+        if age > self.max_staleness or (not found and age > self.miss_refresh_interval):
+            self.misses += 1
+            self.refresh(self.miss_refresh_interval)
+        else:
+            self.hits += 1
+
+    def get_vms(self, project_id):
+        """获取项目中的VM信息，格式同 AdminSession.get_vms。"""
+        self.ensure_fresh(bool(self.projects.get(project_id)))
+        with self.lock:
+            return dict((vm_id, dict(self.vms[vm_id])) for vm_id in self.projects.get(project_id, ()))
+
+    def lookup_project_vms(self, project_id):
+        """只查询内存中项目的VM id 列表，不会阻塞。"""
+        with self.lock:
+            return list(self.projects.get(project_id, ()))
+
+    def all_vms(self):
+        self.ensure_fresh()
+        with self.lock:
+            return dict((vm_id, dict(self.vms[vm_id])) for vm_id in self.vms)
+
+    def get_vm(self, vm_id):
+        self.ensure_fresh(vm_id in self.vms)
+        info = self.vms.get(vm_id)
+        return dict(info) if info is not None else None
+
+    def get_vm_ip(self, vm_id):
+        return first_ip(self.get_vm(vm_id))
+
+    def lookup_vm(self, vm_id):
+        """只查询内存中的数据，不会阻塞，可在 reactor 线程中调用。"""
+        info = self.vms.get(vm_id)
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def poll_status(self, vm_ids):
+        """刷新后返回指定VM的状态，不存在的VM状态为 None。"""
+        self.refresh()
+        with self.lock:
+            return dict((vm_id, self.vms[vm_id][u'status'] if vm_id in self.vms else None)
+                        for vm_id in vm_ids)
+
+    def stats(self):
+        return {
+            'vms': len(self.vms),
+            'age': time.time() - self.synced if self.synced else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'full_syncs': self.full_syncs,
+            'deltas': self.deltas
+        }
+
+
+_directory = None
+
+
+def directory():
+    global _directory
+    if _directory is None: # 配置文件加载之后才能读取参数
+        _directory = VMDirectory(CONF.inventory.max_staleness,
+                                 CONF.inventory.full_sync_interval)
+    return _directory
+
+
+def ensure_fresh():
+    directory().ensure_fresh()
+
+
+def get_vms(project_id):
+    return directory().get_vms(project_id)
+
+
+def lookup_project_vms(project_id):
+    return directory().lookup_project_vms(project_id)
+
+
+def all_vms():
+    return directory().all_vms()
+
+
+def get_vm_ip(vm_id):
+    """查询VM的第一个浮动ip，不存在时返回 None。数据过旧时会请求 Nova。"""
+    return directory().get_vm_ip(vm_id)
+
+
+def lookup_vm(vm_id):
+    """从内存中查询VM信息，不存在时返回 None。返回的 dict 不要修改。"""
+    return directory().lookup_vm(vm_id)
+
+
+def poll_status(vm_ids):
+    return directory().poll_status(vm_ids)
+
+
+def stats():
+    return directory().stats()
+
+
+def refresh():
+    directory().refresh()
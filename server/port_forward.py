@@ -1,113 +1,281 @@
+import errno
 import logging
-import socket
+import multiprocessing
+import os
 import select
+import socket
 import threading
 import time
-import sys
+from collections import deque
 
 
 log = logging.getLogger(__name__)
 
-buffer_size = 4096
-delay = 0.005
+buffer_size = 65536
+# a channel stops reading once its peer has this many bytes queued
+max_queued = 1 << 20
 
-class Forward(object):
+_EAGAIN = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
 
-    def __init__(self):
-        self.forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+# not exported by the python 2 socket module
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
-    def start(self, host, port):
-        try:
-            self.forward.connect((host, port))
-            return self.forward
-        except Exception, e:
-            log.error(e)
-            return False
 
-def findFreePort():
+class Channel(object):
     """
-    get a random avalible port
+    one side of a forwarded connection, owned by an EventLoop
     """
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('localhost', 0))
-        addr, port = s.getsockname()
-        s.close()
-    except socket.error as msg:
-        log.error(msg)
-        s.close()
-    else:
-        return port
+    def __init__(self, loop, sock, owner, connected=True):
+        sock.setblocking(False)
+        self.loop = loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.owner = owner
+        self.peer = None
+        self.connected = connected
+        self.queue = deque()
+        self.queued = 0
+        self.reading = False
+        self.writing = False
+        self.closing = False
+        self.closed = False
+        self.eof = False
+
+    def update(self):
+        mask = 0
+        if self.reading:
+            mask |= select.EPOLLIN
+        if self.writing:
+            mask |= select.EPOLLOUT
+        self.loop.epoll.modify(self.fd, mask)
 
-class FServer(threading.Thread):
+    def on_event(self, events):
+        if events & select.EPOLLOUT:
+            self.on_writable()
+        if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR) and not self.closed:
+            self.on_readable()
+
+    def on_readable(self):
+        try:
+            n = self.sock.recv_into(self.loop.buffer)
+        except socket.error as e:
+            if e.errno in _EAGAIN:
+                return
+            n = 0
+        if n == 0:
+            # epoll is level-triggered: EOF stays readable until EPOLLIN is cleared
+            self.eof = True
+            self.reading = False
+            self.update()
+            if self.peer.connected:
+                self.peer.close_when_flushed()
+            else:
+                self.close()
+            return
+        self.peer.send(self.loop.view[:n])
+        if self.peer.queued > max_queued:
+            # backpressure: stop reading until the peer drains
+            self.reading = False
+            self.update()
+
+    def send(self, data):
+        """write data, queueing what the socket cannot take now"""
+        if not self.queue:
+            try:
+                sent = self.sock.send(data)
+            except socket.error as e:
+                if e.errno not in _EAGAIN:
+                    self.close()
+                    return
+                sent = 0
+            if sent == len(data):
+                return
+            data = data[sent:]
+        # the loop buffer is reused by the next recv_into, so copy
+        chunk = data.tobytes() if isinstance(data, memoryview) else data
+        self.queue.append(chunk)
+        self.queued += len(chunk)
+        if not self.writing:
+            self.writing = True
+            self.update()
+
+    def on_writable(self):
+        if not self.connected:
+            return self.owner.on_connected(self)
+        while self.queue:
+            chunk = self.queue[0]
+            try:
+                sent = self.sock.send(chunk)
+            except socket.error as e:
+                if e.errno in _EAGAIN:
+                    break
+                return self.close()
+            self.queued -= sent
+            if sent < len(chunk):
+                self.queue[0] = chunk[sent:]
+                break
+            self.queue.popleft()
+        if not self.queue:
+            self.writing = False
+            if self.closing:
+                return self.close()
+        if self.queued <= max_queued and not self.peer.reading and not self.peer.closed \
+                and not self.peer.closing and not self.peer.eof:
+            self.peer.reading = True
+            self.peer.update()
+        self.update()
+
+    def close_when_flushed(self):
+        if self.queue:
+            self.closing = True
+            self.reading = False
+            self.update()
+        else:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.unregister(self)
+        self.sock.close()
+        self.owner.channels.discard(self)
+        if not self.owner.channels:
+            self.owner.idle_since = time.time()
+        if self.peer is not None:
+            self.peer.close()
+
+
+class Listener(object):
     """
-    transport data from one port to another using multi-thread
+    accepts clients on a local port and pairs each with a new
+    non-blocking connection to the destination
     """
-    def __init__(self, host, port, dest, dport):
-        threading.Thread.__init__(self)
-        self.thread_stop = False
-        self.input_list = []
-        self.channel = {}
-        self.forward_addr = []
+    def __init__(self, loop, host, port, dest, dport, reuse_port=False):
+        self.loop = loop
+        self.forward_addr = (dest, dport)
+        self.channels = set()
+        self.idle_since = time.time() # when the last connection closed, None while in use
+        self.refusing = False # close new clients at once, set when over a connection limit
+        self.refused = 0
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # let several worker processes share the port, the kernel
+            # spreads incoming connections between them
+            self.server.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         self.server.bind((host, port))
         self.server.listen(300)
-        self.forward_addr.append(dest)
-        self.forward_addr.append(dport)
+        self.server.setblocking(False)
+        self.fd = self.server.fileno()
+        self.port = self.server.getsockname()[1]
 
-    def run(self):
-        self.input_list.append(self.server)
-        ss = select.select
-        while not self.thread_stop:
-            time.sleep(delay)
-            inputready, __, __ = ss(self.input_list, [], [], delay)
-            for self.s in inputready:
-                if self.s == self.server:
-                    self.on_accept()
-                    break
-                try:
-                    self.data = self.s.recv(buffer_size)
-                except socket.error, ex:
-                    print "This is the exception", ex
-                if len(self.data) == 0:
-                    self.on_close()
-                    break
-                else:
-                    self.on_recv(self.s, self.data)
+    def start(self):
+        self.loop.register(self, select.EPOLLIN)
 
-    def on_accept(self):
-        forward = Forward().start(self.forward_addr[0], self.forward_addr[1])
-        clientsock, clientaddr = self.server.accept()
-        if forward:
+    def on_event(self, events):
+        while True:
+            try:
+                clientsock, clientaddr = self.server.accept()
+            except socket.error as e:
+                if e.errno not in _EAGAIN:
+                    log.error(e)
+                return
+            if self.refusing:
+                log.debug("Refusing {}, connection limit reached".format(clientaddr))
+                clientsock.close()
+                self.refused += 1
+                continue
+            forward = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            forward.setblocking(False)
+            err = forward.connect_ex(self.forward_addr)
+            if err not in (0, errno.EINPROGRESS):
+                log.warning("Cannot establish connection with remote server.")
+                log.warning("Closing connection with client side: {}".format(clientaddr))
+                forward.close()
+                clientsock.close()
+                continue
             log.debug("{} has connected".format(clientaddr))
-            self.input_list.append(clientsock)
-            self.input_list.append(forward)
-            self.channel[clientsock] = forward
-            self.channel[forward] = clientsock
-            #for k in self.channel:
-            #    print self.channel[k]
-        else:
-            log.warning("Cannot establish connection with remote server.")
-            log.warning("Closing connection with client side: {}".format(clientaddr))
-            clientsock.close()
-
-    def on_close(self):
-        #print "has disconnected"
-        self.input_list.remove(self.s)
-        self.input_list.remove(self.channel[self.s])
-        out = self.channel[self.s]
-        self.s.close()
-        self.channel[self.s].close()
-        del self.channel[out]
-        del self.channel[self.s]
-        self.stop()
-
-    def on_recv(self, orisock, data):
-        self.channel[orisock].send(data)
+            client = Channel(self.loop, clientsock, self)
+            upstream = Channel(self.loop, forward, self, connected=False)
+            client.peer, upstream.peer = upstream, client
+            self.channels.update((client, upstream))
+            self.idle_since = None
+            # don't read from the client until the destination accepts
+            self.loop.register(client, 0)
+            self.loop.register(upstream, select.EPOLLOUT)
+
+    def on_connected(self, upstream):
+        err = upstream.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            log.warning("Cannot establish connection with remote server: {}".format(os.strerror(err)))
+            upstream.close()
+            return
+        upstream.connected = True
+        client = upstream.peer
+        client.reading = upstream.reading = True
+        client.update()
+        upstream.update()
+
+    def connections(self):
+        """number of forwarded connections, each has two channels"""
+        return len(self.channels) // 2
+
+    def close(self):
+        self.loop.unregister(self)
+        self.server.close()
+        for channel in list(self.channels):
+            channel.close()
+
+
+class EventLoop(threading.Thread):
+    """
+    one epoll loop serving many listeners and channels; all socket work
+    happens on this thread, other threads go through call()
+    """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.epoll = select.epoll()
+        self.handlers = {}
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.commands = deque()
+        self.wake_r, self.wake_w = os.pipe()
+        self.epoll.register(self.wake_r, select.EPOLLIN)
+        self.thread_stop = False
+
+    def register(self, handler, mask):
+        self.handlers[handler.fd] = handler
+        self.epoll.register(handler.fd, mask)
+
+    def unregister(self, handler):
+        if self.handlers.pop(handler.fd, None) is not None:
+            self.epoll.unregister(handler.fd)
+
+    def call(self, fn, *args):
+        self.commands.append((fn, args))
+        os.write(self.wake_w, 'x')
+
+    def run(self):
+        while not self.thread_stop:
+            for fd, events in self.epoll.poll():
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    while self.commands:
+                        fn, args = self.commands.popleft()
+                        fn(*args)
+                    continue
+                handler = self.handlers.get(fd)
+                if handler is not None:
+                    handler.on_event(events)
+        for handler in list(self.handlers.values()):
+            handler.close()
+        self.epoll.close()
 
     def stop(self):
-        self.thread_stop = True
+        self.call(setattr, self, 'thread_stop', True)
+
 
 class Singleton(object):
     def __new__(cls, *args, **kwargs):
@@ -117,14 +285,29 @@ class Singleton(object):
 
 class ServerProxy(Singleton):
     """
-    proxy class to generate port to port communication
+    proxy class to generate port to port communication, served by one
+    event loop per core
     """
     server_list = {}
+    loops = []
+    next_loop = 0
+
+    def _loop(self):
+        if not self.loops:
+            for _ in range(multiprocessing.cpu_count()):
+                loop = EventLoop()
+                loop.start()
+                self.loops.append(loop)
+        loop = self.loops[ServerProxy.next_loop % len(self.loops)]
+        ServerProxy.next_loop += 1
+        return loop
+
     def add_proxy(self, dest_ip, dest_port, localaddr=''):
-        port = findFreePort()
-        server = FServer(localaddr, port, dest_ip, dest_port)
+        loop = self._loop()
+        server = Listener(loop, localaddr, 0, dest_ip, dest_port)
+        port = server.port
         self.server_list[port] = server
-        server.start()
+        loop.call(server.start)
         log.debug('proxy to {}:{} from {}:{}'.format(dest_ip, dest_port, localaddr, port))
         log.debug('connection count: {}'.format(len(self.server_list)))
         return port
@@ -132,8 +315,8 @@ class ServerProxy(Singleton):
     def delete_proxy(self, port):
         if port not in self.server_list:
             return
-        self.server_list[port].stop()
-        del self.server_list[port]
+        server = self.server_list.pop(port)
+        server.loop.call(server.close)
         log.debug('proxy on {} removed'.format(port))
         log.debug('connection count: {}'.format(len(self.server_list)))
 
@@ -1,14 +1,90 @@
+import time
+
+from splicefwd import SplicePair
+import telemetry
 from twisted.internet import protocol
+from twisted.internet.interfaces import IPushProducer
 from twisted.python import log
+from zope.interface import implementer
+
+
+@implementer(IPushProducer)
+class MeteredProducer(object):
+    """Wraps a transport registered as a producer and records how long
+    it was paused by the consumer (backpressure) in a telemetry.Flow.
+
+    The transport can also be throttled by a rate limiter; it only
+    reads while it is neither congested nor throttled.
+    """
+
+    reactor = None
+    frozen = False
+
+    def __init__(self, producer, flow):
+        self.producer = producer
+        self.flow = flow
+        self.congested = False
+        self.throttled = None # pending DelayedCall while rate limited
+
+    def pauseProducing(self):
+        self.flow.pause()
+        self.congested = True
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.flow.resume()
+        self.congested = False
+        if self.throttled is None and not self.frozen:
+            self.producer.resumeProducing()
+
+    def freeze(self):
+        """Stop reading until thaw(), whatever the consumer or the rate
+        limiter ask for in between."""
+        self.frozen = True
+        self.producer.pauseProducing()
+
+    def thaw(self):
+        self.frozen = False
+        if not self.congested and self.throttled is None:
+            self.producer.resumeProducing()
+
+    def stopProducing(self):
+        if self.throttled is not None:
+            self.throttled.cancel()
+            self.throttled = None
+        self.producer.stopProducing()
+
+    def throttle(self, delay):
+        if self.throttled is not None:
+            return
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.producer.pauseProducing()
+        self.throttled = self.reactor.callLater(delay, self.unthrottle)
+
+    def unthrottle(self):
+        self.throttled = None
+        if not self.congested and not self.frozen:
+            self.producer.resumeProducing()
+
 
 class Proxy(protocol.Protocol):
     noisy = True
 
     peer = None
+    splice = None
+    flow = None # telemetry.Flow for data received on this side
+    shaper = None # qos.Shaper shared by the user's connections
+    bucket = None
+    producer = None
 
     def setPeer(self, peer):
         self.peer = peer
 
+    def wantsSplice(self):
+        return False
+
     def connectionLost(self, reason):
         if self.peer is not None:
             self.peer.transport.loseConnection()
@@ -17,18 +93,83 @@ class Proxy(protocol.Protocol):
             log.msg("Unable to connect to peer: %s" % (reason,))
 
     def dataReceived(self, data):
+        flow = self.flow
+        flow.bytes += len(data)
+        flow.chunks += 1
         self.peer.transport.write(data)
+        if self.bucket is not None:
+            delay = self.bucket.consume(len(data))
+            if delay:
+                self.producer.throttle(delay)
+
+class _Backlog(object):
+    """Stands in for the client while a pre-dialed connection waits,
+    recording whether the destination sent anything unprompted."""
+
+    def __init__(self):
+        self.transport = self
+        self.received = 0
+
+    def write(self, data):
+        self.received += len(data)
 
 class ProxyClient(Proxy):
+    warm = False # pre-dialed, waiting in the factory for a client
+
     def connectionMade(self):
+        if self.peer is None:
+            # Dialed before any client connected. Keep reading so that
+            # the factory learns when the destination goes away.
+            self.warm = True
+            self.peer = _Backlog()
+            self.flow = telemetry.Flow()
+            self.factory.proxy.warmed(self)
+            return
+        self.start()
+
+    def attach(self, server):
+        """Start forwarding for a client using this pre-dialed connection."""
+        self.warm = False
+        self.setPeer(server)
+        self.start()
+
+    def connectionLost(self, reason):
+        if self.warm:
+            self.factory.proxy.warmLost(self)
+            return
+        Proxy.connectionLost(self, reason)
+
+    def start(self):
         self.peer.setPeer(self)
+        stats = self.peer.stats
+        stats.connected()
+        self.flow = stats.down
+
+        if self.peer.wantsSplice():
+            # Hand both sockets over to the kernel-side forwarder; it
+            # does its own flow control by not reading from a side
+            # whose peer cannot take more data.
+            self.splice = self.peer.splice = SplicePair(self.peer.transport, self.transport)
+            self.splice.start()
+            return
 
         # Wire this and the peer transport together to enable
         # flow control (this stops connections from filling
         # this proxy memory when one side produces data at a
         # higher rate than the other can consume).
-        self.transport.registerProducer(self.peer.transport, True)
-        self.peer.transport.registerProducer(self.transport, True)
+        self.peer.producer = MeteredProducer(self.peer.transport, stats.up)
+        self.producer = MeteredProducer(self.transport, stats.down)
+        self.transport.registerProducer(self.peer.producer, True)
+        self.peer.transport.registerProducer(self.producer, True)
+
+        shaper = self.peer.shaper
+        if shaper is not None:
+            self.peer.bucket, self.bucket = shaper.up, shaper.down
+
+        # Interactive input and screen updates are small writes, don't
+        # hold them back waiting for ACKs.
+        self.transport.setTcpNoDelay(True)
+        self.peer.transport.setTcpNoDelay(True)
 
         # We're connected, everybody can read to their hearts content.
         self.peer.transport.resumeProducing()
@@ -49,16 +190,51 @@ class ProxyClientFactory(protocol.ClientFactory):
         self.server.transport.loseConnection()
 
 
+class PredialFactory(ProxyClientFactory):
+    """Dials the destination of a ProxyFactory before a client connects."""
+
+    server = None
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def clientConnectionFailed(self, connector, reason):
+        self.proxy.predialFailed(reason)
+
+
 class ProxyServer(Proxy):
 
     clientProtocolFactory = ProxyClientFactory
     reactor = None
+    stats = None
+    conn = None
+    # adopted from a previous process with the upstream connection
+    # already established, see handover
+    resumed = False
+
+    def openStats(self, user, vm_id):
+        self.stats = self.factory.telemetry.open(user, vm_id)
+        self.flow = self.stats.up
 
     def connectionMade(self):
+        limiter = self.factory.limiter
+        if limiter is not None and not limiter.acquire(self.factory.user):
+            log.msg("Connection limit reached for %s" % (self.factory.user,))
+            self.noisy = False
+            self.transport.loseConnection()
+            return
+        self.openStats(self.factory.user, self.factory.vm_id)
+        self.shaper = self.factory.shaper
         # Don't read anything from the connecting client until we have
         # somewhere to send it to.
         self.transport.pauseProducing()
-        self.factory.proxy.append(self)
+        self.factory.opened(self)
+        if self.resumed:
+            return
+        warm = self.factory.takeWarm()
+        if warm is not None:
+            warm.attach(self)
+            return
 
         client = self.clientProtocolFactory()
         client.setServer(self)
@@ -68,18 +244,112 @@ class ProxyServer(Proxy):
             self.reactor = reactor
         self.conn = self.reactor.connectTCP(self.factory.host, self.factory.port, client)
 
+    def wantsSplice(self):
+        # rate limited connections stay on the twisted data path
+        return self.factory.engine == 'splice' and self.shaper is None
+
+    def connectionLost(self, reason):
+        if self.stats is not None:
+            if self.splice is not None:
+                self.stats.up.bytes, self.stats.down.bytes = self.splice.stats()
+            self.factory.telemetry.close(self.stats)
+            self.factory.closed(self)
+        Proxy.connectionLost(self, reason)
+
 
 class ProxyFactory(protocol.Factory):
     """Factory for port forwarder."""
 
     protocol = ProxyServer
+    telemetry = telemetry.registry
+    limiter = None # shared ConnectionLimiter, see twist_forward
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, engine='twisted', user=None, vm_id=None, shaper=None):
         self.host = host
         self.port = port
-        self.proxy = [] # ProxyFactory <-> ProxyServer 1 to 1 mapping
+        self.engine = engine # 'twisted' or 'splice'
+        self.user = user # labels for telemetry
+        self.vm_id = vm_id
+        self.shaper = shaper # qos.Shaper, None for no rate limit
+        self.proxy = set() # open ProxyServer connections
+        self.idle_since = time.time()
+        self.warm = None # pre-dialed ProxyClient
+        self.warm_expiry = None
+        self.dialing = None
+        self.predials = 0
+        self.predial_hits = 0
+        self.reactor = None
+
+    def predial(self, timeout):
+        """Connect to the destination now; the first client connection
+        takes over this connection, it is closed unused after timeout."""
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.predial_timeout = timeout
+        self.predials += 1
+        self.dialing = self.reactor.connectTCP(self.host, self.port, PredialFactory(self),
+                                               timeout=timeout)
+
+    def warmed(self, client):
+        self.dialing = None
+        self.warm = client
+        self.warm_expiry = self.reactor.callLater(self.predial_timeout, self.expireWarm)
+
+    def predialFailed(self, reason):
+        self.dialing = None
+        log.msg("Pre-dial to %s:%s failed: %s" % (self.host, self.port, reason.getErrorMessage()))
+
+    def takeWarm(self):
+        client = self.warm
+        if client is None:
+            return None
+        if client.peer.received:
+            # an RDP server doesn't speak first, don't trust this one
+            self.warm_expiry.cancel()
+            self.expireWarm()
+            return None
+        self.warm = None
+        self.warm_expiry.cancel()
+        self.predial_hits += 1
+        return client
+
+    def warmLost(self, client):
+        if self.warm is client:
+            self.warm = None
+            self.warm_expiry.cancel()
+
+    def expireWarm(self):
+        client, self.warm = self.warm, None
+        client.transport.loseConnection()
+
+    def opened(self, server):
+        self.proxy.add(server)
+        self.idle_since = None
+
+    def closed(self, server):
+        if server in self.proxy:
+            self.proxy.discard(server)
+            if self.limiter is not None:
+                self.limiter.release(self.user)
+            if not self.proxy:
+                self.idle_since = time.time()
+
+    def idleTime(self, now):
+        """Seconds since the last connection closed, 0 while in use."""
+        if self.idle_since is None:
+            return 0
+        return now - self.idle_since
 
     def stop(self):
-        for item in self.proxy:
-            item.conn.disconnect()
+        if self.dialing is not None:
+            self.dialing.disconnect()
+        if self.warm is not None:
+            self.warm_expiry.cancel()
+            self.expireWarm()
+        for item in list(self.proxy):
+            if item.splice is not None:
+                item.splice.close()
+            if item.conn is not None:
+                item.conn.disconnect()
             item.transport.loseConnection()
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from oslo_config import cfg
+
+
+log = logging.getLogger(__name__)
+
+# 交互份额的上限，批量数据至少保留十分之一的限速，速率为 0 的令牌桶无法计算等待时间
+MAX_SHARE = 0.9
+
+opt_qos_group = cfg.OptGroup(name='qos',
+                            title='RDP forwarding bandwidth limits')
+qos_opts = [
+    cfg.DictOpt('policy_rates', default={},
+                help=('Bandwidth limit per user in KiB/s for each connection '
+                      'policy, e.g. 1:2048 limits sessions with drive '
+                      'redirection, unlisted policies are not limited')),
+    cfg.DictOpt('user_rates', default={},
+                help=('Bandwidth limit in KiB/s for individual users, '
+                      'overrides policy_rates, 0 disables the limit')),
+    cfg.FloatOpt('burst', default=2.0,
+                 help=('Seconds of traffic at the limited rate that may be '
+                       'sent at once, keeps interactive bursts unthrottled')),
+    cfg.IntOpt('interactive_size', default=1024,
+               help=('Reads of at most this many bytes count as interactive '
+                     'traffic (input, small screen updates) and are limited '
+                     'separately from bulk transfers')),
+    cfg.FloatOpt('interactive_share', default=0.2, min=0.0, max=MAX_SHARE,
+                 help=('Share of a user\'s limit reserved for interactive '
+                       'traffic, 0 puts all traffic in one class')),
+]
+
+CONF = cfg.CONF
+CONF.register_group(opt_qos_group)
+CONF.register_opts(qos_opts, opt_qos_group)
+
+
+class TokenBucket(object):
+    """令牌桶，rate 为每秒字节数，最多积累 burst 字节。
+
+    consume 允许透支，返回还清欠额需要等待的秒数，
+    调用方在这段时间内停止读取。
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+        self.throttled = 0 # 需要等待的次数
+
+    def consume(self, n):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - n
+        self.updated = now
+        if self.tokens >= 0:
+            return 0
+        self.throttled += 1
+        return -self.tokens / self.rate
+
+
+class ClassedBucket(object):
+    """一个方向的限速，分为交互和批量两类，各有一个令牌桶。
+
+    不超过 small 字节的读取算作交互数据（键盘鼠标输入、少量屏幕更新），
+    使用预留的 share 份额，不会因为批量数据（驱动器重定向、文件复制）的欠额而等待。
+    同一条连接上批量数据造成的暂停仍会推迟其后的交互数据，
+    RDP 的虚拟通道在同一个加密连接中，转发层无法区分。
+    """
+
+    def __init__(self, rate, burst, share, small, clock=time.time):
+        self.rate = float(rate)
+        self.small = small if share > 0 else -1
+        share = min(max(share, 0.0), MAX_SHARE)
+        bulk = rate * (1 - share)
+        self.bulk = TokenBucket(bulk, bulk * burst, clock)
+        self.interactive = None
+        if share > 0:
+            self.interactive = TokenBucket(rate * share, rate * share * burst, clock)
+
+    def consume(self, n):
+        if n <= self.small:
+            return self.interactive.consume(n)
+        return self.bulk.consume(n)
+
+    @property
+    def throttled(self):
+        return self.bulk.throttled + (self.interactive.throttled if self.interactive else 0)
+
+
+class Shaper(object):
+    """一个用户在一个策略下的限速，同一用户的所有连接共用。"""
+
+    def __init__(self, rate, burst, key=None, share=0.0, small=0, clock=time.time):
+        self.key = key # (user, policy)
+        self.up = ClassedBucket(rate, burst, share, small, clock)   # 客户端到VM
+        self.down = ClassedBucket(rate, burst, share, small, clock) # VM到客户端
+
+    def stats(self):
+        return {
+            'rate': self.up.rate,
+            'throttled_up': self.up.throttled,
+            'throttled_down': self.down.throttled
+        }
+
+
+_shapers = {} # (user, policy) -> Shaper
+
+
+def _rate(user, policy):
+    """返回限速 (字节/秒)，不限速时返回 None。"""
+    rates = CONF.qos.user_rates
+    rate = rates.get(user)
+    if rate is None:
+        rate = CONF.qos.policy_rates.get(str(policy))
+    if not rate or float(rate) <= 0:
+        return None
+    return float(rate) * 1024
+
+
+def shaper(user, policy):
+    """返回用户在该策略下的 Shaper，不限速时返回 None。"""
+    rate = _rate(user, policy)
+    if rate is None:
+        return None
+    key = (user, policy)
+    item = _shapers.get(key)
+    if item is None or item.up.rate != rate:
+        item = _shapers[key] = Shaper(rate, CONF.qos.burst, key,
+                                      CONF.qos.interactive_share, CONF.qos.interactive_size)
+        log.debug('user {} policy {} limited to {} B/s'.format(user, policy, rate))
+    return item
+
+
+def stats():
+    return dict(('{}/{}'.format(user, policy), item.stats())
+                for (user, policy), item in _shapers.items())
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import binascii
+import logging
+import os
+import struct
+import time
+
+from . import telemetry
+from .portforward import Proxy, ProxyClient, ProxyClientFactory
+from twisted.internet import protocol, task
+
+
+log = logging.getLogger(__name__)
+
+# X.224 Connection Request 固定部分: LI, CR, DST-REF, SRC-REF, CLASS
+_X224_FIXED_LEN = 7
+_TPKT_HEADER_LEN = 4
+_COOKIE_PREFIX = 'Cookie: '
+_TOKEN_PREFIXES = ('msts=', 'mstshash=')
+
+
+def parse_connection_request(data):
+    """解析客户端发送的第一个 TPKT 包 (X.224 Connection Request)。
+
+    数据不完整时返回 None，格式错误时抛出 ValueError。
+    返回 (token, pdu, rest)：token 为路由令牌，没有时为 None；
+    pdu 为去掉路由令牌行后的请求包；rest 为包之后已收到的数据。
+    """
+    if len(data) < _TPKT_HEADER_LEN:
+        return None
+    version, _, length = struct.unpack('!BBH', data[:_TPKT_HEADER_LEN])
+    if version != 3 or length < _TPKT_HEADER_LEN + _X224_FIXED_LEN:
+        raise ValueError('Not a TPKT packet')
+    if len(data) < length:
+        return None
+    pdu, rest = data[:length], data[length:]
+    li, code = struct.unpack('!BB', pdu[_TPKT_HEADER_LEN:_TPKT_HEADER_LEN + 2])
+    if code & 0xf0 != 0xe0 or li + 1 != length - _TPKT_HEADER_LEN:
+        raise ValueError('Not an X.224 Connection Request')
+
+    start = _TPKT_HEADER_LEN + _X224_FIXED_LEN
+    end = pdu.find('\r\n', start)
+    if end < 0 or pdu[start] == '\x01': # 没有路由令牌，直接是 rdpNegReq
+        return None, pdu, rest
+    line = pdu[start:end]
+    if line.startswith(_COOKIE_PREFIX):
+        line = line[len(_COOKIE_PREFIX):]
+    for prefix in _TOKEN_PREFIXES:
+        if line.startswith(prefix):
+            line = line[len(prefix):]
+            break
+
+    # 去掉路由令牌行，修正 TPKT 长度和 X.224 LI
+    body = pdu[_TPKT_HEADER_LEN + 1:start] + pdu[end + 2:]
+    length = _TPKT_HEADER_LEN + 1 + len(body)
+    pdu = struct.pack('!BBHB', 3, 0, length, len(body)) + body
+    return line, pdu, rest
+
+
+class GatewayClient(ProxyClient):
+    def connectionMade(self):
+        # 先发送缓存的 Connection Request，再开始双向转发
+        self.transport.write(self.peer.pending)
+        self.peer.pending = ''
+        ProxyClient.connectionMade(self)
+
+
+class GatewayClientFactory(ProxyClientFactory):
+    protocol = GatewayClient
+
+
+class GatewayServer(Proxy):
+    """从 Connection Request 中读取路由令牌，连接到对应的VM。"""
+
+    clientProtocolFactory = GatewayClientFactory
+    reactor = None
+    stats = None
+    resumed = None # 从旧进程接管的已连接会话的路由令牌
+    noisy = False # 开始连接VM之后才记录连接失败，拒绝的连接不记录
+
+    # 收到完整 Connection Request 之前的缓存上限和等待时间
+    max_request_size = 4096
+    request_timeout = 10
+
+    def connectionMade(self):
+        if self.reactor is None:
+            from twisted.internet import reactor
+            self.reactor = reactor
+        self.pending = ''
+        self.token = None
+        self.conn = None
+        self.timeout = self.reactor.callLater(self.request_timeout, self.transport.loseConnection)
+        if self.resumed is not None:
+            self.timeout.cancel()
+            if self.admit(self.resumed):
+                self.transport.pauseProducing()
+
+    def dataReceived(self, data):
+        if self.token is not None:
+            return Proxy.dataReceived(self, data)
+
+        self.pending += data
+        try:
+            parsed = parse_connection_request(self.pending)
+        except ValueError as e:
+            log.warning('Bad RDP connection request from {}: {}'.format(self.transport.getPeer(), e))
+            self.transport.loseConnection()
+            return
+        if parsed is None:
+            if len(self.pending) > self.max_request_size:
+                self.transport.loseConnection()
+            return
+
+        token, pdu, rest = parsed
+        target = self.factory.routes.get(token)
+        if target is None:
+            log.warning('Unknown RDP routing token from {}'.format(self.transport.getPeer()))
+            self.transport.loseConnection()
+            return
+
+        self.timeout.cancel()
+        if not self.admit(token):
+            return
+        self.pending = pdu + rest
+
+        # 连接到VM之前不再读取客户端数据
+        self.transport.pauseProducing()
+        self.noisy = True
+        client = self.clientProtocolFactory()
+        client.setServer(self)
+        self.conn = self.reactor.connectTCP(target[0], target[1], client)
+
+    def admit(self, token):
+        """检查连接数限制，登记连接，返回是否允许。"""
+        user, vm_id = self.factory.owners.get(token, (None, None))
+        limiter = self.factory.limiter
+        if limiter is not None and not limiter.acquire(user):
+            log.warning('Connection limit reached for {}'.format(user))
+            self.transport.loseConnection()
+            return False
+        self.token = token
+        self.factory.register(token, self)
+        self.stats = self.factory.telemetry.open(user, vm_id)
+        self.flow = self.stats.up
+        self.shaper = self.factory.shapers.get(token)
+        return True
+
+    def connectionLost(self, reason):
+        if self.timeout.active():
+            self.timeout.cancel()
+        if self.token is not None:
+            self.factory.unregister(self.token, self)
+        if self.stats is not None:
+            self.factory.telemetry.close(self.stats)
+            if self.factory.limiter is not None:
+                self.factory.limiter.release(self.stats.user)
+        Proxy.connectionLost(self, reason)
+
+
+class GatewayFactory(protocol.Factory):
+    """单端口 RDP 网关。
+
+    客户端在 RDP 文件的 loadbalanceinfo 中填写令牌，
+    网关据此把连接转发到对应的VM。
+    没有连接的时间超过 idle_timeout 的路由会被删除，与代理端口的空闲回收相同。
+    """
+
+    protocol = GatewayServer
+    telemetry = telemetry.registry
+    limiter = None # 与 ForwardInst 共用的 ConnectionLimiter
+
+    def __init__(self):
+        self.routes = {} # token -> (host, port)
+        self.owners = {} # token -> (user, vm_id)，用于统计
+        self.shapers = {} # token -> qos.Shaper
+        self.proxy = {}  # token -> set(GatewayServer)
+        self.idle_since = {} # token -> 最后一个连接关闭或路由添加的时间，有连接时不在其中
+        self.idle_timeout = 0
+        self.reaper = task.LoopingCall(self.reapIdle)
+        self.reaped = 0
+        self.onReap = None # 回调 onReap(token)，通知路由因空闲被删除
+
+    def start(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        if idle_timeout > 0 and not self.reaper.running:
+            self.reaper.start(min(60, idle_timeout), now=False)
+
+    def stop(self):
+        if self.reaper.running:
+            self.reaper.stop()
+
+    def reapIdle(self, now=None):
+        """删除空闲超时的路由。"""
+        now = time.time() if now is None else now
+        for token, since in self.idle_since.items():
+            if now - since > self.idle_timeout:
+                log.info('Removing idle gateway route {}'.format(token))
+                self.remove_route(token)
+                self.reaped += 1
+                if self.onReap is not None:
+                    self.onReap(token)
+
+    def add_route(self, host, port, user=None, vm_id=None, shaper=None, token=None):
+        """添加路由，返回令牌。接管旧进程的路由时沿用原令牌。"""
+        if token is None:
+            token = binascii.hexlify(os.urandom(16))
+        self.routes[token] = (host, port)
+        self.owners[token] = (user, vm_id)
+        if shaper is not None:
+            self.shapers[token] = shaper
+        if token not in self.proxy:
+            self.idle_since[token] = time.time()
+        log.debug('gateway route {} -> {}:{}'.format(token, host, port))
+        return token
+
+    def remove_route(self, token):
+        self.routes.pop(token, None)
+        self.owners.pop(token, None)
+        self.shapers.pop(token, None)
+        self.idle_since.pop(token, None)
+        for item in self.proxy.pop(token, ()):
+            if item.conn is not None:
+                item.conn.disconnect()
+            item.transport.loseConnection()
+        log.debug('gateway route {} removed'.format(token))
+
+    def register(self, token, server):
+        self.proxy.setdefault(token, set()).add(server)
+        self.idle_since.pop(token, None)
+
+    def unregister(self, token, server):
+        servers = self.proxy.get(token)
+        if servers is not None:
+            servers.discard(server)
+            if not servers:
+                del self.proxy[token]
+                if token in self.routes:
+                    self.idle_since[token] = time.time()
+
+    def stats(self):
+        return {
+            'routes': len(self.routes),
+            'reaped': self.reaped,
+            'connections': sum(len(s) for s in self.proxy.values())
+        }
@@ -1,13 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
-import traceback
 
 from . import backend, session
 
 
 log = logging.getLogger(__name__)
 
+
+def respond(request, code, body):
+    """回复推迟处理的请求。"""
+    request.setResponseCode(code)
+    request.write(json.dumps(body))
+    request.finish()
+
+
 class Handler(object):
     def __init__(self):
         self.handlers = {}
@@ -16,10 +24,16 @@ class Handler(object):
             "logout":   self.logout,
             "conn":     self.connect_vm,
             "disconn":  self.disconnect_vm,
-            "heartbeat":self.heartbeat
+            "heartbeat":self.heartbeat,
+            "bulk_start": self.bulk_start,
+            "bulk_stop": self.bulk_stop
         }
         self.handlers['GET'] = {
-            "vdstatus": self.user_status
+            "vdstatus": self.user_status,
+            "vms":      self.all_vms,
+            "stats":    self.stats,
+            "traffic":  self.traffic,
+            "ws_clients": self.ws_clients
         }
 
     def handle(self, request, action, msgObj):
@@ -35,22 +49,28 @@ class Handler(object):
 
     def login(self, msgObj, request):
         log.debug('in login handler')
-        try:
-            # 请求keystone获得身份认证结果
-            # 认证通过请求vm信息
-            # TODO: 得到vm获取本地策略
-            # 返回认证结果+vm信息+本地策略
-            # 本地sessions更新接收heartBeat
-            res = backend.login(msgObj[u'username'], msgObj[u'password'])
-            backend.init_user(res[u'token'], msgObj[u'client_ip'])
-            return 200, res
-        except session.AuthenticationFailure:
-            return 401, {'err': 'invalid username or password'}
-        except Exception as e:
-            log.error(e)
+        # 请求keystone获得身份认证结果
+        # 认证通过请求vm信息
+        # TODO: 得到vm获取本地策略
+        # 返回认证结果+vm信息+本地策略
+        # 本地sessions更新接收heartBeat
+        d = backend.login(msgObj[u'username'], msgObj[u'password'])
+        d.addCallback(self._login_cb, msgObj, request)
+        d.addErrback(self._login_err, request)
+        return -1, None # 推迟到认证完成后回复
+
+    def _login_cb(self, res, msgObj, request):
+        backend.init_user(res[u'token'], msgObj[u'client_ip'])
+        respond(request, 200, res)
+
+    def _login_err(self, failure, request):
+        if failure.check(session.AuthenticationFailure):
+            respond(request, 401, {'err': 'invalid username or password'})
+        else:
+            log.error(failure.getErrorMessage())
             log.error('unidentified error occurred in login handler')
-            traceback.print_exc()
-            return 500, {'err':'sth wrong when handle you msg'}
+            failure.printTraceback()
+            respond(request, 500, {'err':'sth wrong when handle you msg'})
 
     # 未使用
     def logout(self, msgObj, request):
@@ -65,6 +85,26 @@ class Handler(object):
         except session.VMError as e:
             return 500, {'err': str(e)}
 
+    def bulk_start(self, msgObj, request):
+        log.debug('in bulk_start handler')
+        return self._bulk_power(msgObj, 'start')
+
+    def bulk_stop(self, msgObj, request):
+        log.debug('in bulk_stop handler')
+        return self._bulk_power(msgObj, 'stop')
+
+    def _bulk_power(self, msgObj, op):
+        # 立即返回任务 id，各VM的结果通过 WebSocket 推送
+        try:
+            res = backend.bulk_power(msgObj[u'token'], op,
+                                     vm_ids=msgObj.get(u'vm_ids'),
+                                     project=msgObj.get(u'project'))
+            return 202, res
+        except ValueError as e:
+            return 400, {'err': str(e)}
+        except session.PermissionDenied as e:
+            return 403, {'err': str(e)}
+
     def disconnect_vm(self, msgObj, request):
         log.debug("in disconnect_vm handler")
         res = backend.disconnect(msgObj[u'token'], msgObj[u'vm_id'])
@@ -81,3 +121,15 @@ class Handler(object):
 
     def user_status(self, msg, request):
         return 200, backend.user_status()
+
+    def all_vms(self, msg, request):
+        return 200, backend.all_vms()
+
+    def stats(self, msg, request):
+        return 200, backend.stats()
+
+    def traffic(self, msg, request):
+        return 200, backend.traffic()
+
+    def ws_clients(self, msg, request):
+        return 200, backend.ws_clients()
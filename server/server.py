@@ -3,7 +3,7 @@
 import json
 import logging
 
-from . import backend, httpserver, logconf, wsserver
+from . import backend, handover, httpserver, logconf, wsserver
 
 from oslo_config import cfg
 from twisted.internet import reactor
@@ -22,6 +22,16 @@ server_opts = [
                help=('Host IP')),
     cfg.IntOpt('port', default=8893,
                help=('Host Port')),
+    cfg.IntOpt('ws_history', default=1024,
+               help=('Number of recent WebSocket messages kept for clients '
+                     'resuming after a reconnect')),
+    cfg.IntOpt('ws_max_queued', default=1048576,
+               help=('Bytes that may be written to a WebSocket client while its '
+                     'send buffer is full before it is treated as a slow consumer')),
+    cfg.StrOpt('ws_slow_policy', default='resync', choices=['resync', 'disconnect'],
+               help=('What to do with a slow WebSocket client: resync drops '
+                     'messages until its buffer drains and then sends a '
+                     'snapshot, disconnect closes the connection')),
 ]
 
 CONF = cfg.CONF
@@ -35,12 +45,16 @@ class Server(object):
         host, port = CONF.server.host, CONF.server.port
 
         try:
-            factory = wsserver.BroadcastPreparedServerFactory(u"ws://127.0.0.1:{}".format(port))
+            factory = wsserver.BroadcastPreparedServerFactory(u"ws://127.0.0.1:{}".format(port),
+                                                              CONF.server.ws_history,
+                                                              CONF.server.ws_max_queued,
+                                                              CONF.server.ws_slow_policy)
             factory.protocol = wsserver.WSServerProtocol
             wsresource = WebSocketResource(factory)
 
             backend.init_ws(factory)
             backend.start_heartbeat_monitor()
+            backend.start_cache_refresh()
 
             root = Resource()
             root.putChild('ws', wsresource)
@@ -48,9 +62,7 @@ class Server(object):
             site = Site(root)
 
             reactor.suggestThreadPoolSize(30)
-            reactor.listenTCP(port, site)
-
-            log.debug("Serving HTTP/WS at port {}".format(port))
+            reactor.callWhenRunning(self.listen, site, port)
             reactor.run()
         except KeyboardInterrupt:
             log.info("Terminating...")
@@ -59,4 +71,32 @@ class Server(object):
             log.error("Failed to start server")
             raise
         finally:
+            backend.stop_cache_refresh()
+            backend.stop_forwarding()
             backend.stop_heartbeat_monitor()
+
+    def listen(self, site, port):
+        """有旧进程在运行时接管它的端口和连接，否则直接监听。"""
+        d = handover.takeover(CONF.server.handover_socket)
+        d.addCallback(self._listen, site, port)
+        d.addErrback(self._listen_err)
+
+    def _listen(self, inherited, site, port):
+        if inherited is None:
+            http_port = reactor.listenTCP(port, site)
+        else:
+            receiver, items = inherited
+            http_port = handover.adopt(items, site)
+            receiver.finish()
+        backend.init_gateway()
+        backend.start_forwarding()
+        if CONF.server.handover_socket:
+            try:
+                handover.serve(CONF.server.handover_socket, http_port)
+            except handover.HandoverError as e:
+                log.error("Hot restart disabled: {}".format(e))
+        log.debug("Serving HTTP/WS at port {}".format(port))
+
+    def _listen_err(self, failure):
+        log.error("Failed to start server: {}".format(failure.getErrorMessage()))
+        reactor.stop()
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import logging
-import re
 import time
-import subprocess
+import threading
 
 import openstack
 
+from . import singleflight, spice
+
+from collections import OrderedDict
 from oslo_config import cfg
 from openstack import connection
 
@@ -19,6 +21,24 @@ os_opts = [
                help=('OpenStack admin usser')),
     cfg.StrOpt('admin_pass', default='123456',
                help=('OpenStack admin password')),
+    cfg.StrOpt('admin_project', default='admin',
+               help=('Project used for cloud-wide admin queries')),
+    cfg.IntOpt('admin_pool_size', default=64,
+               help=('Max number of cached admin sessions')),
+    cfg.IntOpt('admin_token_margin', default=300,
+               help=('Refresh admin sessions whose token expires within '
+                     'this many seconds')),
+    cfg.IntOpt('token_max_sessions', default=10000,
+               help=('Max number of user sessions kept in memory')),
+    cfg.IntOpt('token_idle_timeout', default=3600,
+               help=('Drop user sessions not used for this many seconds')),
+    cfg.IntOpt('token_ttl', default=0,
+               help=('Max session lifetime in seconds, 0 to follow the '
+                     'Keystone token expiry only')),
+    cfg.IntOpt('hypervisor_ttl', default=300,
+               help=('Max age in seconds of the hypervisor index')),
+    cfg.IntOpt('hypervisor_refresh_interval', default=60,
+               help=('Background hypervisor index refresh interval')),
 ]
 
 CONF = cfg.CONF
@@ -45,7 +65,15 @@ class VMError(RuntimeError):
         super(VMError, self).__init__(msg)
 
 
-_vm_ips = {}
+class PermissionDenied(RuntimeError):
+    """用户无权执行操作"""
+
+    def __init__(self, user, target):
+        super(PermissionDenied, self).__init__('Permission denied: {} on {}'.format(user, target))
+
+
+# 合并并发的相同 Nova/Keystone 请求
+flights = singleflight.Group()
 
 
 class Session(object):
@@ -55,23 +83,36 @@ class Session(object):
     status_check_interval = 0.5
     # 等待状态超时时间
     status_wait_timeout = 10
-    # spice 端口号匹配样式
-    spice_port_pattern = re.compile(r'-spice port=(?P<port>\d+),')
 
-    token_map = {}
+    # 列出VM时的分页大小
+    page_size = 500
+
+    # 是否可以用 token 查询到此会话
+    register_token = True
+
+    auth_url = "http://localhost:5000/v3"
+
+    token_map = None
+
+    @classmethod
+    def tokens(cls):
+        if Session.token_map is None: # 配置文件加载之后才能读取参数
+            Session.token_map = TokenStore(CONF.os.token_max_sessions,
+                                           CONF.os.token_idle_timeout,
+                                           CONF.os.token_ttl)
+        return Session.token_map
 
     @classmethod
     def get(cls, token):
         try:
-            session = cls.token_map[token]
+            session = cls.tokens().get(token)
             return session
         except KeyError:
             raise InvalidTokenError(token)
 
     @classmethod
     def register(cls, session):
-        cls.token_map[session.token] = session
-
+        cls.tokens().add(session)
 
     def __init__(self, username, password, project=None):
         """使用用户名和密码创建会话。
@@ -79,7 +120,7 @@ class Session(object):
         默认每个用户拥有独立的同名项目，也可以指定项目名称。
         自动进行身份验证，验证失败时抛出异常。
         """
-        self.conn = connection.Connection(auth_url="http://localhost:5000/v3",
+        self.conn = connection.Connection(auth_url=self.auth_url,
                 project_name=username if project is None else project,
                 username=username,
                 password=password,
@@ -88,35 +129,80 @@ class Session(object):
         try:
             self.token = self.conn.authorize()
             self.username = username
-            Session.register(self)
+            self.project_id = self.conn.current_project_id
+            self.created = self.last_access = time.time()
+            if self.register_token:
+                Session.register(self)
         except openstack.exceptions.HttpException:
             raise AuthenticationFailure(username)
 
+    @classmethod
+    def resume(cls, state):
+        """用旧进程交来的 token 恢复会话，不需要密码。
+
+        客户端继续使用原来的 token，新取得的 Keystone token 与原 token 同时过期。
+        token 已失效时抛出 AuthenticationFailure。
+        """
+        self = cls.__new__(cls)
+        self.conn = connection.Connection(auth_url=cls.auth_url,
+                auth_type='v3token',
+                token=state['token'],
+                project_id=state['project_id'])
+        try:
+            self.conn.authorize()
+        except openstack.exceptions.HttpException:
+            raise AuthenticationFailure(state['username'])
+        self.token = state['token']
+        self.username = state['username']
+        self.project_id = state['project_id']
+        self.created = state['created']
+        self.last_access = state['last_access']
+        Session.register(self)
+        return self
+
+    def state(self):
+        """交给新进程的会话信息，见 resume。"""
+        return {
+            'token': self.token,
+            'username': self.username,
+            'project_id': self.project_id,
+            'created': self.created,
+            'last_access': self.last_access
+        }
+
+    def close(self):
+        self.conn.close()
+
+    def will_expire_soon(self, margin):
+        """token 是否将在 margin 秒内过期。"""
+        auth_ref = self.conn.session.auth.auth_ref
+        return auth_ref is None or auth_ref.will_expire_soon(margin)
+
+    def list_servers(self, all_projects=False, changes_since=None):
+        """分页列出VM详细信息，返回列表。
+
+        changes_since: ISO 8601 时间，只列出此后有变化（包括已删除）的VM
+        """
+        query = {'limit': self.page_size}
+        if all_projects:
+            query['all_projects'] = True
+        if changes_since is not None:
+            query['changes_since'] = changes_since
+        key = ('servers', self.username, self.project_id, all_projects, changes_since)
+        return flights.do(key, lambda: list(self.conn.compute.servers(details=True, **query)))
+
+    def get_server(self, vm_id):
+        key = ('server', self.username, self.project_id, vm_id)
+        return flights.do(key, self.conn.compute.get_server, vm_id)
+
     def get_vms(self):
         """获取用户项目中的所有VM。
 
         返回每个VM的id，状态和浮动ip。
         """
-        def get_floating_ips(networks):
-            """从网络信息中提取浮动ip。"""
-            result = []
-            for name in networks:
-                for address in networks[name]:
-                    if address['OS-EXT-IPS:type'] == 'floating':
-                        result.append(address['addr'])
-            return result
-
-
-        instances = self.conn.compute.servers() # instances 是 generator
         info = {}
-        for vm in instances:
-            info[vm.id] = {
-                u'name': vm.name,
-                u'status': vm.status,
-                u'floating_ips': get_floating_ips(vm.addresses),
-                u'os': 'win'
-            }
-            _vm_ips[vm.id] = info[vm.id][u'floating_ips'][0] if len(info[vm.id][u'floating_ips']) > 0 else None
+        for vm in self.list_servers():
+            info[vm.id] = vm_info(vm)
         return info
 
     def wait_for_status(self, vm_id, status, timeout):
@@ -131,7 +217,7 @@ class Session(object):
         now = time.time()
         deadline = now + timeout
         while now < deadline:
-            vm = self.conn.compute.get_server(vm_id)
+            vm = self.get_server(vm_id)
             if vm.status == status:
                 break
             if vm.status == 'ERROR':
@@ -141,28 +227,43 @@ class Session(object):
         else:
             raise VMError('Action timeout.')
 
+    def get_spice_port(self, vm_id):
+        return spice.get_spice_port(vm_id)
+
+    def power_on(self, vm_id):
+        """向关机状态的VM发送启动请求，不等待启动完成。
+
+        返回是否发送了启动请求。
+        """
+        vm = self.get_server(vm_id)
+        if vm.status != 'SHUTOFF': # 只在关机状态下执行
+            return False
+        log.info('Starting VM {}'.format(vm_id))
+        vm.action(self.conn.session, {'os-start': ''})
+        return True
+
+    def ready_info(self, vm_id):
+        """VM启动后返回给客户端的信息。"""
+        info = {
+            'code': 200,
+            'res': {
+                vm_id: {
+                    'status': 'ACTIVE',
+                    'spice_port': self.get_spice_port(vm_id)
+                }
+            }
+        }
+        return info
+
     def start_vm(self, vm_id):
         """启动用户的VM。
 
         返回时VM已启动，或因错误无法启动，或操作超时。
-        后两者抛出VMError异常。
+        会占用当前线程等待，服务中使用 vmwaiter.StatusWaiter。
         """
-
-        def get_spice_port(vm_id):
-            ps = subprocess.Popen(['ps', '-ef'], stdout=subprocess.PIPE)
-            qemu = subprocess.Popen(["grep", vm_id], stdin=ps.stdout, stdout=subprocess.PIPE)
-            out = qemu.communicate()[0]
-            m = self.spice_port_pattern.search(out)
-            return m.group('port') if m else ''
-
-        session = self.conn.session
-        vm = self.conn.compute.get_server(vm_id)
-        if vm.status == 'SHUTOFF': # 只在关机状态下执行
-            log.info('Starting VM {}'.format(vm_id))
-            body = {'os-start': ''}
-            vm.action(session, body)
+        if self.power_on(vm_id):
             try:
-                self.wait_for_status(vm, 'ACTIVE', self.status_wait_timeout)
+                self.wait_for_status(vm_id, 'ACTIVE', self.status_wait_timeout)
                 log.info('VM {} powered on'.format(vm_id))
             except VMError as e:
                 info = {
@@ -172,17 +273,7 @@ class Session(object):
                     }
                 }
                 return info
-
-        info = {
-            'code': 200,
-            'res': {
-                vm_id: {
-                    'status': 'ACTIVE',
-                    'spice_port': get_spice_port(vm.id)
-                }
-            }
-        }
-        return info
+        return self.ready_info(vm_id)
 
     def stop_vm(self, vm_id):
         """关闭用户的VM。
@@ -190,15 +281,22 @@ class Session(object):
         返回时VM已关闭，或因错误无法关闭，或操作超时。
         后两者抛出VMError异常。
         """
-        session = self.conn.session
-        vm = self.conn.compute.get_server(vm_id)
-        if vm.status == 'ACTIVE': # 只在开机状态下执行
-            log.info('Shuting down VM {}'.format(vm_id))
-            body = {'os-stop': ''}
-            vm.action(session, body)
-            self.wait_for_status(vm, 'SHUTOFF', self.status_wait_timeout)
+        if self.power_off(vm_id):
+            self.wait_for_status(vm_id, 'SHUTOFF', self.status_wait_timeout)
             log.info('VM {} powered off'.format(vm_id))
 
+    def power_off(self, vm_id):
+        """向开机状态的VM发送关机请求，不等待关机完成。
+
+        返回是否发送了关机请求。
+        """
+        vm = self.get_server(vm_id)
+        if vm.status != 'ACTIVE': # 只在开机状态下执行
+            return False
+        log.info('Shuting down VM {}'.format(vm_id))
+        vm.action(self.conn.session, {'os-stop': ''})
+        return True
+
 
 class AdminSession(Session):
     """管理员会话类。
@@ -206,29 +304,220 @@ class AdminSession(Session):
     为了能够获得相关信息，管理员需要在每个用户的项目中都拥有管理员权限。
     """
 
+    register_token = False
+
     def __init__(self, project):
         admin_user = CONF.os.admin_user
         admin_pass = CONF.os.admin_pass
         super(AdminSession, self).__init__(admin_user, admin_pass, project=project)
 
-    def get_vm_host(self, vm_id):
-        """获取VM所在服务器的名称和ip。"""
-        vm = self.conn.compute.get_server(vm_id)
+    def get_vms(self, all_projects=False):
+        """获取项目中的VM信息，包含VM所在服务器的名称和ip。
+
+        all_projects 为真时列出所有项目的VM。
+        VM所在服务器的名称包含在列表结果中，只需一次分页请求。
+        """
+        info = {}
+        for vm in self.list_servers(all_projects):
+            info[vm.id] = vm_info(vm, with_host=True)
+        return info
+
+
+def get_floating_ips(networks):
+    """从网络信息中提取浮动ip。"""
+    result = []
+    for name in networks:
+        for address in networks[name]:
+            if address['OS-EXT-IPS:type'] == 'floating':
+                result.append(address['addr'])
+    return result
+
+
+def vm_info(vm, with_host=False):
+    """从VM详细信息中提取需要的字段。
+
+    with_host 为真时包含VM所在服务器的名称和ip，需要管理员权限。
+    """
+    floating_ips = get_floating_ips(vm.addresses or {})
+    info = {
+        u'name': vm.name,
+        u'status': vm.status,
+        u'floating_ips': floating_ips,
+        u'project_id': vm.project_id,
+        u'os': 'win'
+    }
+    if with_host:
         host_name = vm['OS-EXT-SRV-ATTR:hypervisor_hostname']
-        hypervisors = self.conn.compute.hypervisors()
-        host = [hv for hv in hypervisors if hv.hypervisor_hostname == host_name][0]
-        host = self.conn.compute.get_hypervisor(host.id)
-        return host_name, host.host_ip
+        info[u'host_name'] = host_name
+        info[u'spice_ip'] = lookup_host_ip(host_name) if host_name else None
+    return info
+
+
+class TokenStore(object):
+    """token 到用户会话的映射。
+
+    会话在 Keystone token 过期、超过最长存活时间或长时间未使用时失效，
+    查询时检查失效；超过容量时淘汰最久未使用的会话。
+    """
+
+    def __init__(self, max_size, idle_timeout, ttl=0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ttl = ttl
+        self.sessions = OrderedDict() # 按最近使用时间排序
+        self.lock = threading.Lock()
+        self.evictions = {'expired': 0, 'idle': 0, 'capacity': 0}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def _expired(self, session, now):
+        if self.ttl and now - session.created > self.ttl:
+            return 'expired'
+        if now - session.last_access > self.idle_timeout:
+            return 'idle'
+        if session.will_expire_soon(0):
+            return 'expired'
+        return None
+
+    def _evict(self, token, reason):
+        session = self.sessions.pop(token)
+        self.evictions[reason] += 1
+        log.debug('Session of user {} evicted: {}'.format(session.username, reason))
+        try:
+            session.close()
+        except Exception as e:
+            log.warning('Failed to close session: {}'.format(e))
+
+    def add(self, session):
+        now = time.time()
+        with self.lock:
+            self.sessions.pop(session.token, None)
+            self.sessions[session.token] = session
+            # 最久未使用的会话在前，只检查到第一个未过期空闲时间的会话为止
+            for token in list(self.sessions):
+                if now - self.sessions[token].last_access <= self.idle_timeout:
+                    break
+                self._evict(token, 'idle')
+            while len(self.sessions) > self.max_size:
+                self._evict(next(iter(self.sessions)), 'capacity')
+
+    def get(self, token):
+        """返回 token 对应的会话，不存在或已失效时抛出 KeyError。"""
+        now = time.time()
+        with self.lock:
+            session = self.sessions[token]
+            reason = self._expired(session, now)
+            if reason is not None:
+                self._evict(token, reason)
+                raise KeyError(token)
+            session.last_access = now
+            self.sessions[token] = self.sessions.pop(token) # 移到队尾
+            return session
+
+    def export(self):
+        """所有会话的 state()，最久未使用的在前。"""
+        with self.lock:
+            return [session.state() for session in self.sessions.values()]
+
+    def stats(self):
+        return {
+            'size': len(self.sessions),
+            'evictions': dict(self.evictions)
+        }
+
+
+class AdminSessionPool(object):
+    """按项目缓存已认证的管理员会话。
+
+    token 即将过期时重新认证，超过容量时淘汰最久未使用的会话。
+    """
+
+    def __init__(self, max_size, margin):
+        self.max_size = max_size
+        self.margin = margin
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, project):
+        with self.lock:
+            admin = self.sessions.pop(project, None)
+            if admin is not None and not admin.will_expire_soon(self.margin):
+                self.sessions[project] = admin # 移到队尾
+                return admin
+
+        log.debug('Authenticating admin session for project {}'.format(project))
+        admin = flights.do(('admin_auth', project), AdminSession, project)
+        with self.lock:
+            self.sessions[project] = admin
+            while len(self.sessions) > self.max_size:
+                evicted, _ = self.sessions.popitem(last=False)
+                log.debug('Admin session for project {} evicted'.format(evicted))
+        return admin
+
+
+_admin_pool = None
+
+
+def admin_session(project):
+    """获取项目的管理员会话，优先复用缓存。"""
+    global _admin_pool
+    if _admin_pool is None: # 配置文件加载之后才能读取参数
+        _admin_pool = AdminSessionPool(CONF.os.admin_pool_size, CONF.os.admin_token_margin)
+    return _admin_pool.get(project)
+
+
+class HypervisorIndex(object):
+    """hypervisor 主机名到 host_ip 的索引。
+
+    由后台定时刷新；超过 ttl 未刷新或查询未命中时同步刷新。
+    """
+
+    # 未命中触发刷新的最小间隔，避免未知主机名引起频繁请求
+    miss_refresh_interval = 10
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hosts = {}
+        self.updated = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        admin = admin_session(CONF.os.admin_project)
+        hosts = {}
+        hypervisors = flights.do(('hypervisors',),
+                                 lambda: list(admin.conn.compute.hypervisors(details=True)))
+        for hv in hypervisors:
+            hosts[hv.hypervisor_hostname] = hv.host_ip
+        with self.lock:
+            self.hosts = hosts
+            self.updated = time.time()
+        log.debug('Hypervisor index refreshed: {} hosts'.format(len(hosts)))
+
+    def lookup(self, host_name):
+        age = time.time() - self.updated
+        if age > self.ttl:
+            self.refresh()
+        elif host_name not in self.hosts and age > self.miss_refresh_interval:
+            self.refresh()
+        return self.hosts.get(host_name)
+
+
+_hypervisors = None
+
+
+def _hypervisor_index():
+    global _hypervisors
+    if _hypervisors is None:
+        _hypervisors = HypervisorIndex(CONF.os.hypervisor_ttl)
+    return _hypervisors
+
+
+def lookup_host_ip(host_name):
+    """查询 hypervisor 的 ip，不存在时返回 None。"""
+    return _hypervisor_index().lookup(host_name)
 
-    def get_vms(self):
-        """获取项目中的VM信息，包含VM所在服务器的名称和ip。"""
-        vms = super(AdminSession, self).get_vms()
-        for id in vms:
-            hostname, host_ip = self.get_vm_host(id)
-            vms[id][u'host_name'] = hostname
-            vms[id][u'spice_ip'] = host_ip
-        return vms
 
+def refresh_hypervisors():
+    _hypervisor_index().refresh()
 
-def lookup_vm_ip(vm_id):
-    return _vm_ips.get(vm_id, None)
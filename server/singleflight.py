@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import sys
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None # sys.exc_info()，保留执行者的 traceback
+
+
+class Group(object):
+    """合并并发的相同调用。
+
+    同一个 key 的调用进行中时，其他线程等待并共享它的结果或异常，
+    不再重复执行。
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.deduplicated = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.deduplicated += 1
+                leader = False
+            else:
+                call = self.calls[key] = _Call()
+                self.executed += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception:
+                call.error = sys.exc_info()
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error[0], call.error[1], call.error[2]
+        return call.result
+
+    def stats(self):
+        return {
+            'executed': self.executed,
+            'deduplicated': self.deduplicated,
+            'in_flight': len(self.calls)
+        }
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_cmdline(cmdline):
+    """从 qemu 命令行中解析VM的 uuid 和 spice 端口。
+
+    cmdline: /proc/<pid>/cmdline 的内容，参数以 NUL 分隔
+    返回 (uuid, port)，无法解析时对应项为 None。
+    """
+    args = cmdline.split('\0')
+    uuid = port = None
+    for i in range(len(args) - 1):
+        if args[i] == '-uuid':
+            uuid = args[i + 1]
+        elif args[i] == '-spice':
+            for item in args[i + 1].split(','):
+                key, _, value = item.partition('=')
+                if key == 'port' and value.isdigit():
+                    port = value
+    return uuid, port
+
+
+class SpicePortResolver(object):
+    """直接读取 /proc 查询VM的 spice 端口。
+
+    保存 vm_id -> (pid, 启动时间, port) 索引，只在未命中或进程已退出时重新扫描。
+    已解析出端口的进程不再读取命令行；其他进程每次扫描都重新读取，
+    因为 libvirt fork 之后、exec qemu 之前读到的命令行中还没有 -spice。
+    pid 可能被新进程重用，所以用 pid 和启动时间一起标识进程。
+    """
+
+    def __init__(self, proc_root='/proc'):
+        self.proc_root = proc_root
+        self.ports = {}
+        self.scanned = {} # 已解析出端口的 pid -> 启动时间
+        self.lock = threading.Lock()
+
+    def _start_time(self, pid):
+        """进程的启动时间，进程已退出时返回 None。"""
+        try:
+            with open(os.path.join(self.proc_root, pid, 'stat'), 'rb') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            return None
+        # 进程名中可能有空格，从最后一个 ')' 之后数起，starttime 是第 22 项
+        return stat[stat.rfind(')') + 2:].split(' ')[19]
+
+    def _alive(self, pid, start):
+        return start is not None and self._start_time(pid) == start
+
+    def _read_cmdline(self, pid):
+        try:
+            with open(os.path.join(self.proc_root, pid, 'cmdline'), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return '' # 进程已退出或无权限
+
+    def rescan(self):
+        pids = set(name for name in os.listdir(self.proc_root) if name.isdigit())
+        for pid in list(self.scanned):
+            if pid not in pids or not self._alive(pid, self.scanned[pid]):
+                del self.scanned[pid]
+        for vm_id in list(self.ports):
+            pid, start, _ = self.ports[vm_id]
+            if self.scanned.get(pid) != start:
+                del self.ports[vm_id]
+        for pid in pids.difference(self.scanned):
+            uuid, port = parse_cmdline(self._read_cmdline(pid))
+            if uuid is None or port is None:
+                continue
+            start = self._start_time(pid)
+            if start is not None:
+                self.scanned[pid] = start
+                self.ports[uuid] = (pid, start, port)
+
+    def lookup(self, vm_id):
+        """返回VM的 spice 端口字符串，找不到时返回空字符串。"""
+        entry = self.ports.get(vm_id)
+        if entry is not None and self._alive(entry[0], entry[1]):
+            return entry[2]
+        with self.lock:
+            self.rescan()
+            entry = self.ports.get(vm_id)
+        if entry is None:
+            log.debug('Spice port of VM {} not found'.format(vm_id))
+            return ''
+        return entry[2]
+
+
+_resolver = SpicePortResolver()
+
+
+def get_spice_port(vm_id):
+    return _resolver.lookup(vm_id)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReadWriteDescriptor
+from zope.interface import implementer
+
+
+log = logging.getLogger(__name__)
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+_FLAGS = SPLICE_F_MOVE | SPLICE_F_NONBLOCK
+
+# 每次 splice 的最大字节数，等于 Linux 管道的默认容量
+chunk_size = 65536
+
+_splice = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _splice = _libc.splice
+        _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                            ctypes.c_size_t, ctypes.c_uint]
+        _splice.restype = ctypes.c_ssize_t
+    except (OSError, AttributeError):
+        _splice = None
+
+
+def available():
+    return _splice is not None
+
+
+def splice(fd_in, fd_out, length):
+    """返回移动的字节数，暂时无法读写时返回 None。"""
+    n = _splice(fd_in, None, fd_out, None, length, _FLAGS)
+    if n < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+            return None
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+class _Direction(object):
+    """一个方向的数据通道：src socket -> 管道 -> dst socket。"""
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.pending = 0 # 管道中尚未写出的字节数
+        self.bytes = 0
+        self.eof = False
+
+    def fill(self):
+        """从 src 读入管道，返回 False 表示对端已关闭。"""
+        n = splice(self.src.fd, self.pipe_w, chunk_size)
+        if n == 0:
+            return False
+        if n is not None:
+            self.pending += n
+        return True
+
+    def flush(self):
+        """把管道中的数据写到 dst，返回是否已全部写出。"""
+        while self.pending:
+            n = splice(self.pipe_r, self.dst.fd, self.pending)
+            if n is None:
+                return False
+            self.pending -= n
+            self.bytes += n
+        return True
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+@implementer(IReadWriteDescriptor)
+class _End(object):
+    """注册到 reactor 的一端 socket。
+
+    可读时把数据送往对端，可写时写出从对端收到、积压在管道中的数据。
+    """
+
+    def __init__(self, pair, transport):
+        self.pair = pair
+        self.transport = transport
+        self.fd = transport.fileno()
+        self.outgoing = None # 本端 -> 对端
+        self.incoming = None # 对端 -> 本端
+        self.paused = False
+
+    def fileno(self):
+        return self.fd
+
+    def logPrefix(self):
+        return 'SpliceForwarder'
+
+    def doRead(self):
+        d = self.outgoing
+        try:
+            if not d.fill():
+                d.eof = True
+            if not d.flush():
+                # 对端写不下，停止读取直到管道清空
+                self.pair.reactor.removeReader(self)
+                self.pair.reactor.addWriter(d.dst)
+            elif d.eof:
+                self.pair.close()
+        except OSError as e:
+            log.debug('splice failed: {}'.format(e))
+            self.pair.close()
+
+    def doWrite(self):
+        d = self.incoming
+        try:
+            if d.flush():
+                self.pair.reactor.removeWriter(self)
+                if d.eof: # 对端关闭前发送的数据已全部写出
+                    self.pair.close()
+                elif not d.src.paused:
+                    self.pair.reactor.addReader(d.src)
+        except OSError as e:
+            log.debug('splice failed: {}'.format(e))
+            self.pair.close()
+
+    def connectionLost(self, reason):
+        self.pair.close()
+
+    def pauseProducing(self):
+        self.paused = True
+        self.pair.reactor.removeReader(self)
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.outgoing.pending:
+            self.pair.reactor.addReader(self)
+
+    def stopProducing(self):
+        self.pair.close()
+
+
+class SplicePair(object):
+    """接管两个已连接的 Twisted TCP transport，在内核中双向转发。
+
+    用 splice(2) 经由管道在 socket 之间移动数据，不复制到 Python，只支持 Linux。
+    管道写不出时停止读取源 socket，实现与 Twisted 相同的流量控制。
+    接管前两个 transport 的发送缓冲区必须为空。
+    关闭时通过 transport.loseConnection 交还 Twisted 处理连接断开。
+    """
+
+    def __init__(self, transport_a, transport_b, reactor=reactor):
+        self.reactor = reactor
+        self.a = _End(self, transport_a)
+        self.b = _End(self, transport_b)
+        self.a.outgoing = self.b.incoming = _Direction(self.a, self.b)
+        self.b.outgoing = self.a.incoming = _Direction(self.b, self.a)
+        self.closed = False
+
+    def start(self):
+        for end in (self.a, self.b):
+            end.transport.stopReading()
+            end.transport.stopWriting()
+            self.reactor.addReader(end)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for end in (self.a, self.b):
+            self.reactor.removeReader(end)
+            self.reactor.removeWriter(end)
+            end.outgoing.close()
+        for end in (self.a, self.b):
+            end.transport.loseConnection()
+
+    def freeze(self):
+        """停止读取，管道中的数据继续写出。"""
+        for end in (self.a, self.b):
+            end.pauseProducing()
+
+    def thaw(self):
+        if self.closed:
+            return
+        for end in (self.a, self.b):
+            end.resumeProducing()
+
+    def drained(self):
+        return not self.a.outgoing.pending and not self.b.outgoing.pending
+
+    def detach(self):
+        """从 reactor 移除，不关闭 socket，用于把连接交给其他进程。"""
+        self.closed = True
+        for end in (self.a, self.b):
+            self.reactor.removeReader(end)
+            self.reactor.removeWriter(end)
+            end.outgoing.close()
+
+    def stats(self):
+        return self.a.outgoing.bytes, self.b.outgoing.bytes
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+
+class Flow(object):
+    """一个方向的流量计数。"""
+
+    __slots__ = ('bytes', 'chunks', 'paused', 'paused_at')
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.paused = 0.0 # 因对端写不下而停止读取的累计秒数
+        self.paused_at = None
+
+    def pause(self, now=None):
+        if self.paused_at is None:
+            self.paused_at = time.time() if now is None else now
+
+    def resume(self, now=None):
+        if self.paused_at is not None:
+            now = time.time() if now is None else now
+            self.paused += now - self.paused_at
+            self.paused_at = None
+
+    def paused_time(self, now):
+        if self.paused_at is None:
+            return self.paused
+        return self.paused + now - self.paused_at
+
+
+class ConnectionStats(object):
+    """一条转发连接的统计，up 为客户端到VM，down 为VM到客户端。"""
+
+    __slots__ = ('user', 'vm_id', 'started', 'connect_time', 'up', 'down')
+
+    def __init__(self, user, vm_id, now=None):
+        self.user = user
+        self.vm_id = vm_id
+        self.started = time.time() if now is None else now
+        self.connect_time = None # 连接到VM所用的秒数
+        self.up = Flow()
+        self.down = Flow()
+
+    def connected(self, now=None):
+        now = time.time() if now is None else now
+        self.connect_time = now - self.started
+
+
+_FIELDS = ('connections', 'active', 'bytes_up', 'bytes_down', 'chunks_up', 'chunks_down',
+           'paused_up', 'paused_down', 'connect_time', 'duration')
+
+
+def _add(totals, stats, now, active):
+    totals['connections'] += 1
+    totals['active'] += active
+    totals['bytes_up'] += stats.up.bytes
+    totals['bytes_down'] += stats.down.bytes
+    totals['chunks_up'] += stats.up.chunks
+    totals['chunks_down'] += stats.down.chunks
+    totals['paused_up'] += stats.up.paused_time(now)
+    totals['paused_down'] += stats.down.paused_time(now)
+    totals['connect_time'] += stats.connect_time or 0
+    totals['duration'] += now - stats.started
+
+
+class Telemetry(object):
+    """按用户和VM汇总转发连接的统计。
+
+    数据通道只修改 ConnectionStats 的计数，汇总在连接关闭和查询时进行。
+    """
+
+    def __init__(self):
+        self.active = set()
+        self.closed = {} # (user, vm_id) -> 已关闭连接的合计
+
+    def open(self, user=None, vm_id=None):
+        stats = ConnectionStats(user, vm_id)
+        self.active.add(stats)
+        return stats
+
+    def close(self, stats, now=None):
+        if stats not in self.active:
+            return
+        self.active.discard(stats)
+        now = time.time() if now is None else now
+        stats.up.resume(now)
+        stats.down.resume(now)
+        key = (stats.user, stats.vm_id)
+        totals = self.closed.get(key)
+        if totals is None:
+            totals = self.closed[key] = dict.fromkeys(_FIELDS, 0)
+        _add(totals, stats, now, 0)
+
+    def report(self, now=None):
+        """返回 {'users': {user: 合计}, 'vms': {vm_id: 合计}}。
+
+        合计包括进行中的连接，connect_time 和 duration 为所有连接之和。
+        """
+        now = time.time() if now is None else now
+        users = {}
+        vms = {}
+
+        def merge(key, totals):
+            user, vm_id = key
+            for table, name in ((users, user), (vms, vm_id)):
+                entry = table.get(name)
+                if entry is None:
+                    entry = table[name] = dict.fromkeys(_FIELDS, 0)
+                for field in _FIELDS:
+                    entry[field] += totals[field]
+
+        for key, totals in self.closed.items():
+            merge(key, totals)
+        for stats in list(self.active):
+            totals = dict.fromkeys(_FIELDS, 0)
+            _add(totals, stats, now, 1)
+            merge((stats.user, stats.vm_id), totals)
+        return {'active': len(self.active), 'users': users, 'vms': vms}
+
+
+# 所有转发连接共用
+registry = Telemetry()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+
+class TimerWheel(object):
+    """哈希时间轮，按到期时间管理大量定时项。
+
+    时间按 resolution 分成格，每格一个集合。添加、重新计时和取消都是 O(1)，
+    推进时只取出到期格中的项，开销与到期的项数成正比。
+    到期时间超过一圈的项在经过时放回，不提前到期。
+    """
+
+    def __init__(self, resolution, span, now=0):
+        self.resolution = float(resolution)
+        self.slots = [set() for _ in range(int(math.ceil(span / self.resolution)) + 1)]
+        self.where = {} # key -> (格, 到期时间)
+        self.tick = self._tick(now)
+
+    def _tick(self, t):
+        return int(math.floor(t / self.resolution))
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def schedule(self, key, deadline):
+        """设置 key 的到期时间，已存在则重新计时。"""
+        self.cancel(key)
+        # 当前格已经取出过，最早放到下一格
+        tick = max(int(math.ceil(deadline / self.resolution)), self.tick + 1)
+        index = tick % len(self.slots)
+        self.slots[index].add(key)
+        self.where[key] = (index, deadline)
+
+    def cancel(self, key):
+        item = self.where.pop(key, None)
+        if item is not None:
+            self.slots[item[0]].discard(key)
+
+    def advance(self, now):
+        """推进到 now，返回到期的 key 列表。"""
+        target = self._tick(now)
+        expired = []
+        # 停顿超过一圈时每格只需经过一次
+        start = max(self.tick + 1, target - len(self.slots) + 1)
+        for tick in range(start, target + 1):
+            index = tick % len(self.slots)
+            slot = self.slots[index]
+            if not slot:
+                continue
+            later = set()
+            for key in slot:
+                if self.where[key][1] <= now:
+                    del self.where[key]
+                    expired.append(key)
+                else:
+                    later.add(key)
+            self.slots[index] = later
+        self.tick = max(self.tick, target)
+        return expired
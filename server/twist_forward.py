@@ -1,30 +1,128 @@
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import os
 import socket
+import sys
+import time
+from collections import deque
+from oslo_config import cfg
 from portforward import ProxyFactory
-from twisted.internet.protocol import Protocol,Factory
-from twisted.internet import reactor
-from twisted.internet.endpoints import TCP4ServerEndpoint
+from port_forward import SO_REUSEPORT
+import splicefwd
+from twisted.internet import defer, protocol, reactor, task
+from twisted.internet.error import CannotListenError
 
 
 log = logging.getLogger(__name__)
 
+opt_server_group = cfg.OptGroup(name='server',
+                            title='Foldex Server IP Port')
 
-def findFreePort():
-    """
-    get a random avalible port
+forward_opts = [
+    cfg.IntOpt('proxy_port_min', default=40000,
+               help=('First port of the RDP proxy port range')),
+    cfg.IntOpt('proxy_port_max', default=40999,
+               help=('Last port of the RDP proxy port range')),
+    cfg.StrOpt('forward_engine', default='twisted', choices=['twisted', 'splice'],
+               help=('RDP forwarding data path, splice moves data in the '
+                     'kernel and requires Linux')),
+    cfg.IntOpt('forward_workers', default=0,
+               help=('Number of forwarding worker processes sharing each '
+                     'proxy port with SO_REUSEPORT, 0 to forward in the '
+                     'main process')),
+    cfg.IntOpt('predial_timeout', default=15,
+               help=('Connect to the VM when a proxy port is created and '
+                     'keep the connection this many seconds for the first '
+                     'client, 0 to connect only when a client arrives')),
+    cfg.IntOpt('proxy_idle_timeout', default=900,
+               help=('Close proxy ports and remove gateway routes without '
+                     'connections for this many seconds, 0 to keep them '
+                     'until disconnected')),
+    cfg.IntOpt('max_connections', default=2000,
+               help=('Maximum number of concurrent forwarded connections, '
+                     '0 for no limit')),
+    cfg.IntOpt('max_user_connections', default=20,
+               help=('Maximum number of concurrent forwarded connections per '
+                     'user, 0 for no limit')),
+]
+
+CONF = cfg.CONF
+CONF.register_group(opt_server_group)
+CONF.register_opts(forward_opts, opt_server_group)
+
+
+class PortAllocator(object):
+    """从配置的端口范围中分配代理监听端口。
+
+    空闲端口保存在队列中，分配和回收都是 O(1)。
+    端口由实际的监听调用占用，被其他程序占用的端口放回队尾。
     """
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.bind(('localhost', 0))
-        addr, port = s.getsockname()
-        s.close()
-    except socket.error as msg:
-        log.error(msg)
-        s.close()
-    else:
-        return port
+
+    def __init__(self, port_min, port_max):
+        self.port_min = port_min
+        self.port_max = port_max
+        self.free = deque(range(port_min, port_max + 1))
+        self.used = set()
+        self.collisions = 0
+        self.exhausted = 0
+
+    def _take(self, bind):
+        """依次尝试空闲端口，返回 bind(port) 的结果。"""
+        for _ in range(len(self.free)):
+            port = self.free.popleft()
+            try:
+                result = bind(port)
+            except (CannotListenError, socket.error) as e:
+                log.warning('Port {} is in use: {}'.format(port, e))
+                self.collisions += 1
+                self.free.append(port)
+                continue
+            self.used.add(port)
+            return result
+        self.exhausted += 1
+        raise IOError("Cannot find free port")
+
+    def adopt(self, port):
+        """登记从旧进程接管的端口。"""
+        if port in self.free:
+            self.free.remove(port)
+        self.used.add(port)
+
+    def listen(self, factory, interface=''):
+        """在空闲端口上监听，返回 IListeningPort。"""
+        return self._take(lambda port: reactor.listenTCP(port, factory, interface=interface))
+
+    def reserve(self, interface=''):
+        """用不监听的 SO_REUSEPORT socket 占用空闲端口，返回 (port, socket)。
+
+        转发进程随后可以在同一端口上监听，其他程序则无法绑定。
+        """
+        def bind(port):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            try:
+                sock.bind((interface, port))
+            except socket.error:
+                sock.close()
+                raise
+            return port, sock
+        return self._take(bind)
+
+    def release(self, port):
+        if port in self.used:
+            self.used.remove(port)
+            self.free.append(port) # 放到队尾，尽量晚些重用
+
+    def stats(self):
+        return {
+            'range': [self.port_min, self.port_max],
+            'used': len(self.used),
+            'free': len(self.free),
+            'collisions': self.collisions,
+            'exhausted': self.exhausted
+        }
 
 class Singleton(object):
     def __new__(cls, *args, **kwargs):
@@ -32,36 +130,339 @@ class Singleton(object):
             cls._inst=super(Singleton, cls).__new__(cls, *args, **kwargs)
         return cls._inst
 
+class ConnectionLimiter(object):
+    """限制同时转发的连接数，总数和每个用户分别计数。
+
+    转发进程中的连接由 update() 定期报告，与主进程中的连接一起计数。
+    """
+
+    def __init__(self, max_total, max_per_user):
+        self.max_total = max_total
+        self.max_per_user = max_per_user
+        self.total = 0
+        self.users = {}
+        self.rejected = 0
+        self.remote = {} # 转发进程中各用户的连接数
+        self.remote_total = 0
+
+    def full(self, user):
+        """user 再建立一个连接是否超过限制。"""
+        if self.max_total and self.total + self.remote_total >= self.max_total:
+            return True
+        count = self.users.get(user, 0) + self.remote.get(user, 0)
+        return bool(self.max_per_user and user is not None and count >= self.max_per_user)
+
+    def acquire(self, user):
+        if self.full(user):
+            self.rejected += 1
+            return False
+        self.total += 1
+        self.users[user] = self.users.get(user, 0) + 1
+        return True
+
+    def release(self, user):
+        self.total -= 1
+        count = self.users.pop(user) - 1
+        if count:
+            self.users[user] = count
+
+    def update(self, remote, rejected):
+        """转发进程报告的各用户连接数，以及其间拒绝的连接数。"""
+        self.remote = remote
+        self.remote_total = sum(remote.values())
+        self.rejected += rejected
+
+    def stats(self):
+        return {
+            'connections': self.total + self.remote_total,
+            'users': len(set(self.users) | set(self.remote)),
+            'rejected': self.rejected
+        }
+
+
 class Proxy():
 
-    def __init__(self, dest_ip, dest_port, local_ip=''):
-        self.tmpport = findFreePort()
-        if self.tmpport != None:
-            self.new_proxy = ProxyFactory(dest_ip, dest_port)
-            self.endpoint = TCP4ServerEndpoint(reactor, self.tmpport)
-            self.endpoint.listen(self.new_proxy)
-        else:
-            raise IOError,("Cannot find free port")
+    def __init__(self, dest_ip, dest_port, local_ip, allocator, engine='twisted', user=None, vm_id=None,
+                 shaper=None, limiter=None, fd=None):
+        self.allocator = allocator
+        self.new_proxy = ProxyFactory(dest_ip, dest_port, engine, user, vm_id, shaper)
+        self.new_proxy.limiter = limiter
+        if fd is None:
+            self.listening = allocator.listen(self.new_proxy, local_ip)
+        else: # 接管旧进程的监听 socket
+            self.listening = reactor.adoptStreamPort(fd, socket.AF_INET, self.new_proxy)
+            allocator.adopt(self.listening.getHost().port)
+        self.tmpport = self.listening.getHost().port
 
     def stop(self):
         self.new_proxy.stop()
+        self.listening.stopListening()
+        self.allocator.release(self.tmpport)
 
     def getport(self):
         return self.tmpport
 
+    def whenReady(self):
+        return defer.succeed(self.tmpport)
+
+    def idleTime(self, now):
+        return self.new_proxy.idleTime(now)
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.buf = ''
+
+    def connectionMade(self):
+        self.pool.workerStarted(self)
+
+    def send(self, cmd):
+        self.transport.write(json.dumps(cmd) + '\n')
+
+    def outReceived(self, data):
+        self.buf += data
+        while '\n' in self.buf:
+            line, self.buf = self.buf.split('\n', 1)
+            self.pool.workerReplied(self, json.loads(line))
+
+    def processEnded(self, reason):
+        self.pool.workerEnded(self, reason)
+
+
+class WorkerPool(object):
+    """转发进程池。
+
+    每个进程运行 port_forward 的 epoll 循环，在同一端口上以 SO_REUSEPORT 监听，
+    由内核在进程间分配连接。主进程通过 stdin/stdout 发送命令和接收回复，
+    进程退出后自动重启并恢复当前的代理。
+
+    主进程每隔 stats_interval 秒查询各进程的连接数和空闲时间，
+    每个进程回复后调用 onUsage(refused)，refused 为该进程其间拒绝的连接数。
+    """
+
+    restart_delay = 1
+    stats_interval = 1
+
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}
+        self.proxies = {} # port -> add 命令
+        self.waiting = {} # port -> (Deferred, 尚未回复的进程)
+        self.reports = {} # 进程序号 -> {port: [连接数, 空闲开始时间]}
+        self.refusing = set() # 超过连接数限制的端口
+        self.onUsage = None
+        self.poller = task.LoopingCall(self.poll)
+        self.stopping = False
+
+    def start(self):
+        for i in range(self.count):
+            self._spawn(i)
+        self.poller.start(self.stats_interval, now=False)
+
+    def stop(self):
+        self.stopping = True
+        if self.poller.running:
+            self.poller.stop()
+        for worker in self.workers.values():
+            worker.transport.closeStdin() # 进程读到 EOF 后退出
+
+    def _spawn(self, index):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        args = [sys.executable, '-m', 'server.forward_worker']
+        reactor.spawnProcess(_WorkerProtocol(self, index), sys.executable, args,
+                             env=os.environ, path=root, childFDs={0: 'w', 1: 'r', 2: 2})
+
+    def workerStarted(self, worker):
+        self.workers[worker.index] = worker
+        if self.refusing:
+            worker.send({'op': 'limit', 'ports': sorted(self.refusing)})
+        for cmd in self.proxies.values():
+            worker.send(cmd)
+
+    def workerEnded(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+            self.reports.pop(worker.index, None)
+        for port in list(self.waiting):
+            self._acked(port, worker)
+        if not self.stopping:
+            log.error('Forwarding worker {} exited: {}'.format(worker.index, reason.getErrorMessage()))
+            reactor.callLater(self.restart_delay, self._spawn, worker.index)
+
+    def workerReplied(self, worker, msg):
+        if msg['op'] == 'error':
+            log.error('Forwarding worker {} failed on port {}: {}'.format(worker.index, msg['port'], msg['err']))
+            d, _ = self.waiting.pop(msg['port'], (None, None))
+            if d is not None:
+                d.errback(IOError(msg['err']))
+        elif msg['op'] == 'added':
+            self._acked(msg['port'], worker)
+        elif msg['op'] == 'stats':
+            # JSON 的键是字符串
+            self.reports[worker.index] = dict((int(port), usage) for port, usage in msg['ports'].items())
+            if self.onUsage is not None:
+                self.onUsage(msg['refused'])
+
+    def _acked(self, port, worker):
+        if port not in self.waiting:
+            return
+        d, pending = self.waiting[port]
+        pending.discard(worker)
+        if not pending:
+            del self.waiting[port]
+            d.callback(port)
+
+    def add(self, port, host, dest, dport):
+        """所有进程开始监听后触发返回的 Deferred。"""
+        cmd = {'op': 'add', 'port': port, 'host': host, 'dest': dest, 'dport': dport}
+        self.proxies[port] = cmd
+        d = defer.Deferred()
+        self.waiting[port] = (d, set(self.workers.values()))
+        for worker in self.workers.values():
+            worker.send(cmd)
+        if not self.workers:
+            self._acked(port, None)
+        return d
+
+    def delete(self, port):
+        self.proxies.pop(port, None)
+        self.refusing.discard(port)
+        for worker in self.workers.values():
+            worker.send({'op': 'delete', 'port': port})
+
+    def poll(self):
+        for worker in self.workers.values():
+            worker.send({'op': 'stats'})
+
+    def connections(self, port):
+        """各进程最近报告的端口连接数之和。"""
+        return sum(report[port][0] for report in self.reports.values() if port in report)
+
+    def idleSince(self, port):
+        """所有进程中端口最后一个连接关闭的时间，有连接或有进程还未报告时为 None。"""
+        usage = [report[port] for report in self.reports.values() if port in report]
+        if not usage or len(usage) < len(self.workers) or any(since is None for _, since in usage):
+            return None
+        return max(since for _, since in usage)
+
+    def limit(self, ports):
+        """这些端口上的新连接由转发进程直接关闭，其余端口恢复接受连接。"""
+        ports = set(ports)
+        if ports == self.refusing:
+            return
+        self.refusing = ports
+        for worker in self.workers.values():
+            worker.send({'op': 'limit', 'ports': sorted(ports)})
+
+
+class WorkerProxy(object):
+    """由转发进程池服务的代理，主进程只占用端口。"""
+
+    def __init__(self, dest_ip, dest_port, local_ip, allocator, pool, user=None):
+        self.allocator = allocator
+        self.pool = pool
+        self.user = user # 用于限制连接数
+        self.tmpport, self.placeholder = allocator.reserve(local_ip)
+        self.ready = pool.add(self.tmpport, local_ip, dest_ip, dest_port)
+
+    def stop(self):
+        self.pool.delete(self.tmpport)
+        self.placeholder.close()
+        self.allocator.release(self.tmpport)
+
+    def getport(self):
+        return self.tmpport
+
+    def whenReady(self):
+        return self.ready
+
+    def idleTime(self, now):
+        since = self.pool.idleSince(self.tmpport)
+        if since is None:
+            return 0
+        return now - since
+
+
 class ForwardInst(Singleton):
 
     def __init__(self):
         self.forwardlist = {}
+        self.allocator = PortAllocator(CONF.server.proxy_port_min, CONF.server.proxy_port_max)
+        self.engine = CONF.server.forward_engine
+        if self.engine == 'splice' and not splicefwd.available():
+            log.warning('splice is not available, using twisted forwarding engine')
+            self.engine = 'twisted'
+        self.pool = WorkerPool(CONF.server.forward_workers) if CONF.server.forward_workers > 0 else None
+        self.limiter = ConnectionLimiter(CONF.server.max_connections, CONF.server.max_user_connections)
+        self.idle_timeout = CONF.server.proxy_idle_timeout
+        self.reaper = task.LoopingCall(self.reapIdle)
+        self.reaped = 0
+        self.onReap = None # 回调 onReap(localport)，通知代理因空闲被关闭
+        if self.pool is not None:
+            self.pool.onUsage = self.applyLimits
 
-    def addProxy(self, dest_ip, dest_port, local_ip=''):
-        self.proxyinst = Proxy(dest_ip, dest_port, local_ip)
+    def start(self):
+        if self.pool is not None:
+            self.pool.start()
+        if self.idle_timeout > 0:
+            self.reaper.start(min(60, self.idle_timeout), now=False)
+
+    def stop(self):
+        if self.reaper.running:
+            self.reaper.stop()
+        if self.pool is not None:
+            self.pool.stop()
+
+    def reapIdle(self):
+        """关闭空闲超时的代理端口。"""
+        now = time.time()
+        for localport, proxy in self.forwardlist.items():
+            if proxy.idleTime(now) > self.idle_timeout:
+                log.info('Closing idle proxy on {}'.format(localport))
+                self.deleteProxy(localport)
+                self.reaped += 1
+                if self.onReap is not None:
+                    self.onReap(localport)
+
+    def addProxy(self, dest_ip, dest_port, local_ip='', user=None, vm_id=None, shaper=None):
+        """user 和 vm_id 用于流量统计，shaper 用于限速，转发进程池模式下只用 user 限制连接数。"""
+        if self.pool is not None:
+            self.proxyinst = WorkerProxy(dest_ip, dest_port, local_ip, self.allocator, self.pool, user)
+        else:
+            self.proxyinst = Proxy(dest_ip, dest_port, local_ip, self.allocator, self.engine,
+                                   user, vm_id, shaper, self.limiter)
+            if CONF.server.predial_timeout > 0:
+                self.proxyinst.new_proxy.predial(CONF.server.predial_timeout)
         self.tmpport = self.proxyinst.getport()
         self.forwardlist[self.tmpport] = self.proxyinst
         log.debug('proxy to {}:{} from {}:{}'.format(dest_ip, dest_port, local_ip, self.tmpport))
         log.debug('connection count: {}'.format(len(self.forwardlist)))
         return self.tmpport
 
+    def adoptProxy(self, fd, dest_ip, dest_port, user=None, vm_id=None, shaper=None):
+        """接管旧进程的代理监听 socket，返回端口。"""
+        proxy = Proxy(dest_ip, dest_port, '', self.allocator, self.engine,
+                      user, vm_id, shaper, self.limiter, fd)
+        self.forwardlist[proxy.getport()] = proxy
+        return proxy.getport()
+
+    def applyLimits(self, refused):
+        """按转发进程报告的连接数更新连接限制，超过限制的用户的端口拒绝新连接。
+
+        报告是定期的，两次报告之间建立的连接可能超过限制。
+        """
+        remote = {}
+        for localport, proxy in self.forwardlist.items():
+            connections = self.pool.connections(localport)
+            if connections:
+                remote[proxy.user] = remote.get(proxy.user, 0) + connections
+        self.limiter.update(remote, refused)
+        self.pool.limit(localport for localport, proxy in self.forwardlist.items()
+                        if self.limiter.full(proxy.user))
+
     def deleteProxy(self, localport):
         proxy = self.forwardlist.pop(localport, None)
         if proxy:
@@ -71,7 +472,24 @@ class ForwardInst(Singleton):
         else:
             # 可能在同一个 localport 上被调用多次，不作处理
             pass
-        
+
+    def whenReady(self, localport):
+        """代理开始接受连接后触发返回的 Deferred。"""
+        return self.forwardlist[localport].whenReady()
+
+    def stats(self):
+        stats = self.allocator.stats()
+        stats['proxies'] = len(self.forwardlist)
+        stats['reaped'] = self.reaped
+        stats['limits'] = self.limiter.stats()
+        factories = [proxy.new_proxy for proxy in self.forwardlist.values() if isinstance(proxy, Proxy)]
+        stats['predial'] = {
+            'dialed': sum(f.predials for f in factories),
+            'used': sum(f.predial_hits for f in factories),
+            'warm': sum(1 for f in factories if f.warm is not None)
+        }
+        return stats
+
 '''
 test demo:
 class StartForward(Protocol):
@@ -1,19 +1,81 @@
 # -*- coding: utf-8 -*-
 
-import json
 import logging
 import time
-import threading
 
-from . import session
+from . import inventory, timerwheel
 
 from collections import defaultdict
+from twisted.internet import reactor, task
 
 
 log = logging.getLogger(__name__)
 
 
+def topics_of(change):
+    """状态变化所属的 WebSocket 订阅主题。"""
+    topics = ['user:{}'.format(change['user'])]
+    if change.get('vm'):
+        topics.append('vm:{}'.format(change['vm']))
+    if change.get('project_id'):
+        topics.append('project:{}'.format(change['project_id']))
+    if change.get('host'):
+        topics.append('host:{}'.format(change['host']))
+    return topics
+
+
+class NotificationBatcher(object):
+    """合并一个时间窗口内的状态通知。
+
+    每个用户只保留最新状态，窗口结束时把所有变化放在一条消息中广播：
+    {"action": "notify_batch", "changes": [{"user": ..., "online": ..., "vm": ..., "ip_addr": ...,
+                                            "project_id": ..., "host": ...}]}
+    window 为 0 时每次变化单独发送 notify 消息。订阅了主题的客户端只收到相关的变化。
+    """
+
+    def __init__(self, wsf, window, clock=reactor):
+        self.wsf = wsf
+        self.window = window
+        self.clock = clock
+        self.pending = {} # user -> 最新状态
+        self.timer = None
+        self.batches = 0
+        self.coalesced = 0
+
+    def add(self, change):
+        if not self.window:
+            change['action'] = 'notify'
+            self.wsf.publish(change, topics=topics_of(change))
+            return
+        if change['user'] in self.pending:
+            self.coalesced += 1
+        self.pending[change['user']] = change
+        if self.timer is None:
+            self.timer = self.clock.callLater(self.window, self.flush)
+
+    def flush(self):
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        if not self.pending:
+            return
+        changes, self.pending = self.pending.values(), {}
+        self.batches += 1
+        self.wsf.publish({'action': 'notify_batch', 'changes': changes}, split='changes')
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'coalesced': self.coalesced,
+            'pending': len(self.pending)
+        }
+
+
 class UserMonitor(object):
+    """在 reactor 中跟踪用户在线状态。
+
+    心跳超时用时间轮管理，每次检查只处理到期和状态有变化的用户。
+    """
 
     class Record(object):
         def __init__(self):
@@ -21,17 +83,21 @@ class UserMonitor(object):
             self.online = False
             self.vm = None
             self.vm_ip = None
+            self.project_id = None # 离线后保留最后所在的项目和服务器，用于通知的主题
+            self.host = None
+            self.vm_changed = False
 
-    def __init__(self, wsf, timeout=30, interval=5):
+    def __init__(self, wsf, timeout=30, interval=5, notify_window=0, clock=reactor):
         self.memo = defaultdict(self.Record)
-        self.terminated = False
-        self.refresher = threading.Thread(target=self.refresh_status)
         self.timeout = timeout
         self.refresh_interval = interval
         self.wsf = wsf
-
-    def __del__(self):
-        self.stop()
+        self.clock = clock
+        self.batcher = NotificationBatcher(wsf, notify_window, clock)
+        self.wheel = timerwheel.TimerWheel(interval, timeout, clock.seconds())
+        self.changed = set() # 状态有变化、等待通知的用户
+        self.refresher = task.LoopingCall(self.refresh_status)
+        self.refresher.clock = clock
 
     def update_connection(self, user, client_ip='nochange', vm=None):
         rec = self.memo[user]
@@ -39,10 +105,45 @@ class UserMonitor(object):
             rec.client_ip = client_ip
         rec.vm_changed = rec.vm != vm
         if rec.vm_changed and vm:
-            rec.vm_ip = session.lookup_vm_ip(vm)
+            # VM不在目录中时不能沿用上一个VM的项目和服务器，否则通知会发给错误的订阅者
+            info = inventory.lookup_vm(vm)
+            rec.vm_ip = inventory.first_ip(info)
+            rec.project_id = info[u'project_id'] if info is not None else None
+            rec.host = info.get(u'host_name') if info is not None else None
         rec.vm = vm
+        if rec.vm_changed or not rec.online:
+            self.changed.add(user)
         rec.online = True
-        rec.last_update = time.time()
+        rec.last_update = self.clock.seconds()
+        self.wheel.schedule(user, rec.last_update + self.timeout)
+
+    def export(self):
+        """所有用户的状态，交给新进程，见 restore。"""
+        return [{'user': user, 'online': rec.online, 'vm': rec.vm, 'vm_ip': rec.vm_ip,
+                 'client_ip': getattr(rec, 'client_ip', None), 'project_id': rec.project_id,
+                 'host': rec.host, 'last_update': rec.last_update}
+                for user, rec in self.memo.items()]
+
+    def restore(self, users):
+        """恢复旧进程的用户状态，在线用户按原来的最后心跳时间继续计时。"""
+        for item in users:
+            rec = self.memo[item['user']]
+            rec.online, rec.vm, rec.vm_ip = item['online'], item['vm'], item['vm_ip']
+            rec.project_id, rec.host = item['project_id'], item['host']
+            rec.last_update = item['last_update']
+            if item['client_ip'] is not None:
+                rec.client_ip = item['client_ip']
+            if rec.online:
+                self.wheel.schedule(item['user'], rec.last_update + self.timeout)
+
+    def snapshot(self):
+        """在线用户的状态，格式与通知中的变化相同。"""
+        return [self._change(user) for user, _, _ in self.status()]
+
+    def _change(self, user):
+        rec = self.memo[user]
+        return {'user': user, 'online': rec.online, 'vm': rec.vm, 'ip_addr': rec.vm_ip,
+                'project_id': rec.project_id, 'host': rec.host}
 
     def status(self):
         for username in self.memo:
@@ -51,30 +152,26 @@ class UserMonitor(object):
                 yield username, user.vm, user.vm_ip
 
     def refresh_status(self):
-        while not self.terminated:
-            now = time.time()
-            for user in self.memo:
-                rec = self.memo[user]
-                online = now - rec.last_update < self.timeout
-                if online != rec.online or rec.vm_changed:
-                    rec.online = online
-                    rec.vm_changed = False
-                    if not online:
-                        rec.vm = None
-                    self.notify(user)
-            time.sleep(self.refresh_interval)
+        for user in self.wheel.advance(self.clock.seconds()):
+            rec = self.memo[user]
+            rec.online = False
+            rec.vm = None
+            self.changed.add(user)
+        changed, self.changed = self.changed, set()
+        for user in changed:
+            self.memo[user].vm_changed = False
+            self.notify(user)
 
     def notify(self, user):
         rec = self.memo[user]
-        is_online, vm, vm_ip = rec.online, rec.vm, rec.vm_ip
-        log.debug('======================= user {} status changed. [{}][{}]'.format(user, 'ONLINE' if is_online else 'OFFLINE', vm))
-        self.wsf.broadcast(json.dumps({ 'action': 'notify', 'user': user, 'online': is_online, 'vm': vm, 'ip_addr': vm_ip}))
+        log.debug('======================= user {} status changed. [{}][{}]'.format(user, 'ONLINE' if rec.online else 'OFFLINE', rec.vm))
+        self.batcher.add(self._change(user))
 
     def start(self):
-        self.terminated = False
-        self.refresher.start()
+        if not self.refresher.running:
+            self.refresher.start(self.refresh_interval, now=False)
 
     def stop(self):
-        self.terminated = True
-        self.refresher.join()
-
+        if self.refresher.running:
+            self.refresher.stop()
+        self.batcher.flush()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+from . import session
+
+from collections import defaultdict
+from twisted.internet import defer, reactor, threads
+
+
+log = logging.getLogger(__name__)
+
+
+class StatusWaiter(object):
+    """在 reactor 中等待VM达到指定状态。
+
+    所有等待中的VM共用一次批量查询，查询在一个线程中执行，
+    VM状态没有变化时逐渐延长查询间隔。
+    """
+
+    # 查询间隔的下限和上限，秒
+    min_interval = 0.5
+    max_interval = 4
+    # 没有VM状态变化时查询间隔的增长倍数
+    backoff = 1.5
+
+    def __init__(self, poll, clock=reactor):
+        """poll: 在线程中执行，参数为VM id 列表，返回 {vm_id: status}"""
+        self.poll = poll
+        self.clock = clock
+        self.run = threads.deferToThread # 测试中可替换为同步执行
+        self.pending = defaultdict(list) # vm_id -> [(status, deferred, timer)]
+        self.last_status = {}
+        self.interval = self.min_interval
+        self.timer = None # 下一次查询
+        self.polling = False
+
+    def wait(self, vm_id, status, timeout):
+        """返回 Deferred，VM达到 status 时触发。
+
+        VM处于错误状态或超时则以 VMError 失败。
+        """
+        d = defer.Deferred()
+        timer = self.clock.callLater(timeout, self._expire, vm_id, d)
+        self.pending[vm_id].append((status, d, timer))
+        self.interval = self.min_interval
+        if self.timer is None:
+            if not self.polling: # 查询进行中时由查询完成后安排下一次
+                self._schedule()
+        elif self.timer.getTime() - self.clock.seconds() > self.interval:
+            self.timer.reset(self.interval)
+        return d
+
+    def _schedule(self):
+        self.timer = self.clock.callLater(self.interval, self._tick)
+
+    def _expire(self, vm_id, d):
+        waiters = self.pending.get(vm_id, [])
+        for w in waiters:
+            if w[1] is d:
+                waiters.remove(w)
+                break
+        self._cleanup(vm_id)
+        d.errback(session.VMError('Action timeout.'))
+
+    def _cleanup(self, vm_id):
+        if not self.pending.get(vm_id):
+            self.pending.pop(vm_id, None)
+            self.last_status.pop(vm_id, None)
+
+    def _tick(self):
+        self.timer = None
+        if not self.pending:
+            return
+        self.polling = True
+        d = self.run(self.poll, list(self.pending))
+        d.addCallbacks(self._dispatch, self._poll_failed)
+        d.addBoth(self._polled)
+
+    def _polled(self, _):
+        self.polling = False
+        if self.pending and self.timer is None:
+            self._schedule()
+
+    def _poll_failed(self, failure):
+        log.error('VM status poll failed: {}'.format(failure.getErrorMessage()))
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def _dispatch(self, statuses):
+        changed = False
+        fired = []
+        for vm_id in list(self.pending):
+            status = statuses.get(vm_id)
+            if status != self.last_status.get(vm_id):
+                changed = True
+                self.last_status[vm_id] = status
+            remaining = []
+            for waiter in self.pending[vm_id]:
+                if waiter[0] == status or status == 'ERROR':
+                    fired.append((waiter, status))
+                else:
+                    remaining.append(waiter)
+            self.pending[vm_id] = remaining
+            self._cleanup(vm_id)
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+        # 状态更新完成后再触发回调，回调中可能再次调用 wait
+        for (expected, d, timer), status in fired:
+            timer.cancel()
+            if status == expected:
+                d.callback(status)
+            else:
+                d.errback(session.VMError('VM is in error state.'))
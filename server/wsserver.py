@@ -2,24 +2,84 @@
 
 import json
 import logging
+import time
+
+from collections import defaultdict, deque
 
 from autobahn.twisted.websocket import WebSocketServerFactory, \
     WebSocketServerProtocol
+from autobahn.websocket.types import ConnectionDeny
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 
 from . import backend, logconf
 
 
 log = logging.getLogger(__name__)
 
+_TOPIC_PREFIXES = ('project:', 'user:', 'vm:', 'host:')
+
+
+def valid_topics(topics):
+    """topics 必须是字符串列表，每项为 project:<id>、user:<name>、vm:<id> 或 host:<name>。"""
+    return isinstance(topics, list) and all(
+        isinstance(t, basestring) and any(t.startswith(p) and len(t) > len(p) for p in _TOPIC_PREFIXES)
+        for t in topics)
+
+
+@implementer(IPushProducer)
+class SendMeter(object):
+    """估计客户端发送缓冲的积压：transport 暂停之后写入、尚未确认写出的字节数。
+
+    注册为 transport 的 streaming producer。transport 的缓冲超过其上限时调用
+    pauseProducing，缓冲全部写出后调用 resumeProducing，之前写入的数据即已确认。
+    未暂停时缓冲不超过 transport 的上限，积压记为 0。
+    """
+
+    def __init__(self):
+        self.paused = False
+        self.written = 0 # 暂停之后写入的字节数
+
+    def sent(self, size):
+        if self.paused:
+            self.written += size
+
+    @property
+    def queued(self):
+        return self.written
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.written = 0
+
+    def stopProducing(self):
+        pass
+
 
 class WSServerProtocol(WebSocketServerProtocol):
 
     def onConnect(self, request):
         log.debug("Client connecting: {0}".format(request.peer))
-        self.factory.register(self)
+        # 重连的客户端在 URL 中带上收到的最后一条消息: /ws?epoch=E&since=N
+        self.resume = None
+        try:
+            self.resume = (int(request.params['epoch'][0]), int(request.params['since'][0]))
+        except (KeyError, IndexError, ValueError):
+            pass
+        # 也可以在 URL 中订阅: /ws?topics=project:<id>,vm:<id>
+        self.initial_topics = [t for t in request.params.get('topics', [''])[0].split(',') if t]
+        if not valid_topics(self.initial_topics):
+            raise ConnectionDeny(ConnectionDeny.BAD_REQUEST, 'Invalid topics')
 
     def onOpen(self):
         log.debug("WebSocket connection open.")
+        # 快照和错过的消息在同一次调用中发送，不会与新的广播交错
+        self.factory.register(self, self.initial_topics)
+        self.factory.sync(self, self.resume)
 
     def onMessage(self, payload, isBinary):
         if isBinary:
@@ -38,6 +98,18 @@ class WSServerProtocol(WebSocketServerProtocol):
                     vm_id = cmd['vm']
                     user = cmd['user']
                     backend.disconnect_user(user, vm_id)
+                # 订阅主题 project:<id>、user:<name>、vm:<id>、host:<name>，
+                # 之后发送按新订阅过滤的快照
+                elif cmd['action'] in ('subscribe', 'unsubscribe'):
+                    if not valid_topics(cmd.get('topics')):
+                        log.warning('Invalid topics: {}'.format(msg))
+                        self.sendMessage(json.dumps({'action': 'error', 'err': 'Invalid topics'}))
+                    elif cmd['action'] == 'subscribe':
+                        self.factory.subscribe(self, cmd['topics'])
+                        self.factory.sync(self, None)
+                    else:
+                        self.factory.unsubscribe(self, cmd['topics'])
+                        self.factory.sync(self, None)
 
     def connectionLost(self, reason):
         WebSocketServerProtocol.connectionLost(self, reason)
@@ -52,12 +124,49 @@ class BroadcastServerFactory(WebSocketServerFactory):
     """
     Simple broadcast server broadcasting any message it receives to all
     currently connected clients.
+
+    Messages sent with publish() carry an increasing sequence number and
+    are kept in a bounded history. A new client first gets a snapshot of
+    the current state; a reconnecting client that passes the epoch and
+    the last sequence it saw gets only the messages it missed, or a
+    snapshot if they are no longer in the history.
+
+    Clients may subscribe to topics such as "project:<id>" or "vm:<id>";
+    they then only receive events of those topics. Clients without
+    subscriptions receive everything.
+
+    A client that has had more than max_queued bytes written to it since
+    its transport's buffer filled up is a slow consumer, see SendMeter.
+    With the "resync" policy its messages are dropped until the transport
+    has written out its buffer, then the dropped messages are replayed
+    from the history, or it gets a fresh snapshot if they are no longer
+    there; with "disconnect" the connection is aborted.
     """
 
-    def __init__(self, url):
+    version = 1
+    check_interval = 1.0 # 检查慢客户端是否已恢复的间隔
+
+    def __init__(self, url, history=1024, max_queued=1048576, slow_policy='resync', clock=reactor):
         WebSocketServerFactory.__init__(self, url)
-        self.clients = []
+        self.clients = set()
+        self.everyone = set() # 没有订阅的客户端，接收所有消息
+        self.topics = defaultdict(set) # topic -> 订阅的客户端
         self.tickcount = 0
+        self.epoch = int(time.time() * 1000) # 序号在进程重启后重新开始
+        self.seq = 0
+        self.history = deque(maxlen=history) # (seq, msg, obj, topics, split)
+        self.state = None # 返回快照内容的函数，见 backend.init_ws
+        self.item_topics = None # 返回列表中一项所属主题的函数
+        self.resumed = 0
+        self.snapshots = 0
+        self.max_queued = max_queued
+        self.slow_policy = slow_policy
+        self.clock = clock
+        self.lagging = set() # 等待发送缓冲排空的客户端
+        self.checker = None
+        self.dropped = 0
+        self.resyncs = 0
+        self.disconnects = 0
         #self.tick()
 
     def tick(self):
@@ -65,22 +174,231 @@ class BroadcastServerFactory(WebSocketServerFactory):
         self.broadcast("tick %d from server" % self.tickcount)
         reactor.callLater(1, self.tick)
 
-    def register(self, client):
+    def register(self, client, topics=()):
         if client not in self.clients:
             log.debug("registered client {}".format(client.peer))
-            self.clients.append(client)
+            client.topics = set()
+            client.lagging = False
+            client.dropped = 0
+            client.last_seq = self.seq # 最后发送给客户端的消息序号
+            client.meter = SendMeter()
+            client.registerProducer(client.meter, True)
+            self.clients.add(client)
+            self.everyone.add(client)
+            self.subscribe(client, topics)
 
     def unregister(self, client):
         if client in self.clients:
             log.debug("unregistered client {}".format(client.peer))
-            self.clients.remove(client)
+            self.unsubscribe(client, list(client.topics))
+            self.clients.discard(client)
+            self.everyone.discard(client)
+            self.lagging.discard(client)
+
+    def subscribe(self, client, topics):
+        for topic in topics:
+            client.topics.add(topic)
+            self.topics[topic].add(client)
+        if client.topics:
+            self.everyone.discard(client)
+
+    def unsubscribe(self, client, topics):
+        for topic in topics:
+            client.topics.discard(topic)
+            subscribers = self.topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(client)
+                if not subscribers:
+                    del self.topics[topic]
+        if not client.topics and client in self.clients:
+            self.everyone.add(client)
 
     def broadcast(self, msg):
         log.debug("broadcasting message '{}' ..".format(msg))
         for c in self.clients:
-            c.sendMessage(msg.encode('utf8'))
+            self.deliver(c, msg)
             log.debug("message sent to {}".format(c.peer))
 
+    def prepare(self, msg):
+        return msg
+
+    def send(self, client, msg):
+        self.write(client, msg.encode('utf8'))
+
+    def write(self, client, data):
+        client.sendMessage(data)
+        client.meter.sent(len(data))
+
+    def deliver(self, client, msg, seq=None):
+        """发送前检查客户端的发送缓冲，超过上限时按 slow_policy 处理。
+
+        seq 为消息的序号，没有编号的消息为 None。
+        """
+        if not client.lagging and client.meter.queued > self.max_queued:
+            self.slow(client)
+        if client.lagging:
+            client.dropped += 1
+            self.dropped += 1
+            return
+        self.send(client, msg)
+        if seq is not None:
+            client.last_seq = seq
+
+    def slow(self, client):
+        log.warning('WebSocket client {} has {} bytes queued, {}'.format(
+            client.peer, client.meter.queued, self.slow_policy))
+        client.lagging = True # 之后的消息都丢弃
+        if self.slow_policy == 'disconnect':
+            # 不在这里 unregister，publish 可能正在遍历客户端集合
+            self.disconnects += 1
+            client.dropConnection(abort=True)
+            return
+        self.lagging.add(client)
+        if self.checker is None:
+            self.checker = self.clock.callLater(self.check_interval, self.check_lagging)
+
+    def check_lagging(self):
+        """缓冲已排空的慢客户端补发丢弃的消息，已不在历史中时发送快照。"""
+        self.checker = None
+        for client in list(self.lagging):
+            if not client.meter.paused:
+                self.lagging.discard(client)
+                client.lagging = False
+                self.resyncs += 1
+                self.sync(client, (self.epoch, client.last_seq))
+        if self.lagging:
+            self.checker = self.clock.callLater(self.check_interval, self.check_lagging)
+
+    def publish(self, obj, topics=None, split=None):
+        """编号后发送并保存到历史中，obj 为 dict。
+
+        topics 为事件所属的主题，None 表示发给所有客户端。
+        split 为 obj 中变化列表的键名，列表中每一项由 item_topics 确定主题，
+        订阅者只收到与其主题相关的项。
+        """
+        self.seq += 1
+        obj['seq'] = self.seq
+        msg = self.prepare(json.dumps(obj))
+        self.history.append((self.seq, msg, obj, topics, split))
+        if topics is None and split is None:
+            for c in self.clients:
+                self.deliver(c, msg, self.seq)
+            return
+        for c in self.everyone:
+            self.deliver(c, msg, self.seq)
+        if split is None:
+            recipients = set()
+            for topic in topics:
+                recipients.update(self.topics.get(topic, ()))
+            for c in recipients:
+                self.deliver(c, msg, self.seq)
+            return
+
+        # 每个主题只生成一次消息；订阅多个主题的客户端单独过滤，避免重复
+        views = defaultdict(list)
+        for item in obj[split]:
+            for topic in self.item_topics(item):
+                if topic in self.topics:
+                    views[topic].append(item)
+        multi = set()
+        for topic, items in views.items():
+            single = [c for c in self.topics[topic] if len(c.topics) == 1]
+            if single:
+                view = self.prepare(json.dumps(self._view(obj, split, items)))
+                for c in single:
+                    self.deliver(c, view, self.seq)
+            multi.update(c for c in self.topics[topic] if len(c.topics) > 1)
+        for c in multi:
+            self._send_filtered(c, self.seq, msg, obj, topics, split)
+
+    @staticmethod
+    def _view(obj, split, items):
+        view = dict(obj)
+        view[split] = items
+        return view
+
+    def _filter(self, client, obj, topics, split):
+        """按客户端的订阅过滤，返回 obj 本身、过滤后的副本或 None。"""
+        if not client.topics or (topics is None and split is None):
+            return obj
+        if split is None:
+            return obj if client.topics.intersection(topics) else None
+        items = [item for item in obj[split] if client.topics.intersection(self.item_topics(item))]
+        return self._view(obj, split, items) if items else None
+
+    def _send_filtered(self, client, seq, msg, obj, topics, split):
+        view = self._filter(client, obj, topics, split)
+        if view is obj:
+            self.deliver(client, msg, seq)
+        elif view is not None:
+            self.deliver(client, self.prepare(json.dumps(view)), seq)
+
+    def snapshot(self, client=None):
+        users = self.state() if self.state is not None else []
+        if client is not None and client.topics:
+            users = [u for u in users if client.topics.intersection(self.item_topics(u))]
+        return {
+            'action': 'snapshot',
+            'version': self.version,
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'topics': sorted(client.topics) if client is not None else [],
+            'users': users
+        }
+
+    def sync(self, client, resume):
+        """向新连接的客户端发送错过的消息，无法续传时发送快照。"""
+        if resume is not None:
+            epoch, since = resume
+            oldest = self.history[0][0] if self.history else self.seq + 1
+            if epoch == self.epoch and oldest - 1 <= since <= self.seq:
+                for seq, msg, obj, topics, split in self.history:
+                    if seq > since:
+                        self._send_filtered(client, seq, msg, obj, topics, split)
+                self.resumed += 1
+                return
+        self.snapshots += 1
+        client.last_seq = self.seq
+        self.write(client, json.dumps(self.snapshot(client)).encode('utf8'))
+
+    def export(self):
+        """交给新进程的序号和历史，重连的客户端可以继续续传。"""
+        return {
+            'epoch': self.epoch,
+            'seq': self.seq,
+            'history': [[seq, obj, topics, split] for seq, _, obj, topics, split in self.history]
+        }
+
+    def restore(self, state):
+        self.epoch = state['epoch']
+        self.seq = state['seq']
+        self.history.clear()
+        for seq, obj, topics, split in state['history']:
+            self.history.append((seq, self.prepare(json.dumps(obj)), obj, topics, split))
+
+    def stats(self):
+        return {
+            'clients': len(self.clients),
+            'subscribed': len(self.clients) - len(self.everyone),
+            'topics': len(self.topics),
+            'seq': self.seq,
+            'history': len(self.history),
+            'resumed': self.resumed,
+            'snapshots': self.snapshots,
+            'queued': sum(c.meter.queued for c in self.clients),
+            'lagging': len(self.lagging),
+            'dropped': self.dropped,
+            'resyncs': self.resyncs,
+            'disconnects': self.disconnects
+        }
+
+    def queues(self):
+        """各客户端的发送缓冲和丢弃的消息数，缓冲最多的在前。"""
+        queues = [{'peer': c.peer, 'queued': c.meter.queued, 'dropped': c.dropped,
+                   'lagging': c.lagging, 'topics': sorted(c.topics)} for c in self.clients]
+        queues.sort(key=lambda q: q['queued'], reverse=True)
+        return queues
+
 
 class BroadcastPreparedServerFactory(BroadcastServerFactory):
 
@@ -91,8 +409,17 @@ class BroadcastPreparedServerFactory(BroadcastServerFactory):
 
     def broadcast(self, msg):
         log.debug("broadcasting prepared message '{}' ..".format(msg))
-        preparedMsg = self.prepareMessage(msg)
+        preparedMsg = self.prepare(msg)
         for c in self.clients:
-            c.sendPreparedMessage(preparedMsg)
+            self.deliver(c, preparedMsg)
             log.debug("prepared message sent to {}".format(c.peer))
 
+    def prepare(self, msg):
+        prepared = self.prepareMessage(msg)
+        prepared.size = len(msg) # 用于 SendMeter 计数
+        return prepared
+
+    def send(self, client, msg):
+        client.sendPreparedMessage(msg)
+        client.meter.sent(msg.size)
+
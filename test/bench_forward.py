@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# 比较 twisted 与 splice 转发引擎的吞吐量和 CPU 开销。
+# 发送端、代理和接收端运行在同一进程中，CPU 时间包含三者，
+# 两种引擎的发送端和接收端开销相同，差值即代理数据通道的差别。
+#
+#     python test/bench_forward.py [MiB]
+
+import logging
+import logging.config
+import resource
+import time
+import sys, os.path as path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from server import logconf, portforward, splicefwd
+
+from twisted.internet import defer, protocol, reactor
+
+
+logging.config.dictConfig(logconf.conf_dict)
+log = logging.getLogger('server.bench_forward')
+
+chunk = 'x' * 65536
+
+
+class Sink(protocol.Protocol):
+    def dataReceived(self, data):
+        self.factory.received += len(data)
+        if self.factory.received >= self.factory.total:
+            self.factory.done.callback(None)
+
+
+class SinkFactory(protocol.Factory):
+    protocol = Sink
+
+    def __init__(self, total):
+        self.total = total
+        self.received = 0
+        self.done = defer.Deferred()
+
+
+class Source(protocol.Protocol):
+    """以拉取方式发送数据，由 transport 的发送缓冲区控制速度。"""
+
+    def connectionMade(self):
+        self.sent = 0
+        self.transport.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.sent >= self.factory.total:
+            self.transport.unregisterProducer()
+            return
+        self.transport.write(chunk)
+        self.sent += len(chunk)
+
+    def stopProducing(self):
+        pass
+
+
+class SourceFactory(protocol.ClientFactory):
+    protocol = Source
+
+    def __init__(self, total):
+        self.total = total
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def run(engine, total):
+    sink = SinkFactory(total)
+    sink_port = reactor.listenTCP(0, sink, interface='127.0.0.1')
+    proxy = portforward.ProxyFactory('127.0.0.1', sink_port.getHost().port, engine)
+    proxy_port = reactor.listenTCP(0, proxy, interface='127.0.0.1')
+
+    start, cpu = time.time(), cpu_time()
+    reactor.connectTCP('127.0.0.1', proxy_port.getHost().port, SourceFactory(total))
+    yield sink.done
+    elapsed, cpu = time.time() - start, cpu_time() - cpu
+
+    proxy.stop()
+    yield proxy_port.stopListening()
+    yield sink_port.stopListening()
+    gbit = total * 8 / 1e9
+    log.info('{:8s} {:8.1f} MiB/s  {:6.2f} CPU s/Gbit'.format(
+        engine, total / elapsed / 2 ** 20, cpu / gbit))
+
+
+@defer.inlineCallbacks
+def main(total):
+    try:
+        yield run('twisted', total)
+        if splicefwd.available():
+            yield run('splice', total)
+        else:
+            log.warning('splice is not available on this platform')
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    mib = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    reactor.callWhenRunning(main, mib * 2 ** 20)
+    reactor.run()
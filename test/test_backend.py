@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+
+import testutil
+from server import backend, inventory, session
+
+from twisted.internet import defer
+from twisted.python import log as twisted_log
+
+
+log = testutil.logger(__file__)
+
+
+class SyncThreads(object):
+    """在当前线程中同步执行，代替 threads.deferToThread。"""
+
+    def deferToThread(self, f, *args):
+        return defer.maybeDeferred(f, *args)
+
+
+class FakeSession(object):
+    def __init__(self, username, password):
+        if password != 'secret':
+            raise session.AuthenticationFailure(username)
+        self.username = username
+        self.project_id = 'p1'
+        self.token = 'token-' + username
+
+
+class Patch(object):
+    """临时替换模块属性，restore 时恢复。"""
+
+    def __init__(self):
+        self.saved = []
+
+    def set(self, obj, name, value):
+        self.saved.append((obj, name, vars(obj)[name]))
+        setattr(obj, name, value)
+
+    def restore(self):
+        for obj, name, value in reversed(self.saved):
+            setattr(obj, name, value)
+
+
+def login(password, fresh=None, vms=None):
+    """登录并返回 (结果列表, 错误列表)。"""
+    def ensure_fresh():
+        if fresh is not None:
+            raise fresh
+
+    def get_vms(project_id):
+        if vms is not None:
+            raise vms
+        return {'vm-1': {u'project_id': project_id}}
+
+    patch = Patch()
+    patch.set(backend, 'threads', SyncThreads())
+    patch.set(session, 'Session', FakeSession)
+    patch.set(inventory, 'ensure_fresh', ensure_fresh)
+    patch.set(inventory, 'get_vms', get_vms)
+    results, errors = [], []
+    try:
+        d = backend.login('alice', password)
+        d.addCallbacks(results.append, errors.append)
+    finally:
+        patch.restore()
+    return results, errors
+
+
+def test_login():
+    results, errors = login('secret')
+    assert errors == []
+    assert results == [{'vms': {'vm-1': {u'project_id': 'p1'}}, 'token': 'token-alice'}]
+
+
+def test_login_errors():
+    unhandled = []
+    observer = lambda event: event.get('isError') and unhandled.append(event)
+    twisted_log.addObserver(observer)
+    # 每种错误只触发一次 errback，得到原始的异常
+    results, errors = login('wrong')
+    assert results == [] and len(errors) == 1 and errors[0].check(session.AuthenticationFailure)
+    results, errors = login('secret', fresh=RuntimeError('nova down'))
+    assert results == [] and len(errors) == 1 and errors[0].check(RuntimeError)
+    results, errors = login('wrong', fresh=RuntimeError('nova down'))
+    assert results == [] and len(errors) == 1
+    results, errors = login('secret', vms=IOError('timeout'))
+    assert results == [] and len(errors) == 1 and errors[0].check(IOError)
+    # 并行的另一个步骤的错误也已处理，不会在回收时报告 Unhandled error
+    del errors
+    gc.collect()
+    twisted_log.removeObserver(observer)
+    assert unhandled == []
+
+
+class QueuedThreads(object):
+    """记录待执行的调用，由测试逐个完成，用于检查并发数。"""
+
+    def __init__(self):
+        self.queue = []
+        self.peak = 0
+
+    def deferToThread(self, f, *args):
+        d = defer.Deferred()
+        self.queue.append((d, f, args))
+        self.peak = max(self.peak, len(self.queue))
+        return d
+
+    def finish(self):
+        d, f, args = self.queue.pop(0)
+        try:
+            result = f(*args)
+        except Exception:
+            d.errback()
+        else:
+            d.callback(result)
+
+
+class FakeUser(object):
+    username = 'alice'
+    project_id = 'p1'
+
+    def power_on(self, vm_id):
+        if vm_id == 'vm-err':
+            raise session.VMError('Nova refused')
+        return vm_id != 'vm-on' # 已开机的VM不发送请求
+
+
+class FakeWaiter(object):
+    def wait(self, vm_id, status, timeout):
+        if vm_id == 'vm-slow':
+            return defer.fail(session.VMError('Action timeout.'))
+        return defer.succeed(status)
+
+
+class FakeFactory(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, msg, topics=None, split=None):
+        self.messages.append((msg, topics))
+
+
+def test_bulk_power():
+    queued = QueuedThreads()
+    wsf = FakeFactory()
+    patch = Patch()
+    patch.set(backend, 'threads', queued)
+    patch.set(backend, '_waiter', FakeWaiter())
+    patch.set(backend, '_wsf', wsf)
+    patch.set(session.Session, 'get', staticmethod(lambda token: FakeUser()))
+    patch.set(inventory, 'lookup_vm', {'vm-1': {u'project_id': 'p1'}}.get)
+    backend.CONF.set_override('bulk_concurrency', 2, 'server')
+    vm_ids = ['vm-1', 'vm-2', 'vm-on', 'vm-err', 'vm-slow']
+    try:
+        reply = backend.bulk_power('token', 'start', vm_ids=vm_ids)
+        assert reply['vms'] == vm_ids
+        # 同时发送的请求不超过 bulk_concurrency
+        assert len(queued.queue) == 2
+        while queued.queue:
+            queued.finish()
+            assert len(queued.queue) <= 2
+    finally:
+        backend.CONF.clear_override('bulk_concurrency', 'server')
+        patch.restore()
+    assert queued.peak == 2
+
+    results = dict((msg['vm'], msg) for msg, _ in wsf.messages if msg['action'] == 'bulk')
+    assert dict((vm, msg['result']) for vm, msg in results.items()) == \
+        {'vm-1': 'done', 'vm-2': 'done', 'vm-on': 'skipped', 'vm-err': 'failed', 'vm-slow': 'failed'}
+    assert results['vm-err']['err'] == 'Nova refused'
+    assert all(msg['job'] == reply['job'] and msg['op'] == 'start' for msg in results.values())
+    # 每个VM的结果发给该VM和所属项目的订阅者
+    topics = dict((msg['vm'], t) for msg, t in wsf.messages if msg['action'] == 'bulk')
+    assert topics['vm-1'] == ['vm:vm-1', 'project:p1'] and topics['vm-2'] == ['vm:vm-2']
+    done, topics = wsf.messages[-1]
+    assert done['action'] == 'bulk_done' and topics is None
+    assert done['summary'] == {'done': 2, 'skipped': 1, 'failed': 2}
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
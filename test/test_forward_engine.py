@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import threading
+import time
+
+import testutil
+from server import port_forward
+
+
+log = testutil.logger(__file__)
+
+
+def echo_server():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    def serve(sock):
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+        sock.close()
+
+    def accept():
+        while True:
+            sock, _ = server.accept()
+            t = threading.Thread(target=serve, args=(sock,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=accept)
+    t.daemon = True
+    t.start()
+    return server.getsockname()[1]
+
+
+def recv_exactly(sock, size):
+    chunks = []
+    while size:
+        data = sock.recv(min(size, 65536))
+        assert data, 'connection closed early'
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+
+def test_forward():
+    echo_port = echo_server()
+    proxy = port_forward.ServerProxy()
+    port = proxy.add_proxy('127.0.0.1', echo_port, '127.0.0.1')
+    try:
+        payload = os.urandom(4 * 1024 * 1024)
+        clients = [socket.create_connection(('127.0.0.1', port)) for _ in range(4)]
+        for sock in clients:
+            sock.settimeout(10)
+        # 同时发送多个连接的数据，接收前写满缓冲区以触发背压
+        senders = [threading.Thread(target=sock.sendall, args=(payload,)) for sock in clients]
+        for t in senders:
+            t.start()
+        for sock in clients:
+            assert recv_exactly(sock, len(payload)) == payload
+        for t in senders:
+            t.join()
+        for sock in clients:
+            sock.close()
+    finally:
+        proxy.delete_proxy(port)
+    assert port not in proxy.server_list
+
+
+def test_unreachable_destination():
+    proxy = port_forward.ServerProxy()
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    dead_port = probe.getsockname()[1]
+    probe.close()
+    port = proxy.add_proxy('127.0.0.1', dead_port, '127.0.0.1')
+    try:
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.settimeout(5)
+        assert sock.recv(10) == ''
+        sock.close()
+    finally:
+        proxy.delete_proxy(port)
+
+
+def test_half_closed_client():
+    # 目标端先不读取，客户端发送完后关闭写方向，代理中还有待发送的数据。
+    # 调大 max_queued，使代理在队列非空时仍继续读到 EOF
+    saved, port_forward.max_queued = port_forward.max_queued, 64 * 1024 * 1024
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    proxy = port_forward.ServerProxy()
+    port = proxy.add_proxy('127.0.0.1', server.getsockname()[1], '127.0.0.1')
+    try:
+        payload = os.urandom(16 * 1024 * 1024)
+        client = socket.create_connection(('127.0.0.1', port))
+        upstream, _ = server.accept()
+        client.sendall(payload)
+        client.shutdown(socket.SHUT_WR)
+        listener = proxy.server_list[port]
+        deadline = time.time() + 5
+        while not any(c.closing for c in listener.channels) and time.time() < deadline:
+            time.sleep(0.01)
+        assert any(c.queued for c in listener.channels)
+        # 读到 EOF 后不应再被 epoll 反复唤醒
+        start = sum(os.times()[:2])
+        time.sleep(0.5)
+        assert sum(os.times()[:2]) - start < 0.2
+        upstream.settimeout(10)
+        assert recv_exactly(upstream, len(payload)) == payload
+        assert upstream.recv(10) == ''
+        upstream.close()
+        client.close()
+    finally:
+        proxy.delete_proxy(port)
+        server.close()
+        port_forward.max_queued = saved
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
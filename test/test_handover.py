@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+import testutil
+from server import backend, handover, twist_forward
+
+from twisted.internet import defer, protocol, reactor
+
+
+log = testutil.logger(__file__)
+
+
+class FakeForward(object):
+    pool = None
+
+    def __init__(self):
+        self.forwardlist = {}
+
+
+class NewForward(FakeForward):
+    """新进程一侧的转发，接管代理时创建真实的 Proxy。"""
+
+    adoptProxy = twist_forward.ForwardInst.__dict__['adoptProxy']
+
+    def __init__(self):
+        FakeForward.__init__(self)
+        self.allocator = twist_forward.PortAllocator(0, 0)
+        self.engine = 'twisted'
+        self.limiter = None
+
+
+class Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+def fake_state():
+    return {
+        'sessions': [{'token': 't1', 'username': 'alice', 'project_id': 'p1',
+                      'created': 100.0, 'last_access': 200.0}],
+        'monitor': [{'user': 'alice', 'online': True, 'vm': 'vm-1', 'vm_ip': '10.0.0.1',
+                     'client_ip': '192.168.0.2', 'project_id': 'p1', 'host': 'node-1',
+                     'last_update': 200.0}],
+        'websocket': {'epoch': 1, 'seq': 7, 'history': []}
+    }
+
+
+def test_receiver_lines():
+    receiver = handover.Receiver()
+    items = []
+    receiver.received.addCallback(items.extend)
+    r, w = os.pipe()
+    receiver.fileDescriptorReceived(r)
+    receiver.fileDescriptorReceived(w)
+    # 一行可能分多次收到，fds 按顺序分给各条消息
+    receiver.dataReceived('{"type": "http", "fds": 1}\n{"type": "conn", "fds"')
+    receiver.dataReceived(': 1, "port": 40001}\n{"type": "end", "fds": 0}\n')
+    assert [(msg['type'], fds) for msg, fds in items] == [('http', [r]), ('conn', [w])]
+    os.close(r)
+    os.close(w)
+
+
+def test_adopt_waits_for_sessions():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+    resumed = defer.Deferred()
+    restore = backend.restore_session_state
+    backend.restore_session_state = lambda state: resumed
+    try:
+        items = [({'type': 'http', 'fds': 1}, [os.dup(sock.fileno())]),
+                 (dict(fake_state(), type='state', fds=0), [])]
+        http_port = handover.adopt(items, protocol.Factory())
+        # 会话恢复之前不接受新连接
+        assert http_port not in reactor.getReaders()
+        resumed.callback(None)
+        assert http_port in reactor.getReaders()
+        assert http_port.getHost().port == sock.getsockname()[1]
+        http_port.stopListening()
+    finally:
+        backend.restore_session_state = restore
+        sock.close()
+
+
+def spin(done, timeout=10):
+    """运行 reactor 直到 done() 为真。"""
+    deadline = time.time() + timeout
+    while not done():
+        assert time.time() < deadline, 'timeout'
+        reactor.iterate(0.01)
+
+
+def stop_listening(port):
+    """停止监听并等待完成，UNIX socket 文件随后才被删除。"""
+    stopped = []
+    defer.maybeDeferred(port.stopListening).addBoth(stopped.append)
+    spin(lambda: stopped)
+
+
+def test_round_trip():
+    # 同一进程中运行旧进程和新进程两端，Sender 收到确认后退出
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'run', 'handover.sock')
+    http = reactor.listenTCP(0, protocol.Factory(), interface='127.0.0.1')
+    state = {'forward': FakeForward(), 'gateway': None, 'gateway_port': None,
+             'connections': {'vm-1': 40001}}
+    saved = backend.forwarding_state, backend.session_state
+    backend.forwarding_state = lambda: state
+    backend.session_state = fake_state
+    result = {}
+
+    def received(inherited):
+        receiver, items = inherited
+        for msg, fds in items:
+            result[msg['type']] = msg
+            if msg['type'] == 'http':
+                sock = socket.fromfd(fds[0], socket.AF_INET, socket.SOCK_STREAM)
+                result['port'] = sock.getsockname()[1]
+                sock.close()
+            for fd in fds:
+                os.close(fd)
+        receiver.finish()
+
+    try:
+        listener = handover.serve(path, http)
+        listener.factory.exit = lambda: result.setdefault('exit', True)
+        # socket 和新建的目录只有本用户可以访问
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+        assert stat.S_IMODE(os.stat(os.path.dirname(path)).st_mode) == 0o700
+        d = handover.takeover(path)
+        d.addCallback(received)
+        d.addErrback(lambda failure: result.setdefault('error', failure))
+        spin(lambda: 'exit' in result or 'error' in result)
+        assert 'error' not in result, result.get('error')
+        stop_listening(listener)
+    finally:
+        backend.forwarding_state, backend.session_state = saved
+        http.stopListening()
+        shutil.rmtree(tmp)
+
+    assert result['port'] == http.getHost().port
+    assert result['connections']['map'] == {'vm-1': 40001}
+    assert json.loads(json.dumps(fake_state())) == \
+        dict((k, result['state'][k]) for k in ('sessions', 'monitor', 'websocket'))
+    # 旧进程交出后清空转发状态
+    assert state['connections'] == {}
+
+
+def test_pool_refused():
+    # 转发进程中的连接无法交接，新进程收到拒绝，不接管任何 socket
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'handover.sock')
+    forward = FakeForward()
+    forward.pool = object()
+    http = reactor.listenTCP(0, protocol.Factory(), interface='127.0.0.1')
+    state = {'forward': forward, 'gateway': None, 'gateway_port': None, 'connections': {}}
+    saved = backend.forwarding_state
+    backend.forwarding_state = lambda: state
+    result = []
+    try:
+        listener = handover.serve(path, http)
+        handover.takeover(path).addBoth(result.append)
+        spin(lambda: result)
+        stop_listening(listener)
+    finally:
+        backend.forwarding_state = saved
+        http.stopListening()
+        shutil.rmtree(tmp)
+    assert result[0].check(handover.HandoverRefused)
+    assert 'forwarding workers' in result[0].getErrorMessage()
+    assert listener.factory.active is None
+
+
+def test_live_pair():
+    # 客户端经代理连接 echo 服务器，持续收发数据时交接，数据不丢失也不重复
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'handover.sock')
+    echo_factory = protocol.Factory()
+    echo_factory.protocol = Echo
+    echo = reactor.listenTCP(0, echo_factory, interface='127.0.0.1')
+    http = reactor.listenTCP(0, protocol.Factory(), interface='127.0.0.1')
+    old, new = FakeForward(), NewForward()
+    proxy = twist_forward.Proxy('127.0.0.1', echo.getHost().port, '127.0.0.1',
+                                twist_forward.PortAllocator(0, 0))
+    old.forwardlist[proxy.getport()] = proxy
+    state = {'forward': old, 'gateway': None, 'gateway_port': None, 'connections': {}}
+    saved = (backend.forwarding_state, backend.session_state,
+             backend.restore_session_state, backend.restore_connections)
+    backend.forwarding_state = lambda: state
+    backend.session_state = fake_state
+    backend.restore_session_state = lambda msg: None
+    backend.restore_connections = lambda map: None
+
+    sent, received = [], []
+    stop = threading.Event()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(('127.0.0.1', proxy.getport()))
+
+    def send():
+        for n in range(4000):
+            if stop.is_set():
+                break
+            chunk = '{:08d}'.format(n) * 128
+            sock.sendall(chunk)
+            sent.append(chunk)
+            time.sleep(0.001)
+
+    def receive():
+        # 读得比发送慢，回显的数据积压在代理的发送缓冲中
+        while True:
+            data = sock.recv(1024)
+            if not data:
+                break
+            received.append(data)
+            if stop.is_set() and not writer.is_alive() and \
+                    sum(len(d) for d in received) >= sum(len(c) for c in sent):
+                break
+            time.sleep(0.002)
+
+    result = {}
+
+    def taken(inherited):
+        receiver, items = inherited
+        state['forward'] = new
+        try:
+            result['http'] = handover.adopt(items, protocol.Factory())
+        finally:
+            state['forward'] = old
+        receiver.finish()
+
+    writer, reader = threading.Thread(target=send), threading.Thread(target=receive)
+    writer.start()
+    reader.start()
+    try:
+        spin(lambda: proxy.new_proxy.proxy)
+        server = list(proxy.new_proxy.proxy)[0]
+        server.transport.getHandle().setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        # 代理中有尚未写出的数据时开始交接
+        spin(lambda: len(sent) > 1000 and server.transport in reactor.getWriters())
+        listener = handover.serve(path, http)
+        listener.factory.exit = lambda: result.setdefault('exit', True)
+        d = handover.takeover(path)
+        d.addCallback(taken)
+        d.addErrback(lambda failure: result.setdefault('error', failure))
+        spin(lambda: 'exit' in result or 'error' in result)
+        assert 'error' not in result, result.get('error')
+        stop_listening(listener)
+        assert old.forwardlist == {}
+        assert list(new.forwardlist) == [proxy.getport()]
+        assert len(new.forwardlist[proxy.getport()].new_proxy.proxy) == 1
+        # 交接之后由新进程的代理继续转发
+        moved = len(sent)
+        spin(lambda: len(sent) > moved + 100 or not writer.is_alive())
+        stop.set()
+        spin(lambda: not reader.is_alive(), 30)
+    finally:
+        stop.set()
+        writer.join(30)
+        sock.shutdown(socket.SHUT_RDWR)
+        reader.join(30)
+        sock.close()
+        backend.forwarding_state, backend.session_state, \
+            backend.restore_session_state, backend.restore_connections = saved
+        for p in new.forwardlist.values():
+            p.stop()
+        if 'http' in result:
+            result['http'].stopListening()
+        echo.stopListening()
+        http.stopListening()
+        shutil.rmtree(tmp)
+
+    assert ''.join(received) == ''.join(sent)
+
+
+def test_socket_dir():
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chmod(tmp, 0o755)
+        try:
+            handover.serve(os.path.join(tmp, 'handover.sock'), None)
+        except handover.HandoverError:
+            pass
+        else:
+            assert False, 'serving in a directory readable by others'
+        assert os.listdir(tmp) == []
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_other_user_refused():
+    # 其它用户的进程连接时不发送任何 socket 和状态，需要 root 权限切换用户
+    if os.getuid() != 0:
+        log.warning('Not root, skipped')
+        return
+    tmp = tempfile.mkdtemp()
+    os.chmod(tmp, 0o711)
+    path = os.path.join(tmp, 'handover.sock')
+    http = reactor.listenTCP(0, protocol.Factory(), interface='127.0.0.1')
+    state = {'forward': FakeForward(), 'gateway': None, 'gateway_port': None, 'connections': {}}
+    saved = backend.forwarding_state, backend.session_state
+    backend.forwarding_state = lambda: state
+    backend.session_state = fake_state
+    # 直接监听，跳过 serve 对目录和 socket 权限的限制
+    factory = handover.SenderFactory(http)
+    listener = reactor.listenUNIX(path, factory, mode=0o666)
+    try:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.setuid(65534)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(path)
+                sock.sendall('{"type": "done"}\n')
+                code = 0 if sock.recv(4096) == '' else 2
+            finally:
+                os._exit(code)
+        exited = []
+
+        def reaped():
+            if not exited:
+                done, status = os.waitpid(pid, os.WNOHANG)
+                if done:
+                    exited.append(status)
+            return exited
+        spin(reaped)
+    finally:
+        stop_listening(listener)
+        backend.forwarding_state, backend.session_state = saved
+        shutil.rmtree(tmp)
+    # 连接被关闭，没有收到数据，旧进程继续服务
+    assert exited == [0]
+    assert factory.active is None and http in reactor.getReaders()
+    http.stopListening()
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import inventory, session
+
+
+log = testutil.logger(__file__)
+
+
+class FakeVM(object):
+    def __init__(self, vm_id, project_id, status='ACTIVE', ip=None, host='node-1'):
+        self.id = vm_id
+        self.name = vm_id
+        self.status = status
+        self.project_id = project_id
+        self.addresses = {'net': [{'OS-EXT-IPS:type': 'fixed', 'addr': '172.16.0.1'}]}
+        if ip is not None:
+            self.addresses['net'].append({'OS-EXT-IPS:type': 'floating', 'addr': ip})
+        self.host = host
+
+    def __getitem__(self, key):
+        assert key == 'OS-EXT-SRV-ATTR:hypervisor_hostname'
+        return self.host
+
+
+class FakeCompute(object):
+    def __init__(self, vms):
+        self.vms = vms
+        self.queries = []
+
+    def servers(self, details=False, **query):
+        self.queries.append(dict(query, details=details))
+        return iter(self.vms)
+
+
+def test_admin_get_vms():
+    admin = session.AdminSession.__new__(session.AdminSession)
+    admin.username, admin.project_id = 'admin', 'admin'
+    admin.conn = admin
+    admin.compute = compute = FakeCompute([FakeVM('vm-1', 'p1', ip='10.0.0.1'),
+                                           FakeVM('vm-2', 'p2', 'SHUTOFF', host=None)])
+    saved = session.lookup_host_ip
+    session.lookup_host_ip = {'node-1': '192.168.1.1'}.get
+    try:
+        vms = admin.get_vms(all_projects=True)
+    finally:
+        session.lookup_host_ip = saved
+    # 一次详细列表请求，服务器名称来自列表结果
+    assert compute.queries == [{'details': True, 'all_projects': True, 'limit': admin.page_size}]
+    assert vms['vm-1'] == {u'name': 'vm-1', u'status': 'ACTIVE', u'floating_ips': ['10.0.0.1'],
+                           u'project_id': 'p1', u'os': 'win', u'host_name': 'node-1',
+                           u'spice_ip': '192.168.1.1'}
+    assert vms['vm-2'][u'host_name'] is None and vms['vm-2'][u'spice_ip'] is None
+    assert inventory.first_ip(vms['vm-1']) == '10.0.0.1'
+    assert inventory.first_ip(vms['vm-2']) is None and inventory.first_ip(None) is None
+
+
+class FakeAdmin(object):
+    def __init__(self):
+        self.vms = []
+        self.changes = []
+        self.queries = []
+
+    def list_servers(self, all_projects=False, changes_since=None):
+        self.queries.append(changes_since)
+        return self.vms if changes_since is None else self.changes
+
+
+def test_directory():
+    admin = FakeAdmin()
+    admin.vms = [FakeVM('vm-1', 'p1', ip='10.0.0.1'), FakeVM('vm-2', 'p1')]
+    directory = inventory.VMDirectory(30, 3600)
+    directory._admin = lambda: admin
+    saved = session.lookup_host_ip
+    session.lookup_host_ip = lambda host_name: None
+    try:
+        assert sorted(directory.get_vms('p1')) == ['vm-1', 'vm-2']
+        assert admin.queries == [None]
+        # 数据未过旧时直接从内存返回
+        assert directory.get_vm_ip('vm-1') == '10.0.0.1' and admin.queries == [None]
+
+        # 增量刷新：状态变化、换项目和删除
+        admin.changes = [FakeVM('vm-1', 'p1', 'SHUTOFF', ip='10.0.0.1'), FakeVM('vm-2', 'p2'),
+                         FakeVM('vm-3', 'p2', 'DELETED')]
+        directory.refresh()
+        assert admin.queries[1] is not None
+        assert directory.lookup_vm('vm-1')[u'status'] == 'SHUTOFF'
+        assert directory.lookup_project_vms('p1') == ['vm-1']
+        assert directory.lookup_project_vms('p2') == ['vm-2']
+        admin.changes = [FakeVM('vm-2', 'p2', 'SOFT_DELETED')]
+        directory.refresh()
+        assert directory.lookup_vm('vm-2') is None and directory.lookup_project_vms('p2') == []
+        assert directory.stats()['deltas'] == 4
+
+        # 数据过旧时先刷新，未命中的VM很快再刷新一次
+        directory.synced -= 31
+        directory.get_vm('vm-1')
+        assert len(admin.queries) == 4
+        directory.get_vm('vm-9')
+        assert len(admin.queries) == 4
+        directory.synced -= directory.miss_refresh_interval + 1
+        directory.get_vm('vm-9')
+        assert len(admin.queries) == 5
+
+        # 超过全量同步间隔后重新列出所有VM
+        admin.vms = [FakeVM('vm-4', 'p3')]
+        directory.full_synced -= 3601
+        directory.refresh()
+        assert admin.queries[-1] is None and directory.all_vms().keys() == ['vm-4']
+        assert directory.stats()['full_syncs'] == 2
+    finally:
+        session.lookup_host_ip = saved
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+import testutil
+from server import portforward, twist_forward
+
+from twisted.internet import error
+from twisted.python.failure import Failure
+
+
+log = testutil.logger(__file__)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.closed = False
+
+    def pauseProducing(self):
+        pass
+
+    def loseConnection(self):
+        self.closed = True
+
+
+class FakePool(object):
+    def __init__(self, connections):
+        self.usage = connections
+        self.refusing = set()
+
+    def connections(self, port):
+        return self.usage.get(port, 0)
+
+    def limit(self, ports):
+        self.refusing = set(ports)
+
+
+class FakeReactor(object):
+    def __init__(self):
+        self.dialed = []
+
+    def connectTCP(self, host, port, factory, timeout=30):
+        self.dialed.append((host, port))
+        return None
+
+
+class FakeProxy(object):
+    def __init__(self, idle, user=None):
+        self.idle = idle
+        self.user = user
+        self.stopped = False
+
+    def idleTime(self, now):
+        return self.idle
+
+    def stop(self):
+        self.stopped = True
+
+
+def connect(factory, reactor):
+    server = factory.buildProtocol(None)
+    server.reactor = reactor
+    server.makeConnection(FakeTransport())
+    return server
+
+
+def test_limiter():
+    limiter = twist_forward.ConnectionLimiter(3, 2)
+    assert limiter.acquire('alice') and limiter.acquire('alice')
+    assert not limiter.acquire('alice')
+    # 总数限制对所有用户生效
+    assert limiter.acquire('bob')
+    assert not limiter.acquire('carol')
+    limiter.release('alice')
+    assert limiter.acquire('carol')
+    assert limiter.stats() == {'connections': 3, 'users': 3, 'rejected': 2}
+    for user in ('alice', 'bob', 'carol'):
+        limiter.release(user)
+    assert limiter.users == {} and limiter.total == 0
+    # 0 表示不限制
+    limiter = twist_forward.ConnectionLimiter(0, 0)
+    assert all(limiter.acquire('alice') for _ in range(100))
+
+
+def test_remote_connections():
+    # 转发进程报告的连接与主进程中的连接一起计数
+    limiter = twist_forward.ConnectionLimiter(5, 2)
+    assert limiter.acquire('alice')
+    limiter.update({'alice': 1, 'bob': 2}, 3)
+    assert limiter.full('alice') and limiter.full('bob') and not limiter.full('carol')
+    assert not limiter.acquire('alice')
+    assert limiter.stats() == {'connections': 4, 'users': 2, 'rejected': 4}
+    assert limiter.acquire('carol') and limiter.full(None)
+    # 转发进程中的连接关闭后可以再建立
+    limiter.update({'bob': 1}, 0)
+    assert not limiter.full('carol') and limiter.stats()['connections'] == 3
+
+
+def test_pool_limits():
+    forward = twist_forward.ForwardInst()
+    saved = forward.pool, forward.limiter, forward.forwardlist
+    forward.pool = FakePool({40001: 2, 40002: 1, 40003: 0})
+    forward.limiter = twist_forward.ConnectionLimiter(10, 2)
+    forward.forwardlist = {40001: FakeProxy(0, 'alice'), 40002: FakeProxy(0, 'bob'),
+                           40003: FakeProxy(0, 'alice')}
+    try:
+        # 达到每用户限制的用户的所有端口都拒绝新连接
+        forward.applyLimits(5)
+        assert forward.limiter.remote == {'alice': 2, 'bob': 1}
+        assert forward.pool.refusing == set([40001, 40003])
+        assert forward.limiter.stats() == {'connections': 3, 'users': 2, 'rejected': 5}
+        # 连接关闭后恢复
+        forward.pool.usage[40001] = 1
+        forward.applyLimits(0)
+        assert forward.pool.refusing == set()
+        # 总数达到限制时所有端口都拒绝
+        forward.limiter.max_total = 2
+        forward.applyLimits(0)
+        assert forward.pool.refusing == set([40001, 40002, 40003])
+    finally:
+        forward.pool, forward.limiter, forward.forwardlist = saved
+
+
+def test_proxy_limit():
+    reactor = FakeReactor()
+    factory = portforward.ProxyFactory('10.0.0.1', 3389, user='alice', vm_id='vm-1')
+    factory.limiter = twist_forward.ConnectionLimiter(0, 1)
+    first = connect(factory, reactor)
+    second = connect(factory, reactor)
+    # 超过限制的连接直接关闭，不连接VM，也不记录为代理连接
+    assert reactor.dialed == [('10.0.0.1', 3389)]
+    assert second.transport.closed and not second.noisy
+    assert factory.proxy == set([first])
+    lost = Failure(error.ConnectionDone())
+    second.connectionLost(lost)
+    assert factory.limiter.total == 1
+    first.connectionLost(lost)
+    assert factory.limiter.total == 0 and factory.limiter.stats()['rejected'] == 1
+    assert factory.idle_since is not None
+    connect(factory, reactor)
+    assert len(reactor.dialed) == 2
+
+
+def test_reap_idle_proxies():
+    forward = twist_forward.ForwardInst()
+    forward.idle_timeout = 60
+    reaped = []
+    forward.onReap = reaped.append
+    idle, busy = FakeProxy(61), FakeProxy(0)
+    forward.forwardlist = {40001: idle, 40002: busy}
+    forward.reapIdle()
+    assert reaped == [40001] and idle.stopped and not busy.stopped
+    assert forward.forwardlist == {40002: busy}
+    assert forward.reaped == 1
+
+
+def test_factory_idle_time():
+    factory = portforward.ProxyFactory('10.0.0.1', 3389)
+    now = time.time()
+    assert factory.idleTime(now + 10) >= 10
+    server = object()
+    factory.opened(server)
+    assert factory.idleTime(now + 10) == 0
+    factory.closed(server)
+    assert 0 <= factory.idleTime(time.time()) < 1
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -1,32 +1,101 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import logging
-import logging.config
-import random
-import time
-import sys, os.path as path 
-sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
-from server import user_monitor, logconf
+import json
 
+import testutil
+from server import user_monitor
+
+from twisted.internet import task
+
+
+log = testutil.logger(__file__)
+
+
+class FakeFactory(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, msg, **kwargs):
+        self.messages.append(json.loads(json.dumps(msg)))
 
-logging.config.dictConfig(logconf.conf_dict)
-log = logging.getLogger('server.test_os')
 
 def test():
-    umt = user_monitor.UserMonitor()
+    clock = task.Clock()
+    wsf = FakeFactory()
+    umt = user_monitor.UserMonitor(wsf, timeout=30, interval=5, clock=clock)
+    umt.start()
+    for n in range(5):
+        umt.update_connection('user-{}'.format(n), 'ip-{}'.format(n))
+    clock.advance(5)
+    assert len(wsf.messages) == 5 and all(m['online'] for m in wsf.messages)
+
+    # user-0 保持心跳，其他用户超时下线
+    for _ in range(7):
+        umt.update_connection('user-0', 'ip-0')
+        clock.advance(5)
+    offline = [m['user'] for m in wsf.messages[5:]]
+    assert sorted(offline) == ['user-{}'.format(n) for n in range(1, 5)]
+    assert [u for u, _, _ in umt.status()] == ['user-0']
+    umt.stop()
+
+
+def test_batch():
+    clock = task.Clock()
+    wsf = FakeFactory()
+    umt = user_monitor.UserMonitor(wsf, timeout=30, interval=5, notify_window=0.1, clock=clock)
+    for n in range(100):
+        umt.notify('user-{}'.format(n % 10))
+    assert wsf.messages == []
+    clock.advance(0.1)
+    # 一条消息，每个用户只保留最新状态
+    assert len(wsf.messages) == 1
+    msg = wsf.messages[0]
+    assert msg['action'] == 'notify_batch' and len(msg['changes']) == 10
+    assert umt.batcher.stats()['coalesced'] == 90
+
+
+def test_vm_topics():
+    vms = {'vm-1': {u'project_id': 'p1', u'host_name': 'node-1', u'floating_ips': ['10.0.0.1']}}
+    lookup = user_monitor.inventory.lookup_vm
+    user_monitor.inventory.lookup_vm = vms.get
+    try:
+        clock = task.Clock()
+        wsf = FakeFactory()
+        umt = user_monitor.UserMonitor(wsf, timeout=30, interval=5, clock=clock)
+        umt.update_connection('alice', 'ip-0', 'vm-1')
+        assert umt.snapshot()[0]['ip_addr'] == '10.0.0.1'
+        assert user_monitor.topics_of(umt.snapshot()[0]) == \
+            ['user:alice', 'vm:vm-1', 'project:p1', 'host:node-1']
+        # 不在目录中的VM不沿用上一个VM的项目和服务器
+        umt.update_connection('alice', 'ip-0', 'vm-9')
+        assert user_monitor.topics_of(umt.snapshot()[0]) == ['user:alice', 'vm:vm-9']
+    finally:
+        user_monitor.inventory.lookup_vm = lookup
+
+
+def test_handover():
+    clock = task.Clock()
+    wsf = FakeFactory()
+    umt = user_monitor.UserMonitor(wsf, timeout=30, interval=5, clock=clock)
+    umt.update_connection('alice', 'ip-0')
+    clock.advance(20)
+    state = json.loads(json.dumps(umt.export()))
+
+    # 新进程按原来的最后心跳时间计时，10 秒后超时
+    clock = task.Clock()
+    clock.advance(20)
+    wsf = FakeFactory()
+    umt = user_monitor.UserMonitor(wsf, timeout=30, interval=5, clock=clock)
     umt.start()
-    for i in range(3):
-        for n in range(5):
-            user = 'user-{}'.format(n)
-            ip = 'ip-{}'.format(n)
-            vm = 'vm-{}'.format(n)
-            umt.update_connection(user, ip, vm)
-            log.debug('-- [heartbeat] --> {} {} {}'.format(user, ip, vm))
-            pause = random.randint(3, 10)
-            time.sleep(pause)
+    umt.restore(state)
+    assert [u for u, _, _ in umt.status()] == ['alice']
+    clock.advance(5)
+    assert wsf.messages == []
+    clock.advance(5)
+    assert [(m['user'], m['online']) for m in wsf.messages] == [('alice', False)]
     umt.stop()
 
 
 if __name__ == '__main__':
-    test()
+    testutil.run(globals())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+
+import testutil
+from server import twist_forward
+
+from twisted.internet import protocol
+
+
+log = testutil.logger(__file__)
+
+
+def port_range(count):
+    """找一段连续的空闲端口。"""
+    for start in range(41000, 60000, count):
+        socks = []
+        try:
+            for port in range(start, start + count):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                socks.append(sock)
+                sock.bind(('127.0.0.1', port))
+        except socket.error:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+        return start, start + count - 1
+    raise IOError('No free port range')
+
+
+def test_allocate():
+    low, high = port_range(3)
+    allocator = twist_forward.PortAllocator(low, high)
+    factory = protocol.Factory()
+    # 被其他程序占用的端口跳过并放到队尾
+    busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    busy.bind(('127.0.0.1', low))
+    busy.listen(1)
+    first = allocator.listen(factory, '127.0.0.1')
+    second = allocator.listen(factory, '127.0.0.1')
+    assert [first.getHost().port, second.getHost().port] == [low + 1, low + 2]
+    assert allocator.stats()['collisions'] == 1
+    try:
+        allocator.listen(factory, '127.0.0.1')
+        assert False, 'range is exhausted'
+    except IOError:
+        pass
+    assert allocator.stats()['exhausted'] == 1
+    busy.close()
+
+    # 释放的端口最晚重用
+    first.stopListening()
+    allocator.release(low + 1)
+    third = allocator.listen(factory, '127.0.0.1')
+    assert third.getHost().port == low
+    assert list(allocator.free) == [low + 1]
+    allocator.adopt(low + 1)
+    assert allocator.stats()['used'] == 3 and allocator.stats()['free'] == 0
+    second.stopListening()
+    third.stopListening()
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import portforward
+
+from twisted.internet import error, task
+from twisted.python.failure import Failure
+
+
+log = testutil.logger(__file__)
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.closed = False
+        self.producer = None
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def write(self, data):
+        pass
+
+    def loseConnection(self):
+        self.closed = True
+
+
+class FakeReactor(task.Clock):
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.dialed = []
+
+    def connectTCP(self, host, port, factory, timeout=30):
+        self.dialed.append(factory)
+        return None
+
+
+def predialed(factory, reactor):
+    """预先连接并完成握手，返回等待中的 ProxyClient。"""
+    factory.predial(15)
+    client = reactor.dialed[-1].buildProtocol(None)
+    client.makeConnection(FakeTransport())
+    return client
+
+
+def make_factory():
+    reactor = FakeReactor()
+    factory = portforward.ProxyFactory('10.0.0.1', 3389, user='alice', vm_id='vm-1')
+    factory.reactor = reactor
+    return factory, reactor
+
+
+def test_first_client_takes_warm():
+    factory, reactor = make_factory()
+    client = predialed(factory, reactor)
+    assert factory.warm is client and factory.dialing is None
+    server = factory.buildProtocol(None)
+    server.reactor = reactor
+    server.makeConnection(FakeTransport())
+    # 使用预先建立的连接，不再连接VM
+    assert len(reactor.dialed) == 1
+    assert server.peer is client and client.peer is server and not client.warm
+    assert factory.warm is None and reactor.getDelayedCalls() == []
+    assert (factory.predials, factory.predial_hits) == (1, 1)
+    # 第二个客户端自己连接
+    server = factory.buildProtocol(None)
+    server.reactor = reactor
+    server.makeConnection(FakeTransport())
+    assert len(reactor.dialed) == 2
+
+
+def test_expire():
+    factory, reactor = make_factory()
+    client = predialed(factory, reactor)
+    reactor.advance(14)
+    assert factory.warm is client
+    reactor.advance(1)
+    assert factory.warm is None and client.transport.closed
+    assert factory.takeWarm() is None
+
+
+def test_destination_spoke_first():
+    factory, reactor = make_factory()
+    client = predialed(factory, reactor)
+    client.dataReceived('unexpected')
+    # RDP 服务器不会先发送数据，不使用这个连接
+    assert factory.takeWarm() is None
+    assert client.transport.closed and factory.predial_hits == 0
+
+
+def test_warm_lost_and_failed():
+    factory, reactor = make_factory()
+    client = predialed(factory, reactor)
+    client.connectionLost(Failure(error.ConnectionDone()))
+    assert factory.warm is None and reactor.getDelayedCalls() == []
+    factory.predial(15)
+    reactor.dialed[-1].clientConnectionFailed(None, Failure(error.ConnectionRefusedError()))
+    assert factory.dialing is None and factory.takeWarm() is None
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
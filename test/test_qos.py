@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import qos
+
+
+log = testutil.logger(__file__)
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = qos.TokenBucket(1000, 2000, clock)
+    # 突发量之内不限速
+    assert bucket.consume(1500) == 0
+    assert bucket.consume(500) == 0
+    # 透支 1000 字节，需要等待 1 秒
+    assert bucket.consume(1000) == 1.0
+    clock.now = 1.0
+    assert bucket.consume(0) == 0
+    # 长时间空闲后最多积累 burst
+    clock.now = 100.0
+    assert bucket.consume(2000) == 0
+    assert bucket.consume(500) == 0.5
+    assert bucket.throttled == 2
+
+
+def test_interactive_class():
+    clock = Clock()
+    shaper = qos.Shaper(1000, 2, share=0.2, small=100, clock=clock)
+    # 批量数据透支，只在批量份额 800 字节/秒内计算
+    assert shaper.up.consume(1600) == 0
+    assert shaper.up.consume(800) == 1.0
+    # 交互数据使用预留的份额，不等待批量数据的欠额
+    assert shaper.up.consume(50) == 0
+    assert shaper.up.consume(100) == 0
+    assert shaper.up.consume(300) == 1.375 # 超过 small 的按批量计算
+    assert shaper.up.throttled == 2
+    # share 为 0 时只有一类
+    shaper = qos.Shaper(1000, 2, clock=clock)
+    assert shaper.up.consume(2000) == 0
+    assert shaper.up.consume(10) == 0.01
+    # 份额为 1 时批量数据仍保留一部分速率，不会除以 0
+    shaper = qos.Shaper(1000, 2, share=1.0, small=100, clock=clock)
+    assert abs(shaper.up.bulk.rate - 100) < 1e-6
+    assert shaper.up.consume(150) == 0
+    assert abs(shaper.up.consume(250) - 2.0) < 1e-6
+
+
+def test_shaper():
+    qos.CONF([])
+    qos.CONF.set_override('policy_rates', {'1': '100'}, 'qos')
+    qos.CONF.set_override('user_rates', {'admin': '0'}, 'qos')
+    assert qos.shaper('alice', 0) is None
+    assert qos.shaper('admin', 1) is None
+    shaper = qos.shaper('alice', 1)
+    assert shaper.up.rate == 100 * 1024
+    assert qos.shaper('alice', 1) is shaper
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
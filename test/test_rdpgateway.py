@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+
+import testutil
+from server import rdpgateway
+
+
+log = testutil.logger(__file__)
+
+NEG_REQ = '\x01\x00\x08\x00\x03\x00\x00\x00'
+
+
+def connection_request(cookie):
+    body = '\xe0\x00\x00\x00\x00\x00' + cookie + NEG_REQ
+    return struct.pack('!BBHB', 3, 0, 5 + len(body), len(body)) + body
+
+
+def test_routing_token():
+    data = connection_request('Cookie: msts=abc123\r\n')
+    token, pdu, rest = rdpgateway.parse_connection_request(data + 'more')
+    assert token == 'abc123'
+    assert pdu == connection_request('')
+    assert rest == 'more'
+
+
+def test_mstshash_and_plain():
+    data = connection_request('Cookie: mstshash=user1\r\n')
+    assert rdpgateway.parse_connection_request(data)[0] == 'user1'
+    data = connection_request('')
+    assert rdpgateway.parse_connection_request(data) == (None, data, '')
+
+
+def test_incomplete_and_invalid():
+    data = connection_request('Cookie: msts=abc123\r\n')
+    assert rdpgateway.parse_connection_request(data[:10]) is None
+    try:
+        rdpgateway.parse_connection_request('GET / HTTP/1.1\r\n\r\n')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+class FakeServer(object):
+    conn = None
+
+    def __init__(self):
+        self.transport = self
+        self.closed = False
+
+    def loseConnection(self):
+        self.closed = True
+
+
+def test_reap_idle_routes():
+    factory = rdpgateway.GatewayFactory()
+    factory.idle_timeout = 60
+    reaped = []
+    factory.onReap = reaped.append
+    unused = factory.add_route('10.0.0.1', 3389, 'alice', 'vm-1')
+    used = factory.add_route('10.0.0.2', 3389, 'bob', 'vm-2')
+    now = factory.idle_since[used]
+    server = FakeServer()
+    factory.register(used, server)
+
+    # 从未连接的路由超时后删除，有连接的路由保留
+    factory.reapIdle(now + 61)
+    assert reaped == [unused] and unused not in factory.routes
+    assert used in factory.routes and not server.closed
+
+    # 最后一个连接关闭后重新计时
+    factory.unregister(used, server)
+    since = factory.idle_since[used]
+    factory.reapIdle(since + 30)
+    assert used in factory.routes
+    factory.reapIdle(since + 61)
+    assert reaped == [unused, used]
+    assert factory.routes == factory.owners == factory.idle_since == {}
+    assert factory.stats()['reaped'] == 2
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
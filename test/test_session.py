@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import testutil
+from server import session
+
+
+log = testutil.logger(__file__)
+
+
+class FakeAdmin(object):
+    created = []
+    delay = 0
+
+    def __init__(self, project):
+        time.sleep(self.delay)
+        self.project = project
+        self.expiring = False
+        FakeAdmin.created.append(project)
+
+    def will_expire_soon(self, margin):
+        return self.expiring
+
+
+def test_admin_pool():
+    saved = session.AdminSession
+    session.AdminSession = FakeAdmin
+    FakeAdmin.created = []
+    try:
+        pool = session.AdminSessionPool(2, 300)
+        admin = pool.get('p1')
+        assert pool.get('p1') is admin and FakeAdmin.created == ['p1']
+        # token 即将过期时重新认证
+        admin.expiring = True
+        assert pool.get('p1') is not admin and FakeAdmin.created == ['p1', 'p1']
+        # 超过容量时淘汰最久未使用的项目
+        pool.get('p2')
+        pool.get('p1')
+        pool.get('p3')
+        assert list(pool.sessions) == ['p1', 'p3']
+
+        # 并发请求同一项目只认证一次
+        FakeAdmin.created = []
+        FakeAdmin.delay = 0.2
+        pool = session.AdminSessionPool(2, 300)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(pool.get('p4'))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert FakeAdmin.created == ['p4'] and len(set(results)) == 1
+    finally:
+        session.AdminSession = saved
+        FakeAdmin.delay = 0
+
+
+class FakeHypervisor(object):
+    def __init__(self, name, ip):
+        self.hypervisor_hostname = name
+        self.host_ip = ip
+
+
+class FakeCompute(object):
+    def __init__(self):
+        self.hosts = {'node-1': '192.168.1.1'}
+        self.calls = 0
+
+    def hypervisors(self, details=False):
+        assert details
+        self.calls += 1
+        return [FakeHypervisor(name, ip) for name, ip in self.hosts.items()]
+
+
+def test_hypervisor_index():
+    admin = FakeAdmin('admin')
+    admin.conn = admin
+    admin.compute = compute = FakeCompute()
+    saved = session.admin_session
+    session.admin_session = lambda project: admin
+    try:
+        index = session.HypervisorIndex(300)
+        assert index.lookup('node-1') == '192.168.1.1' and compute.calls == 1
+        assert index.lookup('node-1') == '192.168.1.1' and compute.calls == 1
+        # 刚刷新过，未知主机名不再请求
+        compute.hosts['node-2'] = '192.168.1.2'
+        assert index.lookup('node-2') is None and compute.calls == 1
+        index.updated -= index.miss_refresh_interval + 1
+        assert index.lookup('node-2') == '192.168.1.2' and compute.calls == 2
+        # 超过 ttl 后重新读取
+        index.updated -= 301
+        index.lookup('node-1')
+        assert compute.calls == 3
+    finally:
+        session.admin_session = saved
+
+
+class FakeSession(object):
+    def __init__(self, token, now):
+        self.token = token
+        self.username = 'user-' + token
+        self.project_id = 'p1'
+        self.created = self.last_access = now
+        self.expired = False
+        self.closed = False
+
+    def will_expire_soon(self, margin):
+        return self.expired
+
+    def close(self):
+        self.closed = True
+
+    def state(self):
+        return {'token': self.token, 'last_access': self.last_access}
+
+
+def test_token_store():
+    now = time.time()
+    store = session.TokenStore(3, 60, ttl=600)
+    sessions = [FakeSession(str(n), now) for n in range(4)]
+    for s in sessions[:3]:
+        store.add(s)
+    # 使用过的会话移到队尾，超过容量时淘汰最久未使用的
+    assert store.get('0') is sessions[0]
+    store.add(sessions[3])
+    assert [s['token'] for s in store.export()] == ['2', '0', '3']
+    assert sessions[1].closed
+
+    sessions[2].last_access -= 61
+    sessions[0].created -= 601
+    sessions[3].expired = True
+    for token in ('2', '0', '3'):
+        try:
+            store.get(token)
+            assert False, token
+        except KeyError:
+            pass
+    assert len(store) == 0
+    assert store.stats()['evictions'] == {'expired': 2, 'idle': 1, 'capacity': 1}
+
+    # 添加时顺便淘汰队首空闲的会话
+    old = FakeSession('old', now - 61)
+    store.add(old)
+    store.add(FakeSession('new', now))
+    assert old.closed and [s['token'] for s in store.export()] == ['new']
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import traceback
+
+import testutil
+from server import singleflight
+
+
+log = testutil.logger(__file__)
+
+
+def test_shared_result():
+    group = singleflight.Group()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(n):
+        calls.append(n)
+        started.set()
+        release.wait()
+        return n * 2
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(group.do('k', fetch, 21)))
+    leader.start()
+    started.wait()
+    waiters = [threading.Thread(target=lambda: results.append(group.do('k', fetch, 21)))
+               for _ in range(3)]
+    for t in waiters:
+        t.start()
+    while group.stats()['deduplicated'] < 3:
+        pass
+    release.set()
+    for t in [leader] + waiters:
+        t.join()
+    assert calls == [21] and results == [42] * 4
+    assert group.stats() == {'executed': 1, 'deduplicated': 3, 'in_flight': 0}
+
+
+def failing_call(started, release):
+    started.set()
+    release.wait()
+    raise ValueError('nova unavailable')
+
+
+def test_error_traceback():
+    group = singleflight.Group()
+    started = threading.Event()
+    release = threading.Event()
+
+    def lead():
+        try:
+            group.do('k', failing_call, started, release)
+        except ValueError:
+            pass
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    threading.Timer(0.1, release.set).start()
+    try:
+        group.do('k', failing_call, started, release)
+    except ValueError:
+        frames = [frame[2] for frame in traceback.extract_tb(sys.exc_info()[2])]
+    else:
+        assert False, 'error not raised'
+    leader.join()
+    # 等待者看到的 traceback 中包含执行者出错的位置
+    assert group.stats()['deduplicated'] == 1
+    assert frames[-1] == 'failing_call'
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import testutil
+from server import spice
+
+
+log = testutil.logger(__file__)
+
+
+def make_proc(root, pid, args, start=1000):
+    if not os.path.isdir(os.path.join(root, str(pid))):
+        os.mkdir(os.path.join(root, str(pid)))
+    with open(os.path.join(root, str(pid), 'cmdline'), 'wb') as f:
+        f.write('\0'.join(args) + '\0')
+    with open(os.path.join(root, str(pid), 'stat'), 'wb') as f:
+        f.write('{} (qemu kvm) S 1 {} 0 0 0 0 0 0 0 0 0 0 0 0 20 0 1 0 {} 0 0\n'.format(
+            pid, pid, start))
+
+
+def qemu_args(vm_id, port):
+    return ['/usr/libexec/qemu-kvm', '-name', 'guest=instance-00000001',
+            '-uuid', vm_id, '-spice', 'port={},tls-port=5901,addr=0.0.0.0'.format(port)]
+
+
+def test_parse_cmdline():
+    cmdline = '\0'.join(qemu_args('vm-1', 5900))
+    assert spice.parse_cmdline(cmdline) == ('vm-1', '5900')
+    assert spice.parse_cmdline('/bin/bash\0-l\0') == (None, None)
+
+
+def test_resolver():
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'self')) # 非进程目录
+        make_proc(root, 100, ['/sbin/init'])
+        make_proc(root, 200, qemu_args('vm-1', 5900))
+        resolver = spice.SpicePortResolver(root)
+
+        assert resolver.lookup('vm-1') == '5900'
+        assert resolver.lookup('vm-2') == ''
+
+        # VM 重启后进程号和端口都变化
+        shutil.rmtree(os.path.join(root, '200'))
+        make_proc(root, 300, qemu_args('vm-1', 5902))
+        make_proc(root, 400, qemu_args('vm-2', 5904))
+        assert resolver.lookup('vm-1') == '5902'
+        assert resolver.lookup('vm-2') == '5904'
+        assert sorted(resolver.scanned) == ['300', '400']
+    finally:
+        shutil.rmtree(root)
+
+
+def test_fork_and_reuse():
+    root = tempfile.mkdtemp()
+    try:
+        # libvirt fork 之后、exec 之前，命令行还是父进程的
+        make_proc(root, 500, ['/usr/sbin/libvirtd', '--listen'])
+        resolver = spice.SpicePortResolver(root)
+        assert resolver.lookup('vm-3') == ''
+        make_proc(root, 500, qemu_args('vm-3', 5906))
+        assert resolver.lookup('vm-3') == '5906'
+
+        # VM 退出后 pid 被另一个 qemu 重用
+        make_proc(root, 500, qemu_args('vm-4', 5908), start=2000)
+        assert resolver.lookup('vm-3') == ''
+        assert resolver.lookup('vm-4') == '5908'
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
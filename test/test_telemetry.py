@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import telemetry
+
+
+log = testutil.logger(__file__)
+
+
+def test_flow_paused():
+    flow = telemetry.Flow()
+    flow.pause(10)
+    flow.pause(11) # 重复暂停不重新计时
+    assert flow.paused_time(12) == 2
+    flow.resume(13)
+    flow.resume(20)
+    assert flow.paused == 3
+
+
+def test_report():
+    t = telemetry.Telemetry()
+    a = t.open('alice', 'vm-1')
+    a.started = 100
+    a.connected(100.5)
+    a.up.bytes, a.down.bytes = 10, 1000
+    a.down.pause(101)
+    t.close(a, 110)
+
+    b = t.open('alice', 'vm-2')
+    b.started = 105
+    b.up.bytes = 5
+
+    report = t.report(120)
+    assert report['active'] == 1
+    alice = report['users']['alice']
+    assert alice['connections'] == 2 and alice['active'] == 1
+    assert alice['bytes_up'] == 15 and alice['bytes_down'] == 1000
+    assert alice['paused_down'] == 9
+    assert alice['duration'] == 10 + 15
+    assert report['vms']['vm-1']['connect_time'] == 0.5
+    assert report['vms']['vm-2']['active'] == 1
+
+    t.close(a, 130) # 重复关闭不重复计入
+    assert t.report(120)['vms']['vm-1']['connections'] == 1
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
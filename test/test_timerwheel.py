@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import timerwheel
+
+
+log = testutil.logger(__file__)
+
+
+def test_expire():
+    wheel = timerwheel.TimerWheel(1, 30, now=100)
+    wheel.schedule('a', 130)
+    wheel.schedule('b', 110.5)
+    assert wheel.advance(110) == []
+    assert wheel.advance(111) == ['b']
+    # 重新计时后不在原到期时间到期
+    wheel.schedule('a', 140)
+    assert wheel.advance(135) == []
+    assert wheel.advance(140) == ['a']
+    assert len(wheel) == 0
+
+
+def test_cancel():
+    wheel = timerwheel.TimerWheel(5, 30, now=0)
+    wheel.schedule('a', 10)
+    wheel.cancel('a')
+    assert 'a' not in wheel
+    assert wheel.advance(100) == []
+
+
+def test_wrap():
+    # 超过一圈的项经过时放回，长时间停顿后一次取出所有到期项
+    wheel = timerwheel.TimerWheel(1, 10, now=0)
+    wheel.schedule('far', 25)
+    wheel.schedule('near', 3)
+    assert wheel.advance(5) == ['near']
+    assert wheel.advance(20) == []
+    assert wheel.advance(1000) == ['far']
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import testutil
+from server import session, vmwaiter
+
+from twisted.internet import defer, task
+
+
+log = testutil.logger(__file__)
+
+
+class FakeNova(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.status = {}
+        self.polls = []
+
+    def poll(self, vm_ids):
+        self.polls.append(self.clock.seconds())
+        return dict((vm_id, self.status.get(vm_id)) for vm_id in vm_ids)
+
+
+def make_waiter():
+    clock = task.Clock()
+    nova = FakeNova(clock)
+    waiter = vmwaiter.StatusWaiter(nova.poll, clock)
+    waiter.run = lambda f, *args: defer.maybeDeferred(f, *args)
+    return waiter, nova, clock
+
+
+def results(d):
+    fired = []
+    d.addBoth(fired.append)
+    return fired
+
+
+def test_backoff():
+    waiter, nova, clock = make_waiter()
+    nova.status['vm-1'] = 'SHUTOFF'
+    fired = results(waiter.wait('vm-1', 'ACTIVE', 60))
+    clock.pump([0.25] * 120)
+    # 状态没有变化时间隔从 0.5 秒逐渐增加到 4 秒
+    gaps = [b - a for a, b in zip(nova.polls, nova.polls[1:])]
+    assert nova.polls[0] == 0.5
+    assert all(0.5 <= gap <= 4 for gap in gaps)
+    assert gaps == sorted(gaps) and gaps[-1] == 4
+    assert len(nova.polls) < 15
+
+    # 状态变化后恢复 0.5 秒间隔
+    nova.status['vm-1'] = 'BUILD'
+    polls = len(nova.polls)
+    clock.pump([0.25] * 18)
+    assert nova.polls[polls + 1] - nova.polls[polls] == 0.5
+    nova.status['vm-1'] = 'ACTIVE'
+    clock.pump([0.25] * 20)
+    assert fired == ['ACTIVE']
+    # 没有等待的VM时停止查询
+    polls = len(nova.polls)
+    clock.advance(10)
+    assert len(nova.polls) == polls and clock.getDelayedCalls() == []
+
+
+def test_new_waiter_polls_soon():
+    waiter, nova, clock = make_waiter()
+    nova.status['vm-1'] = 'SHUTOFF'
+    waiter.wait('vm-1', 'ACTIVE', 60)
+    clock.pump([0.25] * 40)
+    # 新的等待不必等到当前的长间隔结束
+    polls = len(nova.polls)
+    fired = results(waiter.wait('vm-2', 'SHUTOFF', 60))
+    nova.status['vm-2'] = 'SHUTOFF'
+    clock.advance(0.5)
+    assert len(nova.polls) == polls + 1 and fired == ['SHUTOFF']
+
+
+def test_timeout():
+    waiter, nova, clock = make_waiter()
+    nova.status['vm-1'] = 'SHUTOFF'
+    fired = results(waiter.wait('vm-1', 'ACTIVE', 10))
+    clock.pump([0.5] * 19)
+    assert fired == []
+    clock.advance(0.5)
+    assert len(fired) == 1 and fired[0].check(session.VMError)
+    assert fired[0].getErrorMessage() == 'Action timeout.'
+    assert waiter.pending == {} and waiter.last_status == {}
+    clock.advance(10)
+    assert clock.getDelayedCalls() == []
+
+
+def test_error_status():
+    waiter, nova, clock = make_waiter()
+    nova.status['vm-1'] = 'ERROR'
+    fired = results(waiter.wait('vm-1', 'ACTIVE', 10))
+    other = results(waiter.wait('vm-2', 'ACTIVE', 10))
+    clock.advance(0.5)
+    assert len(fired) == 1 and fired[0].getErrorMessage() == 'VM is in error state.'
+    assert other == [] and list(waiter.pending) == ['vm-2']
+    # 超时定时器已取消
+    assert len(clock.getDelayedCalls()) == 2
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
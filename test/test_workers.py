@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import select
+import socket
+import time
+
+import testutil
+from server import forward_worker, port_forward, twist_forward
+from test_forward_engine import echo_server, recv_exactly
+
+from twisted.internet import defer, reactor, threads
+from twisted.python.failure import Failure
+
+
+log = testutil.logger(__file__)
+
+
+def free_ports(count):
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+    for sock in socks:
+        sock.bind(('127.0.0.1', 0))
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+    return ports
+
+
+class FakeWorker(object):
+    def __init__(self, index):
+        self.index = index
+        self.sent = []
+
+    def send(self, cmd):
+        self.sent.append(cmd)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.ready = defer.Deferred()
+        self.deleted = []
+        self.since = None
+
+    def add(self, port, host, dest, dport):
+        return self.ready
+
+    def idleSince(self, port):
+        return self.since
+
+    def delete(self, port):
+        self.deleted.append(port)
+
+
+def test_control():
+    loop = port_forward.EventLoop()
+    cmd_r, cmd_w = os.pipe()
+    reply_r, reply_w = os.pipe()
+    control = forward_worker.Control(loop, cmd_r, reply_w)
+    allocator = twist_forward.PortAllocator(*free_ports(1) * 2)
+    port, placeholder = allocator.reserve('127.0.0.1')
+
+    def command(*cmds):
+        # 命令可能分多次读到
+        data = ''.join(json.dumps(cmd) + '\n' for cmd in cmds)
+        os.write(cmd_w, data[:7])
+        control.on_event(0)
+        os.write(cmd_w, data[7:])
+        control.on_event(0)
+        return [json.loads(line) for line in os.read(reply_r, 65536).splitlines()]
+
+    # 在 reserve() 占用的端口上以 SO_REUSEPORT 监听
+    assert command({'op': 'add', 'port': port, 'host': '127.0.0.1', 'dest': '127.0.0.1', 'dport': 1}) == \
+        [{'op': 'added', 'port': port}]
+    assert control.listeners[port].port == port
+    # 其他程序不能绑定这个端口
+    other = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        other.bind(('127.0.0.1', port))
+        assert False, 'port is not reserved'
+    except socket.error:
+        pass
+    other.close()
+
+    # 不能监听时回复错误
+    busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    busy.bind(('127.0.0.1', 0))
+    busy.listen(1)
+    reply = command({'op': 'add', 'port': busy.getsockname()[1], 'host': '127.0.0.1',
+                     'dest': '127.0.0.1', 'dport': 1})
+    assert reply[0]['op'] == 'error' and reply[0]['port'] == busy.getsockname()[1]
+    busy.close()
+
+    assert command({'op': 'delete', 'port': port}) == [{'op': 'deleted', 'port': port}]
+    assert control.listeners == {}
+
+    # stdin 关闭后退出
+    os.close(cmd_w)
+    control.on_event(0)
+    assert loop.thread_stop
+    placeholder.close()
+    for fd in (cmd_r, reply_r, reply_w):
+        os.close(fd)
+
+
+def test_pool_ready():
+    pool = twist_forward.WorkerPool(2)
+    pool.stopping = True # 不重启进程
+    workers = [FakeWorker(0), FakeWorker(1)]
+    for worker in workers:
+        pool.workerStarted(worker)
+    ready = []
+    d = pool.add(40001, '', '10.0.0.1', 3389)
+    d.addCallback(ready.append)
+    assert [w.sent[0]['op'] for w in workers] == ['add', 'add']
+    # 所有进程都开始监听后才就绪，退出的进程不再等待
+    pool.workerReplied(workers[0], {'op': 'added', 'port': 40001})
+    assert ready == []
+    pool.workerEnded(workers[1], Failure(Exception('killed')))
+    assert ready == [40001]
+
+    # 新启动的进程恢复当前的代理
+    worker = FakeWorker(1)
+    pool.workerStarted(worker)
+    assert worker.sent == [{'op': 'add', 'port': 40001, 'host': '',
+                            'dest': '10.0.0.1', 'dport': 3389}]
+    pool.delete(40001)
+    assert worker.sent[-1] == {'op': 'delete', 'port': 40001}
+
+    errors = []
+    pool.add(40002, '', '10.0.0.2', 3389).addErrback(errors.append)
+    pool.workerReplied(worker, {'op': 'error', 'port': 40002, 'err': 'Address in use'})
+    assert len(errors) == 1 and errors[0].check(IOError)
+    assert pool.waiting == {}
+
+
+def test_control_usage():
+    dport = echo_server()
+    loop = port_forward.EventLoop()
+    cmd_r, cmd_w = os.pipe()
+    reply_r, reply_w = os.pipe()
+    control = forward_worker.Control(loop, cmd_r, reply_w)
+    port = free_ports(1)[0]
+
+    def command(cmd):
+        os.write(cmd_w, json.dumps(cmd) + '\n')
+        control.on_event(0)
+        data = os.read(reply_r, 65536) if cmd['op'] in ('add', 'stats') else ''
+        return [json.loads(line) for line in data.splitlines()]
+
+    def usage():
+        reply = command({'op': 'stats'})[0]
+        return reply['ports'][str(port)], reply['refused']
+
+    command({'op': 'add', 'port': port, 'host': '127.0.0.1', 'dest': '127.0.0.1', 'dport': dport})
+    listener = control.listeners[port]
+    (connections, since), refused = usage()
+    assert connections == 0 and since <= time.time() and refused == 0
+
+    client = socket.create_connection(('127.0.0.1', port))
+    listener.on_event(select.EPOLLIN)
+    assert usage() == ([1, None], 0)
+
+    # 超过限制的端口上新连接直接关闭，拒绝数只报告一次
+    command({'op': 'limit', 'ports': [port]})
+    refused_client = socket.create_connection(('127.0.0.1', port))
+    listener.on_event(select.EPOLLIN)
+    assert refused_client.recv(1) == ''
+    refused_client.close()
+    assert usage() == ([1, None], 1)
+    assert usage() == ([1, None], 0)
+    command({'op': 'limit', 'ports': []})
+    assert not listener.refusing
+
+    # 最后一个连接关闭后开始计算空闲时间
+    before = time.time()
+    client.close()
+    channel = [c for c in listener.channels if c.connected and c.sock.getpeername()[1] != dport][0]
+    channel.on_event(select.EPOLLIN)
+    (connections, since), _ = usage()
+    assert connections == 0 and before <= since <= time.time()
+
+    control.close()
+    for fd in (cmd_r, cmd_w, reply_r, reply_w):
+        os.close(fd)
+
+
+def test_pool_usage():
+    pool = twist_forward.WorkerPool(2)
+    pool.stopping = True
+    workers = [FakeWorker(0), FakeWorker(1)]
+    for worker in workers:
+        pool.workerStarted(worker)
+    refused = []
+    pool.onUsage = refused.append
+    pool.add(40001, '', '10.0.0.1', 3389)
+    pool.poll()
+    assert [w.sent[-1] for w in workers] == [{'op': 'stats'}] * 2
+
+    pool.workerReplied(workers[0], {'op': 'stats', 'ports': {'40001': [2, None]}, 'refused': 1})
+    assert pool.connections(40001) == 2 and pool.idleSince(40001) is None
+    pool.workerReplied(workers[1], {'op': 'stats', 'ports': {'40001': [1, None]}, 'refused': 0})
+    assert pool.connections(40001) == 3 and refused == [1, 0]
+    # 所有进程中都没有连接时才算空闲，从最后关闭的连接算起
+    pool.workerReplied(workers[0], {'op': 'stats', 'ports': {'40001': [0, 90.0]}, 'refused': 0})
+    assert pool.connections(40001) == 1 and pool.idleSince(40001) is None
+    pool.workerReplied(workers[1], {'op': 'stats', 'ports': {'40001': [0, 100.0]}, 'refused': 0})
+    assert pool.idleSince(40001) == 100.0
+
+    # 新启动的进程还未报告时不算空闲
+    pool.workerEnded(workers[1], Failure(Exception('killed')))
+    assert pool.idleSince(40001) == 90.0
+    worker = FakeWorker(1)
+    pool.workerStarted(worker)
+    assert pool.idleSince(40001) is None
+
+    # 限制变化时才发送，新启动的进程先收到限制
+    pool.limit([40001])
+    assert workers[0].sent[-1] == worker.sent[-1] == {'op': 'limit', 'ports': [40001]}
+    pool.limit(set([40001]))
+    assert len(worker.sent) == 2
+    late = FakeWorker(2)
+    pool.workerStarted(late)
+    assert late.sent[0] == {'op': 'limit', 'ports': [40001]} and late.sent[1]['op'] == 'add'
+    pool.delete(40001)
+    assert pool.refusing == set()
+
+
+def test_worker_proxy():
+    allocator = twist_forward.PortAllocator(*free_ports(1) * 2)
+    pool = FakePool()
+    proxy = twist_forward.WorkerProxy('10.0.0.1', 3389, '127.0.0.1', allocator, pool)
+    assert proxy.whenReady() is pool.ready
+    # 空闲时间来自转发进程的报告，有连接时为 0
+    assert proxy.idleTime(1000.0) == 0
+    pool.since = 400.0
+    assert proxy.idleTime(1000.0) == 600.0
+    assert allocator.stats()['used'] == 1
+    proxy.stop()
+    assert pool.deleted == [proxy.getport()]
+    assert allocator.stats()['used'] == 0
+    # 释放后其他程序可以绑定
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', proxy.getport()))
+    sock.close()
+
+
+def test_forwarding():
+    # 启动真正的转发进程，经过代理端口访问 echo 服务
+    dport = echo_server()
+    allocator = twist_forward.PortAllocator(*free_ports(1) * 2)
+    pool = twist_forward.WorkerPool(2)
+    pool.start()
+    result = {}
+
+    def started():
+        proxy = twist_forward.WorkerProxy('127.0.0.1', dport, '127.0.0.1', allocator, pool)
+        d = proxy.whenReady()
+        d.addCallback(lambda port: threads.deferToThread(echo, port))
+        d.addCallback(lambda data: result.update(echo=data))
+        d.addErrback(lambda failure: result.update(error=failure))
+        d.addBoth(lambda _: (proxy.stop(), pool.stop(), reactor.stop()))
+
+    def echo(port):
+        sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+        sock.sendall('hello')
+        data = recv_exactly(sock, 5)
+        sock.close()
+        return data
+
+    # 等待进程启动后再添加代理，否则 add 不等待任何进程
+    def wait():
+        if len(pool.workers) < pool.count:
+            reactor.callLater(0.05, wait)
+        else:
+            started()
+
+    reactor.callWhenRunning(wait)
+    timeout = reactor.callLater(20, reactor.stop)
+    reactor.run()
+    assert 'error' not in result, result.get('error')
+    assert result['echo'] == 'hello'
+    timeout.cancel()
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import socket
+
+import testutil
+from server import wsserver, user_monitor
+
+from twisted.internet import protocol, reactor, task
+
+
+log = testutil.logger(__file__)
+
+
+class FakeClient(object):
+    peer = 'test'
+
+    def __init__(self):
+        self.messages = []
+        self.producer = None
+        self.aborted = False
+
+    def sendMessage(self, msg):
+        self.messages.append(json.loads(msg))
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def dropConnection(self, abort=False):
+        self.aborted = abort
+
+    def fill(self, size):
+        """模拟 transport 缓冲写满后又写入 size 字节。"""
+        self.producer.pauseProducing()
+        self.producer.sent(size)
+
+    def flush(self):
+        self.producer.resumeProducing()
+
+
+def make_factory(history, policy='resync', clock=None):
+    factory = wsserver.BroadcastServerFactory(u"ws://127.0.0.1:8893", history, 1000, policy, clock)
+    factory.state = lambda: [
+        {'user': 'alice', 'online': True, 'vm': None, 'ip_addr': None, 'project_id': 'p1', 'host': None},
+        {'user': 'bob', 'online': True, 'vm': 'vm-2', 'ip_addr': None, 'project_id': 'p2', 'host': None}]
+    factory.item_topics = user_monitor.topics_of
+    return factory
+
+
+def test_snapshot():
+    factory = make_factory(4)
+    factory.publish({'action': 'notify', 'user': 'bob'})
+    client = FakeClient()
+    factory.register(client)
+    factory.sync(client, None)
+    snapshot = client.messages[0]
+    assert snapshot['action'] == 'snapshot' and snapshot['seq'] == 1
+    assert snapshot['users'][0]['user'] == 'alice'
+    factory.publish({'action': 'notify', 'user': 'carol'})
+    assert client.messages[1]['seq'] == 2
+
+
+def test_resume():
+    factory = make_factory(4)
+    for n in range(6):
+        factory.publish({'action': 'notify', 'user': 'user-{}'.format(n)})
+    # 历史中保留 3..6，从 2 之后续传
+    client = FakeClient()
+    factory.register(client)
+    factory.sync(client, (factory.epoch, 2))
+    assert [m['seq'] for m in client.messages] == [3, 4, 5, 6]
+    # 已经错过历史之外的消息
+    client = FakeClient()
+    factory.register(client)
+    factory.sync(client, (factory.epoch, 1))
+    assert client.messages[0]['action'] == 'snapshot'
+    # 服务重启后序号不连续
+    client = FakeClient()
+    factory.register(client)
+    factory.sync(client, (factory.epoch - 1, 5))
+    assert client.messages[0]['action'] == 'snapshot'
+    assert factory.stats()['resumed'] == 1
+
+
+def test_handover():
+    factory = make_factory(4)
+    for n in range(6):
+        factory.publish({'action': 'notify', 'user': 'user-{}'.format(n)})
+    state = json.loads(json.dumps(factory.export()))
+    # 新进程沿用序号，客户端重连后续传
+    factory = make_factory(4)
+    factory.restore(state)
+    client = FakeClient()
+    factory.register(client)
+    factory.sync(client, (state['epoch'], 4))
+    assert [m['seq'] for m in client.messages] == [5, 6]
+    factory.publish({'action': 'notify', 'user': 'carol'})
+    assert client.messages[-1]['seq'] == 7
+
+
+def test_topics():
+    factory = make_factory(16)
+    everyone, p1, both = FakeClient(), FakeClient(), FakeClient()
+    factory.register(everyone)
+    factory.register(p1, ['project:p1'])
+    factory.register(both, ['project:p1', 'vm:vm-2'])
+    factory.sync(p1, None)
+    assert [u['user'] for u in p1.messages[0]['users']] == ['alice']
+    factory.sync(both, None)
+    assert len(both.messages[0]['users']) == 2
+
+    factory.publish({'action': 'bulk', 'vm': 'vm-2'}, topics=['vm:vm-2', 'project:p2'])
+    factory.publish({'action': 'bulk_done'})
+    assert len(everyone.messages) == 2
+    assert [m['action'] for m in p1.messages[1:]] == ['bulk_done']
+    assert [m['action'] for m in both.messages[1:]] == ['bulk', 'bulk_done']
+
+    # 批量通知按订阅拆分，同一变化只发一次
+    changes = [{'user': 'alice', 'vm': 'vm-1', 'project_id': 'p1'},
+               {'user': 'bob', 'vm': 'vm-2', 'project_id': 'p1'},
+               {'user': 'carol', 'vm': 'vm-3', 'project_id': 'p3'}]
+    factory.publish({'action': 'notify_batch', 'changes': changes}, split='changes')
+    assert len(everyone.messages[-1]['changes']) == 3
+    assert [c['user'] for c in p1.messages[-1]['changes']] == ['alice', 'bob']
+    assert [c['user'] for c in both.messages[-1]['changes']] == ['alice', 'bob']
+    seq = everyone.messages[-1]['seq']
+    assert p1.messages[-1]['seq'] == both.messages[-1]['seq'] == seq
+
+    # 续传时同样过滤
+    client = FakeClient()
+    factory.register(client, ['project:p3'])
+    factory.sync(client, (factory.epoch, 0))
+    assert [m['action'] for m in client.messages] == ['bulk_done', 'notify_batch']
+    assert [c['user'] for c in client.messages[1]['changes']] == ['carol']
+
+    factory.unsubscribe(p1, ['project:p1'])
+    factory.unregister(both)
+    assert factory.stats()['topics'] == 1 and factory.stats()['subscribed'] == 1
+    factory.publish({'action': 'bulk', 'vm': 'vm-2'}, topics=['vm:vm-2'])
+    assert p1.messages[-1]['action'] == 'bulk'
+
+
+def test_valid_topics():
+    assert wsserver.valid_topics(['project:p1', 'vm:vm-2', u'user:alice', 'host:node-1'])
+    assert wsserver.valid_topics([])
+    assert not wsserver.valid_topics('project:p1') # 字符串会被当作单个字符订阅
+    assert not wsserver.valid_topics(['p1'])
+    assert not wsserver.valid_topics(['vm:'])
+    assert not wsserver.valid_topics([{'vm': 'vm-2'}])
+    assert not wsserver.valid_topics(None)
+
+
+def test_slow():
+    clock = task.Clock()
+    factory = make_factory(16, clock=clock)
+    fast, slow = FakeClient(), FakeClient()
+    factory.register(fast)
+    factory.register(slow)
+    factory.publish({'action': 'notify', 'user': 'user-0'})
+    slow.fill(2000)
+    factory.publish({'action': 'bulk', 'vm': 'vm-1'}, topics=['vm:vm-1'])
+    factory.publish({'action': 'bulk_done'})
+    assert len(fast.messages) == 3 and len(slow.messages) == 1
+    assert slow.dropped == 2 and factory.stats()['lagging'] == 1
+    assert factory.queues()[0]['queued'] == 2000
+
+    # 缓冲写出之前不补发，之后从历史中补发丢弃的消息
+    clock.advance(factory.check_interval)
+    assert len(slow.messages) == 1
+    slow.flush()
+    clock.advance(factory.check_interval)
+    assert [m['action'] for m in slow.messages] == ['notify', 'bulk', 'bulk_done']
+    factory.publish({'action': 'notify', 'user': 'user-3'})
+    assert [m['seq'] for m in slow.messages] == [1, 2, 3, 4]
+    assert factory.stats()['resyncs'] == 1 and not clock.getDelayedCalls()
+
+    # 丢弃的消息已不在历史中时发送快照
+    slow.fill(2000)
+    for n in range(20):
+        factory.publish({'action': 'notify', 'user': 'user-{}'.format(n)})
+    slow.flush()
+    clock.advance(factory.check_interval)
+    assert slow.messages[-1]['action'] == 'snapshot' and slow.messages[-1]['seq'] == 24
+    factory.publish({'action': 'bulk_done'})
+    assert slow.messages[-1]['seq'] == 25
+
+    factory = make_factory(16, 'disconnect', clock)
+    client = FakeClient()
+    factory.register(client)
+    client.fill(2000)
+    factory.publish({'action': 'notify', 'user': 'alice'})
+    factory.publish({'action': 'notify', 'user': 'bob'})
+    assert client.aborted and client.messages == []
+    assert factory.stats()['disconnects'] == 1 and factory.stats()['dropped'] == 2
+
+
+
+def test_send_meter():
+    # 对端不读取时 TCP transport 暂停 producer，写出缓冲后恢复
+    meter = wsserver.SendMeter()
+    connected = []
+
+    class Writer(protocol.Protocol):
+        def connectionMade(self):
+            self.transport.registerProducer(meter, True)
+            connected.append(self)
+
+    factory = protocol.Factory()
+    factory.protocol = Writer
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    peer = socket.create_connection(('127.0.0.1', port.getHost().port))
+    try:
+        while not connected:
+            reactor.iterate(0.01)
+        writer = connected[0]
+        chunk = 'x' * 65536
+        sent = 0
+        while not meter.paused:
+            writer.transport.write(chunk)
+            meter.sent(len(chunk))
+            sent += len(chunk)
+            reactor.iterate(0)
+        for _ in range(16):
+            writer.transport.write(chunk)
+            meter.sent(len(chunk))
+            sent += len(chunk)
+        assert meter.queued == 16 * len(chunk) + len(chunk)
+
+        received = 0
+        peer.setblocking(False)
+        while meter.paused:
+            try:
+                received += len(peer.recv(1 << 20))
+            except socket.error:
+                pass
+            reactor.iterate(0.01)
+        assert meter.queued == 0 and received <= sent
+        writer.transport.loseConnection()
+    finally:
+        peer.close()
+        port.stopListening()
+        reactor.iterate(0.01)
+
+
+if __name__ == '__main__':
+    testutil.run(globals())
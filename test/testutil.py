@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+# 测试脚本共用的设置：把仓库根目录加入 sys.path 并配置日志。
+#
+#     import testutil
+#     from server import qos
+#
+#     log = testutil.logger(__file__)
+#     ...
+#     if __name__ == '__main__':
+#         testutil.run(globals())
+
+import inspect
+import logging
+import logging.config
+import sys, os.path as path
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from server import logconf
+
+
+logging.config.dictConfig(logconf.conf_dict)
+
+
+def logger(filename):
+    return logging.getLogger('server.' + path.splitext(path.basename(filename))[0])
+
+
+def run(namespace):
+    """按定义顺序运行脚本中所有以 test 开头的函数。"""
+    tests = [f for name, f in namespace.items()
+             if name.startswith('test') and inspect.isfunction(f)
+             and f.__module__ == namespace['__name__']]
+    tests.sort(key=lambda f: f.__code__.co_firstlineno)
+    for test in tests:
+        test()
+    logger(namespace['__file__']).debug('OK')